@@ -4,11 +4,32 @@ import unittest
 import Shotwell_event2folder
 import datetime
 import os
+import tempfile
+import hashlib
+import sqlite3
 
 
 
 #####TESTS########
 
+def sampleDB ()->sqlite3.Connection:
+	''' Returns an in-memory DB with the tables and columns of a Shotwell DB in use by the script.'''
+	con = sqlite3.connect (':memory:')
+	con.executescript ('''
+		CREATE TABLE EventTable (id INTEGER PRIMARY KEY, name TEXT, primary_photo_id INTEGER, time_created INTEGER, primary_source_id TEXT, comment TEXT);
+		CREATE TABLE PhotoTable (id INTEGER PRIMARY KEY, filename TEXT, filesize INTEGER DEFAULT 0, timestamp INTEGER DEFAULT 0, exposure_time INTEGER, import_id INTEGER DEFAULT 0, event_id INTEGER DEFAULT -1, md5 TEXT, time_created INTEGER DEFAULT 0, flags INTEGER DEFAULT 0, rating INTEGER DEFAULT 0, file_format INTEGER DEFAULT 0, title TEXT, time_reimported INTEGER, editable_id INTEGER DEFAULT -1);
+		CREATE TABLE VideoTable (id INTEGER PRIMARY KEY, filename TEXT, width INTEGER, height INTEGER, clip_duration REAL, is_interpretable INTEGER, filesize INTEGER DEFAULT 0, timestamp INTEGER DEFAULT 0, exposure_time INTEGER, import_id INTEGER DEFAULT 0, event_id INTEGER DEFAULT -1, md5 TEXT, time_created INTEGER DEFAULT 0, rating INTEGER DEFAULT 0, title TEXT, backlinks TEXT, time_reimported INTEGER, flags INTEGER DEFAULT 0, comment TEXT);
+		CREATE TABLE BackingPhotoTable (id INTEGER PRIMARY KEY, filepath TEXT);
+		INSERT INTO EventTable (id, name) VALUES (1, 'First event'), (2, null), (3, 'Empty event');
+		INSERT INTO PhotoTable (id, filename, exposure_time, event_id, editable_id) VALUES
+			(1, '/lib/a.jpg', 1000, 1, -1), (2, '/lib/b.jpg', 3000, 1, 1), (3, '/lib/c.jpg', 3000, 1, -1),
+			(4, '/lib/d.jpg', 50000, 2, -1), (5, '/lib/e.jpg', 0, -1, -1), (6, '/lib/f.jpg', 0, 9, -1);
+		INSERT INTO VideoTable (id, filename, exposure_time, event_id) VALUES
+			(1, '/lib/a.mov', 2000, 1), (2, '/lib/b.mov', 0, 2), (3, '/lib/c.mov', 60000, 2);
+		INSERT INTO BackingPhotoTable (id, filepath) VALUES (1, '/lib/b_modified.jpg');
+		''')
+	return con
+
 TM = Shotwell_event2folder
 
 class itemcheck_text_values (unittest.TestCase):
@@ -304,6 +325,1179 @@ class findeventname (unittest.TestCase):
 			self.assertEqual (match, result)
 
 
+class md5hash_test (unittest.TestCase):
+	""" Given a file, it returns its md5 hash. Files bigger than a chunk are hashed in several reads."""
+	def setUp (self):
+		self.tempdir = tempfile.TemporaryDirectory ()
+		self.contents = {
+			'empty.jpg': b'',
+			'small.jpg': b'small file',
+			'big.mov': os.urandom (TM.Hashchunksize * 2 + 100),
+			}
+		for filename, data in self.contents.items():
+			with open (os.path.join (self.tempdir.name, filename), 'wb') as f:
+				f.write (data)
+
+	def tearDown (self):
+		self.tempdir.cleanup ()
+
+	def test_known_values (self):
+		for filename, data in self.contents.items():
+			result = TM.md5hash (os.path.join (self.tempdir.name, filename))
+			self.assertEqual (hashlib.md5 (data).hexdigest(), result)
+
+	def test_md5hashpool (self):
+		filepaths = [os.path.join (self.tempdir.name, f) for f in self.contents]
+		result = TM.md5hashpool (filepaths + [os.path.join (self.tempdir.name, 'missing.jpg')])
+		expected = {os.path.join (self.tempdir.name, f): hashlib.md5 (d).hexdigest() for f, d in self.contents.items()}
+		self.assertEqual (expected, result)
+
+
+class Fingerprintcache_test (unittest.TestCase):
+	""" Stores values for files, keyed by their stat. Changed files are not fetched."""
+	def setUp (self):
+		self.tempdir = tempfile.TemporaryDirectory ()
+		self.cache = TM.Fingerprintcache (os.path.join (self.tempdir.name, 'cache.sqlite'), 2)
+		self.files = []
+		for n in range (3):
+			filepath = os.path.join (self.tempdir.name, f'file{n}.jpg')
+			with open (filepath, 'wb') as f:
+				f.write (b'data' * (n + 1))
+			self.files.append (filepath)
+
+	def tearDown (self):
+		self.cache.close ()
+		self.tempdir.cleanup ()
+
+	def test_stored_values (self):
+		self.cache.put (self.files[0], md5='abc', metadata={'title': 'my title'})
+		self.assertEqual ('abc', self.cache.get (self.files[0], 'md5'))
+		self.assertEqual ({'title': 'my title'}, self.cache.get (self.files[0], 'metadata'))
+		self.assertEqual (None, self.cache.get (self.files[0], 'mediainfo'))
+		self.assertEqual (None, self.cache.get (self.files[1], 'md5'))
+		self.assertEqual (None, self.cache.get (os.path.join (self.tempdir.name, 'missing.jpg'), 'md5'))
+
+	def test_changed_file (self):
+		self.cache.put (self.files[0], md5='abc')
+		with open (self.files[0], 'ab') as f:
+			f.write (b'more data')
+		self.assertEqual (None, self.cache.get (self.files[0], 'md5'))
+
+	def test_eviction (self):
+		for n, filepath in enumerate (self.files):
+			self.cache.put (filepath, md5=str(n))
+		self.cache.flush ()
+		count = self.cache.connection.execute ('SELECT count(*) FROM fingerprints').fetchone()[0]
+		self.assertEqual (2, count)
+
+	def test_older_cache_file (self):
+		cachefile = os.path.join (self.tempdir.name, 'old.sqlite')
+		con = sqlite3.connect (cachefile)
+		con.execute ("CREATE TABLE fingerprints (device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER,\
+			md5 TEXT, mediainfo BLOB, metadata BLOB, last_access INTEGER, PRIMARY KEY (device, inode))")
+		con.commit ()
+		con.close ()
+		cache = TM.Fingerprintcache (cachefile, 2)
+		cache.put (self.files[0], md5='abc', probe={'codec': 'h264'})
+		self.assertEqual ({'codec': 'h264'}, cache.get (self.files[0], 'probe'))
+		cache.close ()
+
+	def test_cachedprobevideo (self):
+		probevideo, fpcache = TM.probevideo, TM.fpcache
+		probed = []
+		TM.probevideo = lambda filepath: probed.append (filepath) or {'codec': 'h264'}
+		TM.fpcache = self.cache
+		try:
+			self.assertEqual ({self.files[0]: {'codec': 'h264'}, self.files[1]: {'codec': 'h264'}}, TM.probevideopool (self.files[:2], 2))
+			self.assertEqual ({'codec': 'h264'}, TM.cachedprobevideo (self.files[0]))
+		finally:
+			TM.probevideo, TM.fpcache = probevideo, fpcache
+		self.assertEqual (sorted (self.files[:2]), sorted (probed))
+
+
+class eventplanner_test (unittest.TestCase):
+	""" Yields events with their average date and items, items of not existent events are skipped."""
+	def test_known_values (self):
+		result = list (TM.eventplanner (sampleDB ()))
+		self.assertEqual ([1, 2, 3], [e[0] for e in result])
+		self.assertEqual (['First event', None, 'Empty event'], [e[1] for e in result])
+		# distinct exposure times of the event: 1000, 2000, 3000
+		self.assertEqual ([2000, 55000, 0], [e[2] for e in result])
+		self.assertEqual ([(1, 'PhotoTable'), (1, 'VideoTable'), (2, 'PhotoTable'), (3, 'PhotoTable')], [(i[0], i[5]) for i in result[0][3]])
+		self.assertEqual ('/lib/b_modified.jpg', result[0][3][2][10])
+		self.assertEqual (None, result[0][3][0][10])
+		self.assertEqual ([2, 3, 4], [i[0] for i in result[1][3]])
+		self.assertEqual ([], result[2][3])
+
+
+class Exposureindex_test (unittest.TestCase):
+	""" Given a time window, returns the number of events with items in it, and the most frequent event."""
+	known_values = (
+		((0, 1000), (0, None)),
+		((999, 1001), (1, 1)),
+		((999, 3001), (1, 1)),
+		((1000, 50001), (2, 1)),
+		((40000, 70000), (1, 2)),
+		)
+	def test_known_values (self):
+		index = TM.Exposureindex (sampleDB ())
+		self.assertEqual (9, len (index))
+		for (start, end), expected in self.known_values:
+			self.assertEqual (expected, index.window (start, end))
+		self.assertEqual (3, index.window (-1, 1)[0])
+
+	def test_updates (self):
+		index = TM.Exposureindex (sampleDB ())
+		index.move (0, -1, 55000, 5)
+		index.move (0, 9, 55001, 5)
+		self.assertEqual ((1, 2), index.window (-1, 1))
+		self.assertEqual ((2, 5), index.window (54000, 70000))
+		index.remove (12345, 1)
+		self.assertEqual (9, len (index))
+
+
+class timeclusters_test (unittest.TestCase):
+	""" Given entries sorted by time, groups them in clusters separated by a time gap."""
+	known_values = (
+		([], []),
+		([(10, 'a')], [[(10, 'a')]]),
+		([(10, 'a'), (14, 'b'), (18, 'c')], [[(10, 'a'), (14, 'b'), (18, 'c')]]),
+		([(10, 'a'), (14, 'b'), (19, 'c'), (35, 'd')], [[(10, 'a'), (14, 'b')], [(19, 'c')], [(35, 'd')]]),
+		)
+	def test_known_values (self):
+		for entries, expected in self.known_values:
+			self.assertEqual (expected, TM.timeclusters (entries, 5))
+
+
+class DBwriter_test (unittest.TestCase):
+	""" Buffers writes, executes them in order, and commits them in batches (never in dummy mode)."""
+	def setUp (self):
+		TM.dummymsg = ''
+
+	def test_order_and_batches (self):
+		con = sampleDB ()
+		con.commit ()
+		writer = TM.DBwriter (con, 3, False)
+		writer.execute ('UPDATE PhotoTable SET title = ? WHERE id = ?', ('first', 1))
+		writer.execute ('UPDATE PhotoTable SET title = title || ? WHERE id = ?', (' second', 1))
+		self.assertEqual (None, con.execute ('SELECT title FROM PhotoTable WHERE id = 1').fetchone()[0])
+		writer.execute ('UPDATE PhotoTable SET title = ? WHERE id = ?', ('third', 2))
+		self.assertFalse (con.in_transaction)
+		self.assertEqual ('first second', con.execute ('SELECT title FROM PhotoTable WHERE id = 1').fetchone()[0])
+		writer.execute ('UPDATE PhotoTable SET title = ? WHERE id = ?', ('fourth', 3))
+		writer.commit ('test')
+		self.assertFalse (con.in_transaction)
+		self.assertEqual ('fourth', con.execute ('SELECT title FROM PhotoTable WHERE id = 3').fetchone()[0])
+
+	def test_dummy (self):
+		con = sampleDB ()
+		con.commit ()
+		writer = TM.DBwriter (con, 1, True)
+		writer.execute ('UPDATE PhotoTable SET title = ? WHERE id = ?', ('first', 1))
+		writer.commit ()
+		self.assertTrue (con.in_transaction)
+		self.assertEqual ('first', con.execute ('SELECT title FROM PhotoTable WHERE id = 1').fetchone()[0])
+
+
+class executemoveplan_test (unittest.TestCase):
+	""" Moves files of a plan, resolving name collisions at destinations in plan order."""
+	def setUp (self):
+		TM.dummy, TM.dummymsg = False, ''
+		self.tempdir = tempfile.TemporaryDirectory ()
+		self.root = self.tempdir.name
+		for filepath in ('src1/IMG_0001.JPG', 'src2/IMG_0001.JPG', 'src2/IMG_0001_modified.JPG', 'src3/b.jpg'):
+			os.makedirs (os.path.dirname (os.path.join (self.root, filepath)), exist_ok=True)
+			with open (os.path.join (self.root, filepath), 'w') as f:
+				f.write (filepath)
+
+	def tearDown (self):
+		self.tempdir.cleanup ()
+
+	def test_known_values (self, allocator=False):
+		r = self.root
+		plan = [
+			TM.Movetask (1, 'PhotoTable', f'{r}/src1/IMG_0001.JPG', f'{r}/dest/IMG_0001.JPG', -1, None),
+			TM.Movetask (2, 'PhotoTable', f'{r}/src2/IMG_0001.JPG', f'{r}/dest/IMG_0001.JPG', 7, f'{r}/src2/IMG_0001_modified.JPG'),
+			TM.Movetask (3, 'VideoTable', f'{r}/src3/b.jpg', f'{r}/dest2/b.jpg', -1, None),
+			TM.Movetask (4, 'VideoTable', f'{r}/src3/missing.jpg', f'{r}/dest2/missing.jpg', -1, None),
+			]
+		for workers in (1, 3):
+			if allocator:
+				TM.nameallocator = TM.Nameallocator (TM.Dirindex ())  # A new index, files are moved back outside it
+			result = {task.id: (dest, editable_dest) for task, dest, editable_dest in TM.executemoveplan (plan, workers)}
+			self.assertEqual ({
+				1: (f'{r}/dest/IMG_0001.JPG', None),
+				2: (f'{r}/dest/IMG_0001(0).JPG', f'{r}/dest/IMG_0001(0)_modified.JPG'),
+				3: (f'{r}/dest2/b.jpg', None),
+				4: (None, None),
+				}, result)
+			with open (f'{r}/dest/IMG_0001(0).JPG') as f:
+				self.assertEqual ('src2/IMG_0001.JPG', f.read ())
+			# moving files back to run the plan again
+			for task in plan[:3]:
+				os.rename (result[task.id][0], task.src)
+			os.rename (result[2][1], plan[1].editable_src)
+
+	def test_allocated_in_plan_order (self):
+		""" With a name allocator names are given before moving, and moves are queued by device."""
+		try:
+			self.test_known_values (allocator=True)
+		finally:
+			TM.nameallocator = None
+
+	def test_executeplan (self):
+		""" Files are moved in chunks, and the paths of each chunk are committed before the next one is read."""
+		r = self.root
+		con = sampleDB ()
+		for Id, filename in ((1, 'src1/IMG_0001.JPG'), (2, 'src2/IMG_0001.JPG'), (3, 'src3/b.jpg')):
+			con.execute ("UPDATE PhotoTable SET filename = ? WHERE id = ?", (f'{r}/{filename}', Id))
+		con.commit ()
+		plan = [
+			TM.Movetask (1, 'PhotoTable', f'{r}/src1/IMG_0001.JPG', f'{r}/dest/IMG_0001.JPG', -1, None, 1),
+			TM.Movetask (2, 'PhotoTable', f'{r}/src2/IMG_0001.JPG', f'{r}/dest/IMG_0001.JPG', -1, None, 1),
+			TM.Movetask (3, 'PhotoTable', f'{r}/src3/missing.jpg', f'{r}/dest/missing.jpg', -1, None, 2),
+			]
+		committed = []
+		def tasks ():
+			for task in plan:
+				committed.append (con.execute ("SELECT count(*) FROM PhotoTable WHERE filename LIKE ?", (f'{r}/dest/%',)).fetchone()[0])
+				yield task
+		TM.nameallocator = TM.Nameallocator (TM.Dirindex ())
+		try:
+			finalpaths, movedfrom, failedevents = TM.executeplan ([], tasks (), 1, TM.DBwriter (con, 100, False), 1, {('PhotoTable', 2)})
+		finally:
+			TM.nameallocator = None
+		self.assertEqual ([0, 1, 2], committed)
+		self.assertEqual ({('PhotoTable', 2): f'{r}/dest/IMG_0001(0).JPG'}, finalpaths)
+		self.assertEqual ({f'{r}/src1', f'{r}/src2'}, movedfrom)
+		self.assertEqual ({2}, failedevents)
+		self.assertEqual (f'{r}/dest/IMG_0001(0).JPG', con.execute ("SELECT filename FROM PhotoTable WHERE id = 2").fetchone()[0])
+
+	def test_journal (self):
+		""" Names given to a batch are reserved, and the batch is journaled before it is moved."""
+		r = self.root
+		plan = [
+			TM.Movetask (1, 'PhotoTable', f'{r}/src1/IMG_0001.JPG', f'{r}/dest/IMG_0001.JPG', -1, None),
+			TM.Movetask (2, 'PhotoTable', f'{r}/src2/IMG_0001.JPG', f'{r}/dest/IMG_0001.JPG', 7, f'{r}/src2/IMG_0001_modified.JPG'),
+			]
+		journalpath = os.path.join (r, 'moves.journal')
+		TM.nameallocator = TM.Nameallocator (TM.Dirindex ())
+		TM.movejournal = TM.Movejournal (journalpath)
+		try:
+			result = [(dest, editable_dest) for task, dest, editable_dest in TM.executemoveplan (plan, 1)]
+			with open (journalpath, 'rb') as f:
+				records = list (TM.readrecords (f, journalpath))
+		finally:
+			TM.nameallocator, TM.movejournal = None, None
+		self.assertEqual ([(f'{r}/dest/IMG_0001.JPG', None), (f'{r}/dest/IMG_0001(0).JPG', f'{r}/dest/IMG_0001(0)_modified.JPG')], result)
+		self.assertEqual ([
+			('PhotoTable', 1, f'{r}/src1/IMG_0001.JPG', f'{r}/dest/IMG_0001.JPG'),
+			('PhotoTable', 2, f'{r}/src2/IMG_0001.JPG', f'{r}/dest/IMG_0001(0).JPG'),
+			('BackingPhotoTable', 7, f'{r}/src2/IMG_0001_modified.JPG', f'{r}/dest/IMG_0001(0)_modified.JPG'),
+			], records)
+
+	def test_recoverjournal (self):
+		r = self.root
+		con = sampleDB ()
+		con.execute ("UPDATE PhotoTable SET filename = ? WHERE id = 1", (f'{r}/src1/IMG_0001.JPG',))
+		con.execute ("UPDATE PhotoTable SET filename = ? WHERE id = 2", (f'{r}/src3/b.jpg',))
+		con.execute ("UPDATE PhotoTable SET filename = ? WHERE id = 3", (f'{r}/src2/IMG_0001.JPG',))
+		con.commit ()
+		journalpath = os.path.join (r, 'moves.journal')
+		journal = TM.Movejournal (journalpath)
+		journal.append ([
+			('PhotoTable', 1, f'{r}/src1/IMG_0001.JPG', f'{r}/dest/IMG_0001.JPG'),  # moved
+			('PhotoTable', 2, f'{r}/src3/b.jpg', f'{r}/dest/b.jpg'),  # not moved
+			('PhotoTable', 3, f'{r}/src2/IMG_0001.JPG', f'{r}/dest/c.jpg'),  # taken meanwhile,
+			('PhotoTable', 3, f'{r}/src2/IMG_0001.JPG', f'{r}/dest/c(0).jpg'),  # moved to a new name
+			])
+		journal.file.write (TM.planline (('PhotoTable', 4, '/a.jpg', '/b.jpg'))[:20])  # torn
+		journal.file.close ()
+		os.makedirs (f'{r}/dest')
+		os.rename (f'{r}/src1/IMG_0001.JPG', f'{r}/dest/IMG_0001.JPG')
+		open (f'{r}/dest/c.jpg', 'w').close ()
+		os.rename (f'{r}/src2/IMG_0001.JPG', f'{r}/dest/c(0).jpg')
+		self.assertEqual (2, TM.recoverjournal (con, journalpath))
+		self.assertEqual (f'{r}/dest/c(0).jpg', con.execute ("SELECT filename FROM PhotoTable WHERE id = 3").fetchone()[0])
+		self.assertEqual (f'{r}/dest/IMG_0001.JPG', con.execute ("SELECT filename FROM PhotoTable WHERE id = 1").fetchone()[0])
+		self.assertEqual (f'{r}/src3/b.jpg', con.execute ("SELECT filename FROM PhotoTable WHERE id = 2").fetchone()[0])
+		self.assertFalse (os.path.exists (journalpath))
+		self.assertEqual (0, TM.recoverjournal (con, journalpath))
+
+
+class Dirindex_test (unittest.TestCase):
+	""" Answers the kind of a pointer as itemcheck does, and it keeps coherent with filemove."""
+	def setUp (self):
+		TM.dummy, TM.dummymsg = False, ''
+		self.tempdir = tempfile.TemporaryDirectory ()
+		self.root = self.tempdir.name
+		os.makedirs (os.path.join (self.root, 'folder'))
+		with open (os.path.join (self.root, 'file.jpg'), 'w') as f:
+			f.write ('file')
+		os.symlink (os.path.join (self.root, 'nowhere'), os.path.join (self.root, 'link'))
+
+	def tearDown (self):
+		TM.dirindex = None
+		self.tempdir.cleanup ()
+
+	def test_known_values (self):
+		index = TM.Dirindex ()
+		for name in ('folder', 'file.jpg', 'link', 'missing', 'missing/file.jpg', 'file.jpg/file.jpg'):
+			pointer = os.path.join (self.root, name)
+			self.assertEqual (TM.itemcheck (pointer), index.kind (pointer))
+		self.assertRaises (TM.NotStringError, index.kind, None)
+		self.assertRaises (TM.MalformedPathError, index.kind, "/home//")
+
+	def test_changes_meanwhile_read (self):
+		index = TM.Dirindex ()
+		r = self.root
+		scandir = os.scandir
+		def changingscandir (path):
+			index.add (f'{r}/new.jpg', 'file')  # As another thread would, out of the lock
+			index.remove (f'{r}/file.jpg')
+			return scandir (path)
+		os.scandir = changingscandir
+		try:
+			entries = index.entries (r)
+		finally:
+			os.scandir = scandir
+		self.assertEqual ({'folder': 'folder', 'link': 'link', 'new.jpg': 'file'}, entries)
+		self.assertEqual ({}, index.loading)
+
+	def test_filemove (self):
+		TM.dirindex = TM.Dirindex ()
+		r = self.root
+		self.assertEqual ('', TM.pathkind (f'{r}/new/folder/file.jpg'))
+		self.assertEqual (f'{r}/new/folder/file.jpg', TM.filemove (f'{r}/file.jpg', f'{r}/new/folder/file.jpg'))
+		self.assertEqual ('', TM.pathkind (f'{r}/file.jpg'))
+		self.assertEqual ('file', TM.pathkind (f'{r}/new/folder/file.jpg'))
+		self.assertEqual ('folder', TM.pathkind (f'{r}/new'))
+		with open (f'{r}/file.jpg', 'w') as f:
+			f.write ('another file')
+		TM.dirindex.add (f'{r}/file.jpg', 'file')
+		self.assertEqual (f'{r}/new/folder/file(0).jpg', TM.filemove (f'{r}/file.jpg', f'{r}/new/folder/file.jpg'))
+		self.assertEqual ({'file.jpg': 'file', 'file(0).jpg': 'file'}, TM.dirindex.entries (f'{r}/new/folder'))
+
+
+class Nameallocator_test (unittest.TestCase):
+	""" Allocates the same free names that a Nextfilenumber probe loop gives."""
+	def setUp (self):
+		self.tempdir = tempfile.TemporaryDirectory ()
+		self.root = self.tempdir.name
+		for name in ('file.jpg', 'file(0).jpg', 'file(2).jpg', 'other(4).jpg', 'noext'):
+			with open (os.path.join (self.root, name), 'w') as f:
+				f.write (name)
+
+	def tearDown (self):
+		self.tempdir.cleanup ()
+
+	def probeloop (self, dest):
+		while TM.itemcheck (dest) != "":
+			dest = TM.Nextfilenumber (dest)
+		return dest
+
+	def test_known_values (self):
+		allocator = TM.Nameallocator (TM.Dirindex ())
+		for name in ('file.jpg', 'file(0).jpg', 'free.jpg', 'other(4).jpg', 'noext'):
+			dest = os.path.join (self.root, name)
+			self.assertEqual (self.probeloop (dest), allocator.allocate (dest))
+
+	def test_taken_names (self):
+		r = self.root
+		allocator = TM.Nameallocator (TM.Dirindex ())
+		self.assertEqual (f'{r}/file(1).jpg', allocator.allocate (f'{r}/file.jpg'))
+		allocator.index.add (f'{r}/file(1).jpg', 'file')
+		self.assertEqual (f'{r}/file(3).jpg', allocator.allocate (f'{r}/file.jpg'))
+		allocator.index.add (f'{r}/file(3).jpg', 'file')
+		self.assertEqual (f'{r}/file(4).jpg', allocator.allocate (f'{r}/file.jpg'))
+		allocator.index.remove (f'{r}/file(0).jpg')
+		self.assertEqual (f'{r}/file(0).jpg', allocator.allocate (f'{r}/file.jpg'))
+
+
+class Inotifywatcher_test (unittest.TestCase):
+	""" Detects changes on watched files, and waits for them with a debounce time."""
+	def setUp (self):
+		self.tempdir = tempfile.TemporaryDirectory ()
+		self.watcher = TM.Inotifywatcher (self.tempdir.name, {'photo.db', 'photo.db-journal'})
+		TM.Daemondebounce = 0.1
+
+	def tearDown (self):
+		self.watcher.close ()
+		self.tempdir.cleanup ()
+
+	def touch (self, name):
+		with open (os.path.join (self.tempdir.name, name), 'a') as f:
+			f.write ('data')
+
+	def test_read (self):
+		self.assertEqual (set (), self.watcher.read ())
+		self.touch ('photo.db')
+		self.touch ('photo.db-journal')
+		self.touch ('other.db')
+		self.assertEqual ({'photo.db', 'photo.db-journal'}, self.watcher.read ())
+		self.assertEqual (set (), self.watcher.read ())
+
+	def test_waitforchanges (self):
+		app = 'not-a-running-app'
+		self.assertEqual ([], TM.procpids (app))
+		self.assertFalse (TM.waitforchanges (self.watcher, app, 0.1))
+		self.touch ('photo.db')
+		self.assertTrue (TM.waitforchanges (self.watcher, app, 0.1))
+		self.assertTrue (TM.waitforchanges (self.watcher, app, 0.1, pending=True))
+
+	def test_waitappexit (self):
+		self.assertTrue (TM.waitappexit ('not-a-running-app', 0.1))
+		process = TM.subprocess.Popen (['sleep', '30'])
+		try:
+			self.assertFalse (TM.waitprocessexit (process.pid, 0.1))
+		finally:
+			process.kill ()
+		process.wait ()
+		self.assertTrue (TM.waitprocessexit (process.pid, 0.1))
+
+
+class eventsignatures_test (unittest.TestCase):
+	""" Returns a signature for each event, it changes when the event or its items change."""
+	def test_changes (self):
+		con = sampleDB ()
+		signatures = TM.eventsignatures (con)
+		self.assertEqual ([1, 2, 3], sorted (signatures))
+		self.assertEqual (('First event', 4), signatures[1][:2])
+		self.assertEqual (('Empty event', 0), signatures[3][:2])
+		self.assertEqual (signatures, TM.eventsignatures (con))
+		for sql in ("UPDATE PhotoTable SET title = 'new title' WHERE id = 1",
+					"UPDATE PhotoTable SET filename = '/lib/other/a.jpg' WHERE id = 1",
+					"UPDATE VideoTable SET event_id = 2 WHERE id = 1",
+					"UPDATE EventTable SET name = 'Renamed' WHERE id = 1",
+					"UPDATE PhotoTable SET rating = id WHERE id IN (2, 3)",
+					"UPDATE PhotoTable SET rating = 5 - rating WHERE id IN (2, 3)",  # Swapped ratings, 2-3 to 3-2
+					"UPDATE PhotoTable SET exposure_time = exposure_time + (id - 2) * 500 WHERE id IN (1, 3)",  # +500 and -500
+					"UPDATE PhotoTable SET title = CASE id WHEN 1 THEN 'x' ELSE 'y' END WHERE id IN (1, 2)",
+					"UPDATE PhotoTable SET title = CASE id WHEN 1 THEN 'y' ELSE 'x' END WHERE id IN (1, 2)",
+					):
+			con.execute (sql)
+			newsignatures = TM.eventsignatures (con)
+			self.assertNotEqual (signatures[1], newsignatures[1])
+			self.assertEqual (signatures[3], newsignatures[3])
+			signatures = newsignatures
+
+	def test_restricted (self):
+		con = sampleDB ()
+		signatures = TM.eventsignatures (con)
+		self.assertEqual ({1: signatures[1], 3: signatures[3]}, TM.eventsignatures (con, {1, 3}))
+		self.assertEqual (dict(), TM.eventsignatures (con, set ()))
+
+	def test_summaries (self):
+		con = sampleDB ()
+		summaries = TM.eventsummaries (con)
+		self.assertEqual ([1, 2, 3], sorted (summaries))
+		self.assertEqual (('First event', 4), summaries[1][:2])
+		self.assertEqual (('Empty event', 0, 0), summaries[3])
+		for sql in ("UPDATE PhotoTable SET title = 'new title' WHERE id = 1",
+					"UPDATE PhotoTable SET filename = '/lib/other/a.jpg' WHERE id = 1",
+					"UPDATE VideoTable SET event_id = 2 WHERE id = 1",
+					"UPDATE EventTable SET name = 'Renamed' WHERE id = 1",
+					"UPDATE PhotoTable SET rating = id WHERE id IN (2, 3)",
+					"UPDATE PhotoTable SET rating = 5 - rating WHERE id IN (2, 3)",  # Swapped ratings, 2-3 to 3-2
+					"UPDATE PhotoTable SET exposure_time = exposure_time + (id - 2) * 500 WHERE id IN (1, 3)",  # +500 and -500
+					"UPDATE PhotoTable SET time_reimported = 1000 WHERE id = 2",
+					):
+			con.execute (sql)
+			newsummaries = TM.eventsummaries (con)
+			self.assertNotEqual (summaries[1], newsummaries[1])
+			self.assertEqual (summaries[3], newsummaries[3])
+			summaries = newsummaries
+
+	def test_dirtyevents (self):
+		con = sampleDB ()
+		summaries, marks = TM.eventsummaries (con), TM.highwatermarks (con)
+		self.assertEqual ((set (), summaries), TM.dirtyevents (con, summaries, marks))
+		con.execute ("INSERT INTO PhotoTable (id, filename, exposure_time, event_id, time_created) VALUES (10, '/lib/new.jpg', 0, 3, 2000)")
+		self.assertEqual ({3}, TM.dirtyevents (con, TM.eventsummaries (con), marks)[0])  # Caught by the marks alone
+		summaries, marks = TM.eventsummaries (con), TM.highwatermarks (con)
+		self.assertEqual ((10, 2000, 0), marks['PhotoTable'])
+		con.execute ("UPDATE VideoTable SET time_reimported = 3000 WHERE id = 1")
+		videoevent = con.execute ('SELECT event_id FROM VideoTable WHERE id = 1').fetchone()[0]
+		self.assertEqual ({videoevent}, TM.dirtyevents (con, TM.eventsummaries (con), marks)[0])
+		con.execute ("UPDATE EventTable SET name = 'Renamed' WHERE id = 3")
+		self.assertIn (3, TM.dirtyevents (con, summaries, marks)[0])
+
+
+class snapshot_test (unittest.TestCase):
+	""" Plans on a copy of the DB, and checks that planned rows have not changed at the live DB."""
+	def setUp (self):
+		self.tmp = tempfile.TemporaryDirectory ()
+		self.dbpath = os.path.join (self.tmp.name, 'photo.db')
+		con = sqlite3.connect (self.dbpath)
+		sampleDB ().backup (con)
+		con.close ()
+
+	def tearDown (self):
+		self.tmp.cleanup ()
+
+	def test_snapshot (self):
+		snapshot = TM.snapshotDB (self.dbpath, os.path.join (self.tmp.name, 'snapshot.db'))
+		self.assertEqual (6, snapshot.execute ('SELECT count(*) FROM PhotoTable').fetchone()[0])
+		snapshot.close ()
+
+	def test_validation (self):
+		con = sqlite3.connect (self.dbpath)
+		signatures = TM.eventsignatures (con)
+		check = {
+			'maxevent': 3,
+			'signatures': {1: signatures[1]},
+			'rows': TM.rowvalues (con, {('VideoTable', 1), ('BackingPhotoTable', 1)}),
+			}
+		self.assertEqual (2, len (check['rows']))
+		self.assertTrue (TM.snapshotisvalid (con, check))
+		con.execute ("UPDATE EventTable SET name = 'Renamed' WHERE id = 2")
+		self.assertTrue (TM.snapshotisvalid (con, check))
+		for sql in ("UPDATE PhotoTable SET title = 'new title' WHERE id = 1",
+					"UPDATE BackingPhotoTable SET filepath = '/lib/moved.jpg' WHERE id = 1",
+					"INSERT INTO EventTable (id, name) VALUES (4, 'New event')",
+					"UPDATE PhotoTable SET exposure_time = exposure_time + (id - 2) * 500 WHERE id IN (1, 3)",  # Changes that add up to 0
+					):
+			con.execute ('SAVEPOINT change')
+			con.execute (sql)
+			self.assertFalse (TM.snapshotisvalid (con, check))
+			con.execute ('ROLLBACK TO change')
+			con.execute ('RELEASE change')
+		con.close ()
+
+
+class planfile_test (unittest.TestCase):
+	""" Writes and reads plan files, record by record."""
+	def setUp (self):
+		self.tmp = tempfile.TemporaryDirectory ()
+		self.planpath = os.path.join (self.tmp.name, 'test.plan')
+
+	def tearDown (self):
+		self.tmp.cleanup ()
+
+	def test_roundtrip (self):
+		writelog = [('UPDATE PhotoTable SET title = ? WHERE id = ?', ('title', 1))]
+		fileactions = [('title', '/lib/a.jpg', 'title')]
+		moveplan = [TM.Movetask (1, 'PhotoTable', '/lib/a.jpg', '/lib/2020/a.jpg', -1, None, 1)]
+		TM.writeplan (self.planpath, {'datelimit': None}, TM.planrecords (writelog, fileactions, moveplan))
+		records = list (TM.readplan (self.planpath))
+		self.assertEqual (('header', {'datelimit': None}), records[0])
+		self.assertEqual ([('sql', writelog[0]), ('file', fileactions[0]), ('move', tuple (moveplan[0]))], records[1:])
+		self.assertEqual (moveplan[0], TM.Movetask (*records[3][1]))
+
+	def test_values (self):
+		header = {
+			'created': datetime.datetime (2020, 1, 2, 3, 4, 5),
+			'check': {'maxevent': 3, 'signatures': {1: ('name', 2, 'ab')}, 'rows': {('VideoTable', 1): ('/lib/a.mov', 0, 1, None)}},
+			'mirror': ({('PhotoTable', 1): ('/recent', '/lib/a.jpg', 1)}, {1, 2}),
+			'~odd key': [1, 'two', None, 1.5, True],
+			}
+		TM.writeplan (self.planpath, header, [])
+		self.assertEqual ([('header', header)], list (TM.readplan (self.planpath)))
+		self.assertRaises (ValueError, TM.writeplan, self.planpath, {'bytes': b'data'}, [])
+
+	def test_data_only (self):
+		with open (self.planpath, 'wb') as f:
+			f.write (TM.Planmagic + b'{"~tuple": ["header", {"__reduce__": "os.system"}]}\n')
+		self.assertEqual ([('header', {'__reduce__': 'os.system'})], list (TM.readplan (self.planpath)))
+
+	def test_spool (self):
+		spool = TM.Planspool ()
+		spool.append (('UPDATE PhotoTable SET title = ? WHERE id = ?', ('title', 1)))
+		spool.append (('title', '/lib/a.jpg', 'title'))
+		self.assertEqual (2, len (spool))
+		self.assertEqual (list (spool), list (spool))
+		spool.append (('title', '/lib/b.jpg', None))
+		self.assertEqual ([('UPDATE PhotoTable SET title = ? WHERE id = ?', ('title', 1)), ('title', '/lib/a.jpg', 'title'), ('title', '/lib/b.jpg', None)], list (spool))
+		spool.close ()
+
+	def test_streamed (self):
+		""" Folders and moves are read from the plan as they are iterated."""
+		con = sampleDB ()
+		tasks = [TM.Movetask (n, 'PhotoTable', f'/lib/{n}.jpg', f'/lib/2020/{n}.jpg', -1, None, 1) for n in range (4)]
+		folders = [TM.Foldertask ('/lib/a', '/lib/b', tasks[:1])]
+		read = []
+		def records ():
+			for record in TM.planrecords ([('UPDATE PhotoTable SET title = ? WHERE id = ?', ('streamed', 1))], [], tasks[1:], folders):
+				read.append (record[0])
+				yield record
+		folderplan, moveplan = TM.applyplanrecords (records (), TM.DBwriter (con, 100, False))
+		self.assertEqual ('streamed', con.execute ("SELECT title FROM PhotoTable WHERE id = 1").fetchone()[0])
+		self.assertEqual (folders, list (folderplan))
+		self.assertEqual (['sql', 'folder', 'move'], read)
+		self.assertEqual (tasks[1:], list (moveplan))
+		self.assertEqual (['sql', 'folder', 'move', 'move', 'move'], read)
+		folderplan, moveplan = TM.applyplanrecords (iter ([('move', tuple (tasks[1]))]), TM.DBwriter (con, 100, False))
+		self.assertEqual (([], [tasks[1]]), (list (folderplan), list (moveplan)))
+
+	def test_truncated (self):
+		TM.writeplan (self.planpath, {}, TM.planrecords ([], [], []))
+		with open (self.planpath, 'ab') as f:
+			f.write (b'{"~tuple": ["mo')
+		plan = TM.readplan (self.planpath)
+		self.assertEqual (('header', {}), next (plan))
+		self.assertRaises (ValueError, next, plan)
+		with open (self.planpath, 'wb') as f:
+			f.write (b'not a plan')
+		self.assertRaises (ValueError, list, TM.readplan (self.planpath))
+
+
+class foldertask_test (unittest.TestCase):
+	""" Renames an event folder at once if all of its files are moved as they are."""
+	def setUp (self):
+		TM.dummy, TM.dummymsg = False, ''
+		TM.dirindex, TM.nameallocator, TM.movejournal = None, None, None
+		self.tempdir = tempfile.TemporaryDirectory ()
+		r = self.root = self.tempdir.name
+		for filepath in ('old/a.jpg', 'old/a_modified.jpg', 'old/b.mov'):
+			os.makedirs (os.path.dirname (os.path.join (r, filepath)), exist_ok=True)
+			with open (os.path.join (r, filepath), 'w') as f:
+				f.write (filepath)
+		self.tasks = [
+			TM.Movetask (1, 'PhotoTable', f'{r}/old/a.jpg', f'{r}/2020/new/a.jpg', 1, f'{r}/old/a_modified.jpg', 1),
+			TM.Movetask (1, 'VideoTable', f'{r}/old/b.mov', f'{r}/2020/new/b.mov', -1, None, 1),
+			]
+
+	def tearDown (self):
+		self.tempdir.cleanup ()
+
+	def test_eventfoldertask (self):
+		r = self.root
+		reserved = set ()
+		self.assertIsNone (TM.eventfoldertask (self.tasks, 3, reserved))  # Not all items are moved
+		self.assertIsNone (TM.eventfoldertask (self.tasks[:1], 1, reserved))  # Other files at the folder
+		self.assertIsNone (TM.eventfoldertask ([self.tasks[0], self.tasks[1]._replace (dest = f'{r}/2020/new/c.mov')], 2, reserved))  # Renamed file
+		self.assertEqual (TM.Foldertask (f'{r}/old', f'{r}/2020/new', self.tasks), TM.eventfoldertask (self.tasks, 2, reserved))
+		self.assertEqual ({f'{r}/2020/new'}, reserved)
+		self.assertIsNone (TM.eventfoldertask (self.tasks, 2, reserved))  # Destination already planned
+
+	def test_movefolder (self):
+		r = self.root
+		con = sampleDB ()
+		con.execute ("UPDATE PhotoTable SET filename = ? WHERE id = 1", (f'{r}/old/a.jpg',))
+		con.execute ("UPDATE VideoTable SET filename = ? WHERE id = 1", (f'{r}/old/b.mov',))
+		con.execute ("UPDATE PhotoTable SET filename = ? WHERE id = 2", (f'{r}/older/c.jpg',))
+		con.execute ("UPDATE BackingPhotoTable SET filepath = ? WHERE id = 1", (f'{r}/old/a_modified.jpg',))
+		foldertask = TM.eventfoldertask (self.tasks, 2, set ())
+		with open (f'{r}/old/new.jpg', 'w') as f:
+			f.write ('new file')
+		self.assertFalse (TM.movefolder (foldertask))
+		os.remove (f'{r}/old/new.jpg')
+		self.assertTrue (TM.movefolder (foldertask))
+		self.assertEqual (['a.jpg', 'a_modified.jpg', 'b.mov'], sorted (os.listdir (f'{r}/2020/new')))
+		self.assertFalse (os.path.exists (f'{r}/old'))
+		self.assertEqual (3, TM.renamefolderpointers (con, f'{r}/old', f'{r}/2020/new'))
+		self.assertEqual (f'{r}/2020/new/a.jpg', con.execute ("SELECT filename FROM PhotoTable WHERE id = 1").fetchone()[0])
+		self.assertEqual (f'{r}/older/c.jpg', con.execute ("SELECT filename FROM PhotoTable WHERE id = 2").fetchone()[0])
+		self.assertEqual (f'{r}/2020/new/a_modified.jpg', con.execute ("SELECT filepath FROM BackingPhotoTable WHERE id = 1").fetchone()[0])
+
+
+class eventdate_test (unittest.TestCase):
+	""" Returns the date of an event by a date policy."""
+	items = [(1, '', None, t, 0, 'PhotoTable', -1, 0, None, 0, None) for t in (100, 200, 200, 600, 0)]
+
+	def test_policies (self):
+		self.assertEqual (300, TM.eventdate ('average', 1, 300, self.items, dict()))
+		self.assertEqual (100, TM.eventdate ('min', 1, 300, self.items, dict()))
+		self.assertEqual (200, TM.eventdate ('median', 1, 300, self.items, dict()))
+		self.assertEqual (0, TM.eventdate ('min', 1, 0, self.items[-1:], dict()))
+
+	def test_first (self):
+		firstdates = dict ()
+		self.assertEqual (300, TM.eventdate ('first', 1, 300, self.items, firstdates))
+		self.assertEqual ({1: 300}, firstdates)
+		self.assertEqual (300, TM.eventdate ('first', 1, 350, self.items, firstdates))
+		self.assertEqual (150, TM.eventdate ('first', 1, 150, self.items[:2], firstdates))  # 300 is out of the event dates
+		self.assertEqual ({1: 150}, firstdates)
+
+
+class mostrecentcutoff_test (unittest.TestCase):
+	""" Returns the exposure time after which files go to the most recent folder, keeping the last one while it fits."""
+	def test_hysteresis (self):
+		con = sampleDB ()
+		con.execute ("UPDATE PhotoTable SET filesize = 100")
+		con.execute ("UPDATE VideoTable SET filesize = 100")
+		self.assertEqual (3000, TM.mostrecentcutoff (con, 250, 0))
+		con.execute ("INSERT INTO PhotoTable (id, filename, filesize, exposure_time, event_id) VALUES (7, '/lib/g.jpg', 100, 70000, 2)")
+		self.assertEqual (3000, TM.mostrecentcutoff (con, 330, 0))
+		self.assertEqual (3000, TM.mostrecentcutoff (con, 330, 0, 3000))  # 300 fit in 330
+		con.execute ("INSERT INTO PhotoTable (id, filename, filesize, exposure_time, event_id) VALUES (8, '/lib/h.jpg', 100, 80000, 2)")
+		self.assertEqual (50000, TM.mostrecentcutoff (con, 330, 0))
+		self.assertEqual (60000, TM.mostrecentcutoff (con, 330, 0, 3000))  # Evicted down to 297
+		self.assertEqual (0, TM.mostrecentcutoff (con, 10000, 0))
+		self.assertIsNone (TM.mostrecentcutoff (con, 250, 5))
+
+
+class mirror_test (unittest.TestCase):
+	""" Mirrors the most recent files sharing their data, and keeps the mirror updated with the changes only."""
+	def setUp (self):
+		TM.dummy, TM.dummymsg = False, ''
+		TM.dirindex, TM.nameallocator = None, None
+		self.tempdir = tempfile.TemporaryDirectory ()
+		r = self.root = self.tempdir.name
+		os.makedirs (f'{r}/lib')
+		for name in ('a.jpg', 'b.jpg', 'c.jpg'):
+			with open (f'{r}/lib/{name}', 'w') as f:
+				f.write (name)
+
+	def tearDown (self):
+		self.tempdir.cleanup ()
+
+	def test_mirrorfile (self):
+		r = self.root
+		self.assertIn (TM.mirrorfile (f'{r}/lib/a.jpg', f'{r}/a.jpg'), ('reflink', 'hardlink'))  # Same filesystem
+		with open (f'{r}/a.jpg') as f:
+			self.assertEqual ('a.jpg', f.read ())
+		self.assertTrue (TM.mirrorisfresh (f'{r}/a.jpg', f'{r}/lib/a.jpg'))
+
+	def test_syncmirror (self):
+		r = self.root
+		wanted = [(f'{r}/recent', f'{r}/lib/a.jpg', 1), (f'{r}/recent', f'{r}/lib/b.jpg', 2)]
+		mirror, emptied = TM.syncmirror (wanted, dict (), {1, 2})
+		self.assertEqual ({f'{r}/recent/a.jpg': (f'{r}/lib/a.jpg', 1), f'{r}/recent/b.jpg': (f'{r}/lib/b.jpg', 2)}, mirror)
+		# Event 2 is not processed and is kept, b.jpg leaves event 1 and c.jpg comes in.
+		mirror, emptied = TM.syncmirror ([(f'{r}/recent', f'{r}/lib/c.jpg', 1)], mirror, {1})
+		self.assertEqual ({f'{r}/recent/b.jpg': (f'{r}/lib/b.jpg', 2), f'{r}/recent/c.jpg': (f'{r}/lib/c.jpg', 1)}, mirror)
+		self.assertEqual ({f'{r}/recent'}, emptied)
+		self.assertEqual (['b.jpg', 'c.jpg'], sorted (os.listdir (f'{r}/recent')))
+		self.assertEqual ((mirror, set ()), TM.syncmirror ([(f'{r}/recent', f'{r}/lib/c.jpg', 1)], mirror, {1}))
+		# c.jpg is rewritten, as a metadata change does.
+		with open (f'{r}/lib/new.jpg', 'w') as f:
+			f.write ('c.jpg with a title')
+		os.replace (f'{r}/lib/new.jpg', f'{r}/lib/c.jpg')
+		self.assertFalse (TM.mirrorisfresh (f'{r}/recent/c.jpg', f'{r}/lib/c.jpg'))
+		self.assertEqual ((mirror, set ()), TM.syncmirror ([(f'{r}/recent', f'{r}/lib/c.jpg', 1)], mirror, {1}))
+		with open (f'{r}/recent/c.jpg') as f:
+			self.assertEqual ('c.jpg with a title', f.read ())
+
+
+	def test_mirror_off (self):
+		""" Names of removed mirrors are free for the files that come back to their folder."""
+		r = self.root
+		TM.nameallocator = TM.Nameallocator (TM.Dirindex ())
+		try:
+			mirror = TM.syncmirror ([(f'{r}/recent', f'{r}/lib/a.jpg', 1)], dict (), {1})[0]
+			self.assertEqual (f'{r}/recent/a(0).jpg', TM.nameallocator.allocate (f'{r}/recent/a.jpg'))
+			TM.syncmirror ([], mirror, {1})
+			self.assertEqual (f'{r}/recent/a.jpg', TM.nameallocator.allocate (f'{r}/recent/a.jpg'))
+		finally:
+			TM.nameallocator = None
+
+
+class crossdevicemove_test (unittest.TestCase):
+	""" Copies and hashes a file in one pass, and deletes the source only if the copy is verified."""
+	def setUp (self):
+		TM.fpcache = None
+		self.tempdir = tempfile.TemporaryDirectory ()
+		self.src = os.path.join (self.tempdir.name, 'src.jpg')
+		self.dest = os.path.join (self.tempdir.name, 'dest.jpg')
+		self.data = os.urandom (3 * 1024 * 1024 + 7)
+		with open (self.src, 'wb') as f:
+			f.write (self.data)
+
+	def tearDown (self):
+		self.tempdir.cleanup ()
+
+	def test_copyandhash (self):
+		self.assertEqual (hashlib.md5 (self.data).hexdigest(), TM.copyandhash (self.src, self.dest))
+		with open (self.dest, 'rb') as f:
+			self.assertEqual (self.data, f.read ())
+
+	def test_move (self):
+		TM.transferstats.clear ()
+		TM.crossdevicemove (self.src, self.dest, hashlib.md5 (self.data).hexdigest())
+		self.assertFalse (os.path.exists (self.src))
+		self.assertEqual (['dest.jpg'], os.listdir (self.tempdir.name))
+		self.assertEqual (len (self.data), TM.transferstats['bytes'])
+
+	def test_outdated_md5 (self):
+		TM.crossdevicemove (self.src, self.dest, 'outdated md5')
+		self.assertFalse (os.path.exists (self.src))
+		self.assertTrue (os.path.exists (self.dest))
+
+	def test_bad_copy (self):
+		md5hash = TM.md5hash
+		TM.md5hash = lambda filepath: 'a bad copy'
+		try:
+			self.assertRaises (OSError, TM.crossdevicemove, self.src, self.dest, None)
+		finally:
+			TM.md5hash = md5hash
+		self.assertTrue (os.path.exists (self.src))
+		self.assertFalse (os.path.exists (self.dest))
+
+	def test_short_writes (self):
+		fileio = open
+		class Shortwriter:
+			def __init__ (self, f):
+				self.f = f
+			def write (self, data):
+				return self.f.write (data[:1000])  # As a network mount could
+			def __getattr__ (self, name):
+				return getattr (self.f, name)
+			def __enter__ (self):
+				return self
+			def __exit__ (self, *args):
+				self.f.close ()
+		TM.open = lambda path, mode, **kwargs: Shortwriter (fileio (path, mode, **kwargs)) if 'x' in mode else fileio (path, mode, **kwargs)
+		try:
+			TM.crossdevicemove (self.src, self.dest, hashlib.md5 (self.data).hexdigest())
+		finally:
+			del TM.open
+		with open (self.dest, 'rb') as f:
+			self.assertEqual (self.data, f.read ())
+
+	def test_source_not_deleted (self):
+		remove = os.remove
+		def failingremove (path):
+			if path == self.src:
+				raise PermissionError (13, 'Permission denied', path)
+			remove (path)
+		os.remove = failingremove
+		try:
+			self.assertRaises (OSError, TM.crossdevicemove, self.src, self.dest, hashlib.md5 (self.data).hexdigest())
+		finally:
+			os.remove = remove
+		self.assertTrue (os.path.exists (self.src))
+		self.assertFalse (os.path.exists (self.dest))
+
+	def test_rename_errors (self):
+		TM.dummy, TM.dirindex, TM.nameallocator = False, None, None
+		rename = TM.renamenoreplace
+		def failingrename (src, dest):
+			raise PermissionError (13, 'Permission denied', src)
+		TM.renamenoreplace = failingrename
+		try:
+			self.assertRaises (PermissionError, TM.movefile, self.src, self.dest)
+			task = TM.Movetask (1, 'PhotoTable', self.src, self.dest, -1, None, 1)
+			self.assertEqual ([(task, None, None)], TM.movetasks ([(task, self.dest, None)]))
+		finally:
+			TM.renamenoreplace = rename
+		self.assertTrue (os.path.exists (self.src))
+		self.assertFalse (os.path.exists (self.dest))
+
+	def test_dest_taken (self):
+		with open (self.dest, 'wb') as f:
+			f.write (b'written meanwhile')
+		self.assertRaises (FileExistsError, TM.crossdevicemove, self.src, self.dest, None)
+		self.assertTrue (os.path.exists (self.src))
+		with open (self.dest, 'rb') as f:
+			self.assertEqual (b'written meanwhile', f.read ())
+
+	def test_dest_taken_after_allocation (self):
+		TM.dummy, TM.dirindex, TM.movejournal = False, None, None
+		TM.nameallocator = TM.Nameallocator (TM.Dirindex ())
+		journalpath = os.path.join (self.tempdir.name, 'journal')
+		try:
+			dest = TM.filedest (self.src, self.dest)
+			with open (self.dest, 'wb') as f:
+				f.write (b'written meanwhile')
+			TM.movejournal = TM.Movejournal (journalpath)
+			task = TM.Movetask (1, 'PhotoTable', self.src, self.dest, -1, None, 1)
+			self.assertEqual ([(task, self.dest[:-4] + '(0).jpg', None)], TM.movetasks ([(task, dest, None)]))
+			TM.movejournal.file.close ()
+			with open (journalpath, 'rb') as f:
+				self.assertEqual ([('PhotoTable', 1, self.src, self.dest[:-4] + '(0).jpg')], list (TM.readrecords (f, journalpath)))
+		finally:
+			TM.nameallocator, TM.movejournal = None, None
+		with open (self.dest, 'rb') as f:
+			self.assertEqual (b'written meanwhile', f.read ())
+		self.assertFalse (os.path.exists (self.src))
+
+	def test_renamenoreplace (self):
+		libc = TM.libc
+		for fallback in (False, True):
+			if fallback:
+				TM.libc = None  # No renameat2()
+			try:
+				with open (self.dest, 'wb') as f:
+					f.write (b'dest')
+				self.assertRaises (FileExistsError, TM.renamenoreplace, self.src, self.dest)
+				os.makedirs (self.src + '.d')
+				os.makedirs (self.dest + '.d')
+				self.assertRaises (FileExistsError, TM.renamenoreplace, self.src + '.d', self.dest + '.d')
+				os.remove (self.dest)
+				os.rmdir (self.src + '.d')
+				os.rmdir (self.dest + '.d')
+				TM.renamenoreplace (self.src, self.dest)
+				self.assertFalse (os.path.exists (self.src))
+				os.rename (self.dest, self.src)
+			finally:
+				TM.libc = libc
+		with open (self.src, 'rb') as f:
+			self.assertEqual (self.data, f.read ())
+
+
+class devices_test (unittest.TestCase):
+	""" Finds if devices are rotational, and runs work in queues by device."""
+	def test_devicerotational (self):
+		self.assertIn (TM.devicerotational (os.stat ('/').st_dev), (True, False))
+		self.assertFalse (TM.devicerotational (os.makedev (0, 999)))  # Not a block device
+
+	def test_pathdevice (self):
+		self.assertEqual (os.stat ('/tmp').st_dev, TM.pathdevice ('/tmp/not/existent/folder'))
+
+	def test_executors (self):
+		executors = TM.Deviceexecutors (2)
+		TM.rotationalcache[-1] = True
+		try:
+			self.assertEqual (-1, executors.rotational ((None, -1)))
+			jobs = [executors.submit ((None, -1), pow, 2, n) for n in range (3)] + [executors.submit ((None,), pow, 3, 2)]
+			self.assertEqual ([1, 2, 4, 9], [job.result () for job in jobs])
+			self.assertEqual (1, executors.executors[-1]._max_workers)
+			self.assertEqual (2, executors.executors[(None,)]._max_workers)
+			# Jobs at all pools share the limit of workers.
+			running, peak, lock = [0], [0], TM.threading.Lock ()
+			def job ():
+				with lock:
+					running[0] += 1
+					peak[0] = max (peak[0], running[0])
+				TM.time.sleep (0.05)
+				with lock:
+					running[0] -= 1
+			jobs = [executors.submit ((None, n % 3), job) for n in range (9)]
+			for j in jobs:
+				j.result ()
+			self.assertEqual (2, peak[0])
+		finally:
+			executors.shutdown ()
+			del TM.rotationalcache[-1]
+
+
+class conversionqueue_test (unittest.TestCase):
+	""" Runs conversions in parallel, and stops them on request."""
+	class Shellqueue (Shotwell_event2folder.Conversionqueue):
+		def command (self, job):
+			return ['sh', '-c', ': > "$0"; ' + job.src, job.dest]  # The new file is written before the script runs
+
+	def setUp (self):
+		TM.dummy, TM.dummymsg = False, ''
+		self.tempdir = tempfile.TemporaryDirectory ()
+
+	def tearDown (self):
+		self.tempdir.cleanup ()
+
+	def job (self, n:int, script:str, strategy:str='encode'):
+		return TM.Conversionjob (n, script, os.path.join (self.tempdir.name, f'{n}_c.mov'), None, strategy)
+
+	def test_command (self):
+		job = TM.Conversionjob (None, '/a b/MVI.MOV', '/a b/MVI_c.mov', '2018-01-03T18:25:34.000000Z')
+		queue = TM.Conversionqueue (1, 2, 0)
+		self.assertEqual (['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error', '-i', '/a b/MVI.MOV', '-threads', '2',
+			'-metadata', 'creation_time=2018-01-03T18:25:34.000000Z', '-f', 'mov', '/a b/MVI_c.mov'], queue.command (job))
+		queue = TM.Conversionqueue (1, 0, 10)
+		self.assertEqual (['nice', '-n', '10'], queue.command (job._replace (creationtime=None))[:3])
+		self.assertEqual (['-i', '/a b/MVI.MOV', '-f', 'mov', '/a b/MVI_c.mov'], queue.command (job._replace (creationtime=None))[-5:])
+
+	def test_remux_command (self):
+		job = TM.Conversionjob (None, 'MVI.MOV', 'MVI_c.mov', None, 'remux')
+		self.assertEqual (['-i', 'MVI.MOV', '-c', 'copy', '-map_metadata', '0', '-f', 'mov', 'MVI_c.mov'], TM.Conversionqueue (1, 2, 0).command (job)[-9:])
+
+	def test_conversionstrategy (self):
+		for probe, strategy in (
+			({'codec': 'h264', 'bitrate': 5000, 'duration': 10.0}, 'remux'),
+			({'codec': 'hevc', 'bitrate': 5000, 'duration': 10.0}, 'remux'),
+			({'codec': 'h264', 'bitrate': 9000, 'duration': 10.0}, 'encode'),
+			({'codec': 'mjpeg', 'bitrate': 5000, 'duration': 10.0}, 'encode'),
+			({'codec': 'h264', 'bitrate': None, 'duration': None}, 'encode'),
+			(None, 'encode'),
+			):
+			self.assertEqual (strategy, TM.conversionstrategy (probe, 8000))
+
+	def test_conversionbitrate (self):
+		probe = {'codec': 'h264', 'bitrate': 8000, 'duration': 10.0, 'size': 10000000, 'width': 1000, 'height': 1000, 'rotation': 90}
+		self.assertEqual (1000, TM.conversionbitrate (probe, 0, 0, 0, 0))
+		self.assertEqual (500, TM.conversionbitrate (None, 10000000, 20.0, 1000, 1000))
+		self.assertEqual (500, TM.conversionbitrate (dict (probe, duration=None), 10000000, 20.0, 1000, 1000))
+		self.assertEqual (None, TM.conversionbitrate (None, 10000000, 0, 1000, 1000))
+
+	def test_conversionpriority (self):
+		# 10 MB, 10 seconds of 1000x1000 pixels, at 1000 bytes/s per 1000 pixels: 10 MB to 2.5 MB at a target of 250.
+		self.assertEqual (750000, TM.conversionpriority (None, 10000000, 10.0, 1000, 1000, 250))
+		self.assertEqual (0, TM.conversionpriority (None, 10000000, 10.0, 1000, 1000, 2000))
+		self.assertEqual (0, TM.conversionpriority (None, 10000000, 0, 1000, 1000, 250))
+		# Same bitrate, same priority, whatever the length of the video.
+		self.assertEqual (750000, TM.conversionpriority ({'size': 20000000, 'duration': 20.0, 'width': None, 'height': None}, 0, 0, 1000, 1000, 250))
+
+	def test_deadline (self):
+		queue = self.Shellqueue (1, 0, 0)
+		for n in range (3):
+			queue.add (self.job (n, 'sleep 1'))
+		results = [(job.entry, exitcode) for job, exitcode in queue.results (lambda: False, TM.time.monotonic () + 0.5)]
+		queue.close ()
+		self.assertEqual ([(0, 0), (1, None), (2, None)], sorted (results))
+
+	def test_requeue (self):
+		queue = self.Shellqueue (2, 0, 0)
+		queue.add (self.job (0, 'exit 1', 'remux'))
+		results = []
+		for job, exitcode in queue.results (lambda: False):
+			results.append ((job.strategy, exitcode))
+			if job.strategy == 'remux':
+				queue.add (job._replace (src='exit 0', strategy='encode'))
+		queue.close ()
+		self.assertEqual ([('remux', 1), ('encode', 0)], results)
+
+	def test_results (self):
+		queue = self.Shellqueue (2, 0, 0)
+		for n, script in enumerate (('exit 0', 'exit 1', 'exit 0')):
+			queue.add (self.job (n, script))
+		self.assertEqual ([(0, 0), (1, 1), (2, 0)], sorted ((job.entry, exitcode) for job, exitcode in queue.results (lambda: False)))
+		queue.close ()
+		self.assertEqual (['0_c.mov', '2_c.mov'], sorted (os.listdir (self.tempdir.name)))
+
+	def test_stop (self):
+		queue = self.Shellqueue (1, 0, 0)
+		for n in range (3):
+			queue.add (self.job (n, 'exec sleep 30'))
+		start = datetime.datetime.now ()
+		self.assertEqual ([None, None, None], [exitcode for job, exitcode in queue.results (lambda: True)])
+		queue.close ()
+		self.assertLess ((datetime.datetime.now () - start).total_seconds (), 20)
+
+	def test_stop_keeps_finished (self):
+		""" Jobs finished when Shotwell starts are not yielded as done, their new file is kept for next pass."""
+		queue = self.Shellqueue (2, 0, 0)
+		queue.add (self.job (0, 'exit 0'))
+		queue.add (self.job (1, 'exec sleep 30'))
+		TM.time.sleep (0.5)
+		self.assertEqual ([(0, None), (1, None)], sorted ((job.entry, exitcode) for job, exitcode in queue.results (lambda: True)))
+		queue.close ()
+		self.assertEqual (['0_c.mov'], os.listdir (self.tempdir.name))
+
+	def test_converted (self):
+		queue = self.Shellqueue (1, 0, 0)
+		queue.add (self.job (0, 'exit 1'), converted=True)
+		self.assertEqual ([0], [exitcode for job, exitcode in queue.results (lambda: False)])
+		queue.close ()
+
+	def test_convertedisvalid (self):
+		probevideo = TM.probevideo
+		TM.probevideo = lambda filepath: None if filepath == 'broken' else {'duration': 60.4}
+		try:
+			self.assertTrue (TM.convertedisvalid ('MVI_c.mov', 60.0))
+			self.assertFalse (TM.convertedisvalid ('MVI_c.mov', 120.0))  # Cut short
+			self.assertFalse (TM.convertedisvalid ('MVI_c.mov', None))
+			self.assertFalse (TM.convertedisvalid ('broken', 60.0))
+		finally:
+			TM.probevideo = probevideo
+
+	def test_job_errors (self):
+		class Failingqueue (self.Shellqueue):
+			def command (self, job):
+				raise OSError ('No such file or directory')
+		queue = Failingqueue (1, 0, 0)
+		queue.add (self.job (0, 'exit 0'))
+		self.assertEqual ([None], [exitcode for job, exitcode in queue.results (lambda: False)])
+		queue.close ()
+
+	def test_segmentstrategy (self):
+		probe = {'codec': 'mjpeg', 'bitrate': 30000, 'duration': 7200.0}
+		self.assertEqual ('segmented', TM.conversionstrategy (probe, 8000, 600))
+		self.assertEqual ('encode', TM.conversionstrategy (probe, 8000, 0))
+		self.assertEqual ('encode', TM.conversionstrategy (dict (probe, duration=1000.0), 8000, 600))
+		self.assertEqual ('remux', TM.conversionstrategy (dict (probe, codec='h264', bitrate=5000), 8000, 600))
+
+
+class segmentedconversion_test (unittest.TestCase):
+	""" Splits a video, encodes its segments in parallel and joins them, resuming from segments already encoded."""
+	fakeffmpeg = '''import sys, os, shutil
+args = sys.argv[1:]
+source = args[args.index ('-i') + 1]
+with open (os.environ['FAKEFFMPEG_LOG'], 'a') as log:
+	for n, arg in enumerate (args[:-1]):
+		if arg == '-i':
+			log.write (os.path.basename (args[n+1]) + '\\n')
+if 'concat' not in args and '-map' not in args and '-an' not in args:
+	sys.exit (2)
+if 'segment' in args:
+	data = open (source, 'rb').read ()
+	for n in range (3):
+		open (args[-1] % n, 'wb').write (data[n*4:(n+1)*4])
+elif 'concat' in args:
+	with open (args[-1], 'wb') as f:
+		for line in open (source):
+			f.write (open (line.strip ()[6:-1], 'rb').read ())
+elif os.path.exists (source + '.fail'):
+	sys.exit (1)
+else:
+	shutil.copyfile (source, args[-1])
+'''
+	class Fakequeue (Shotwell_event2folder.Conversionqueue):
+		def ffmpeg (self):
+			return [TM.sys.executable, os.environ['FAKEFFMPEG']]
+
+	def setUp (self):
+		TM.dummy, TM.dummymsg = False, ''
+		self.tempdir = tempfile.TemporaryDirectory ()
+		self.segments = os.path.join (self.tempdir.name, 'segments')
+		self.src = os.path.join (self.tempdir.name, 'MVI.MOV')
+		self.dest = os.path.join (self.tempdir.name, 'MVI_c.mov')
+		with open (self.src, 'wb') as f:
+			f.write (b'aaaabbbbcccc')
+		os.environ['FAKEFFMPEG'] = os.path.join (self.tempdir.name, 'ffmpeg.py')
+		os.environ['FAKEFFMPEG_LOG'] = os.path.join (self.tempdir.name, 'ffmpeg.log')
+		with open (os.environ['FAKEFFMPEG'], 'w') as f:
+			f.write (self.fakeffmpeg)
+
+	def tearDown (self):
+		self.tempdir.cleanup ()
+
+	def convert (self)->int:
+		queue = self.Fakequeue (2, 0, 0, 600, self.segments)
+		queue.add (TM.Conversionjob (None, self.src, self.dest, None, 'segmented'))
+		exitcode = [exitcode for job, exitcode in queue.results (lambda: False)][0]
+		queue.close ()
+		with open (os.environ['FAKEFFMPEG_LOG']) as f:
+			calls = sorted (f.read ().split ())
+		os.remove (os.environ['FAKEFFMPEG_LOG'])
+		return exitcode, calls
+
+	def test_resume (self):
+		queue = self.Fakequeue (2, 0, 0, 600, self.segments)
+		folder = queue.segmentfolder (self.src)
+		os.makedirs (os.path.join (folder, 'encoded'))
+		with open (os.path.join (folder, 'encoded', '00000.mov'), 'wb') as f:
+			f.write (b'AAAA')  # Encoded by a former run
+		exitcode, calls = self.convert ()
+		self.assertEqual (0, exitcode)
+		self.assertEqual (['00001.mkv', '00002.mkv', 'MVI.MOV', 'MVI.MOV', 'segments.txt'], calls)
+		with open (self.dest, 'rb') as f:
+			self.assertEqual (b'AAAAbbbbcccc', f.read ())
+		self.assertEqual ([], os.listdir (self.segments))
+
+	def test_failed_segment (self):
+		queue = self.Fakequeue (2, 0, 0, 600, self.segments)
+		folder = queue.segmentfolder (self.src)
+		os.makedirs (os.path.join (folder, 'split'))
+		for n in range (3):
+			with open (os.path.join (folder, 'split', f'0000{n}.mkv'), 'wb') as f:
+				f.write (b'data')
+		open (os.path.join (folder, 'split', '00001.mkv.fail'), 'w').close ()
+		exitcode, calls = self.convert ()
+		self.assertEqual (1, exitcode)
+		self.assertEqual (['00000.mkv', '00001.mkv', '00002.mkv'], calls)
+		self.assertFalse (os.path.exists (self.dest))
+		self.assertEqual ([], os.listdir (self.segments))
+
+	def test_segment_errors (self):
+		class Failingqueue (self.Fakequeue):
+			def encodesegment (self, src, dest):
+				raise OSError ('No space left on device')
+		queue = Failingqueue (2, 0, 0, 600, self.segments)
+		queue.add (TM.Conversionjob (None, self.src, self.dest, None, 'segmented'))
+		self.assertEqual ([None], [exitcode for job, exitcode in queue.results (lambda: False)])
+		queue.close ()
+		self.assertFalse (os.path.exists (self.dest))
+
+	def test_cleansegments (self):
+		queue = self.Fakequeue (1, 0, 0, 600, self.segments)
+		os.makedirs (os.path.join (self.segments, 'stale'))
+		os.makedirs (queue.segmentfolder (self.src))
+		queue.futures[None] = TM.Conversionjob (None, self.src, self.dest, None, 'segmented')
+		queue.cleansegments ()
+		self.assertEqual ([os.path.basename (queue.segmentfolder (self.src))], os.listdir (self.segments))
+		queue.close ()
+
+
 if __name__ == '__main__':
 	unittest.main()
 
@@ -6,8 +6,12 @@ __author__ = "pablo33"
 __version__ = "1.3.1"
 
 
-import sqlite3, os, sys, shutil, logging, re, time, pickle
+import sqlite3, os, sys, shutil, logging, re, time, pickle, threading, select, struct, ctypes, ctypes.util, fcntl, subprocess, json, errno, tempfile
 from hashlib import md5
+from concurrent.futures import ThreadPoolExecutor, Future, wait, FIRST_COMPLETED
+from bisect import bisect_left, bisect_right
+from collections import Counter, namedtuple
+from itertools import chain, islice
 
 from datetime import datetime
 import gi  # in use to avoid Gi warning
@@ -38,6 +42,15 @@ DBpath = os.path.join(UserHomePath,".local/share/shotwell/data/photo.db")  # Pat
 Th128path = os.path.join(UserHomePath,".cache/shotwell/thumbs/thumbs128")  # Path where thumbnails are stored.
 Th360path = os.path.join(UserHomePath,".cache/shotwell/thumbs/thumbs360")  # Path where thumbnails are stored.
 LastExec = None
+Hashchunksize = 1024*1024  # Bytes read at a time when hashing files.
+Hashworkers = min (4, os.cpu_count() or 1)  # Number of files hashed at the same time.
+fpcache = None  # Fingerprint cache, it is opened at main program if enabled.
+dirindex = None  # Directory index, it is created on each pass if enabled.
+nameallocator = None  # Allocator of collision-free filenames, it is created on each pass.
+movejournal = None  # Journal of the file moves not committed to DB yet.
+Journalbatch = 256  # Moves written to the journal at once, with a single fsync.
+Daemondebounce = 5  # Seconds without DB changes before a daemon pass is started.
+Daemonmaxwait = 3600  # Max seconds the daemon waits for DB changes, before it checks the DB anyway.
 
 # -------- Global Vars ----------
 mintepoch = '1800'  # In order to discard low year values, this is the lowest year. // fetched later by user configuration.
@@ -74,6 +87,137 @@ def itemcheck (pointer:str)->str:
 		return 'link'
 	return ""
 
+class Dirindex:
+	""" In-memory snapshot of directory contents, to answer itemcheck() without syscalls.
+
+	Each directory is read once with os.scandir, the first time one of its entries is checked.
+	Whoever creates, moves or deletes files must keep the index coherent with add() and remove().
+	Directories are read out of the lock, so threads don't wait for each other's reads. Changes
+	recorded meanwhile a directory is read are applied to the read entries before they are published.
+		"""
+	def __init__ (self):
+		self.dirs = dict ()  # directory path : {entry name : kind}
+		self.removals = Counter ()  # directory path : number of entries removed
+		self.loading = dict ()  # directory path : [changes seen by each read in progress]
+		self.lock = threading.RLock ()
+
+	def entries (self, dirpath:str)->dict:
+		""" Returns a dictionary {name: kind} of a directory, or None if it can't be read.
+		A not existent directory has no entries."""
+		with self.lock:
+			if dirpath in self.dirs:
+				return self.dirs[dirpath]
+			changes = []  # (name, kind), kind is None for removed entries, name is None if the directory was removed
+			self.loading.setdefault (dirpath, []).append (changes)
+		entries = dict ()
+		try:
+			with os.scandir (dirpath) as scan:
+				for entry in scan:
+					if entry.is_file ():
+						entries[entry.name] = 'file'
+					elif entry.is_dir ():
+						entries[entry.name] = 'folder'
+					elif entry.is_symlink ():
+						entries[entry.name] = 'link'
+					else:
+						entries[entry.name] = ''
+		except (FileNotFoundError, NotADirectoryError):
+			pass
+		except OSError:
+			entries = None
+		with self.lock:
+			self.loading[dirpath].remove (changes)
+			if len (self.loading[dirpath]) == 0:
+				del self.loading[dirpath]
+			if dirpath in self.dirs:
+				return self.dirs[dirpath]  # Published by another thread meanwhile
+			if entries is None:
+				return None
+			for name, kind in changes:
+				if name is None:
+					return entries  # The directory was removed meanwhile, it is not published
+				if kind is None:
+					entries.pop (name, None)
+				else:
+					entries[name] = kind
+			self.dirs[dirpath] = entries
+			return entries
+
+	def kind (self, pointer:str)->str:
+		""" Returns what kind of a pointer is, same as itemcheck()."""
+		if type (pointer) is not str:
+			raise NotStringError ('Bad input, it must be a string')
+		if pointer.find ("//") != -1 :
+			raise MalformedPathError ('Malformed Path, it has double slashes')
+		dirpath, name = os.path.split (pointer)
+		if dirpath == '' or name == '':
+			return itemcheck (pointer)
+		entries = self.entries (dirpath)
+		if entries is None:
+			return itemcheck (pointer)
+		return entries.get (name, '')
+
+	def add (self, pointer:str, kind:str):
+		""" Records a new entry, if its directory has been read."""
+		dirpath, name = os.path.split (pointer)
+		with self.lock:
+			if dirpath in self.dirs:
+				self.dirs[dirpath][name] = kind
+			for changes in self.loading.get (dirpath, ()):
+				changes.append ((name, kind))
+
+	def remove (self, pointer:str):
+		""" Forgets an entry, if its directory has been read. Contents of a removed directory are forgotten too."""
+		dirpath, name = os.path.split (pointer)
+		with self.lock:
+			if dirpath in self.dirs:
+				self.dirs[dirpath].pop (name, None)
+				self.removals[dirpath] += 1
+			for changes in self.loading.get (dirpath, ()):
+				changes.append ((name, None))
+			for loaded in [d for d in self.dirs if d == pointer or d.startswith (pointer + '/')]:
+				del self.dirs[loaded]
+			for loading in [d for d in self.loading if d == pointer or d.startswith (pointer + '/')]:
+				for changes in self.loading[loading]:
+					changes.append ((None, None))
+
+class Nameallocator:
+	""" Allocates collision-free filenames, the same ones a Nextfilenumber probe loop would give.
+
+	Names are checked against a Dirindex, so each directory is read once. The last name given
+	for each requested path is remembered, and the next request for that path goes on from it
+	instead of probing all counters again, unless an entry has been removed from the directory since.
+		"""
+	def __init__ (self, index:Dirindex):
+		self.index = index
+		self.lastgiven = dict ()  # requested path : (last allocated path, removals at directory)
+		self.lock = threading.Lock ()
+
+	def allocate (self, dest:str)->str:
+		""" Returns dest if it is free, or the first free Nextfilenumber name of it."""
+		dirpath = os.path.dirname (dest)
+		entries = self.index.entries (dirpath)
+		if entries is None:
+			while itemcheck (dest) != "":
+				dest = Nextfilenumber (dest)
+			return dest
+		with self.lock:
+			if os.path.basename (dest) not in entries:
+				return dest
+			candidate, removals = self.lastgiven.get (dest, (dest, None))
+			if removals != self.index.removals[dirpath]:
+				candidate = dest
+			while os.path.basename (candidate) in entries:
+				candidate = Nextfilenumber (candidate)
+			self.lastgiven[dest] = (candidate, self.index.removals[dirpath])
+			return candidate
+
+def pathkind (pointer:str)->str:
+	""" Returns what kind of a pointer is, from the directory index if it is enabled."""
+	if dirindex is None:
+		return itemcheck (pointer)
+	return dirindex.kind (pointer)
+
 def Nextfilenumber (dest:str)->str:
 	""" Returns the next filename counter as filename(nnn).ext.
 
@@ -185,24 +329,405 @@ def extracttitle (photofilename:str)->str:
 	logging.debug ("The title for this entry will be: " + str(title))
 	return title
 
+def filedest (origin:str, dest:str)->str:
+	""" Returns the name a file will have when it is moved to a destination, or None if the file does not exist.
+
+	It implements Nextfilenaumber function to avoid overwriting files. The name is reserved
+	at the name allocator index, so it is not given again before the file is moved.
+		"""
+	if pathkind (origin) != 'file':
+		return None
+	if nameallocator is None:
+		if pathkind (dest) != "" :
+			while pathkind (dest) != "" :
+				dest = Nextfilenumber (dest)
+			logging.debug ("File already exists at destination, assigning a new name. >> " + dest)
+		return dest
+	allocated = nameallocator.allocate (dest)
+	if allocated != dest:
+		logging.debug ("File already exists at destination, assigning a new name. >> " + allocated)
+	if dummy == False:
+		nameallocator.index.add (allocated, 'file')
+	return allocated
+
+def makefolder (destdir:str):
+	""" Creates a folder and its parents if they do not exist, keeping the directory index coherent."""
+	if pathkind (destdir) == '':
+		index = dirindex if nameallocator is None else nameallocator.index
+		os.makedirs (destdir, exist_ok=True)
+		if index is not None:
+			while destdir != '/' and index.kind (destdir) != 'folder':
+				index.add (destdir, 'folder')
+				destdir = os.path.dirname (destdir)
+
+libc = ctypes.CDLL (ctypes.util.find_library ('c'), use_errno=True)
+Renamenoreplace = 1  # RENAME_NOREPLACE flag of renameat2()
+
+def renamenoreplace (src:str, dest:str):
+	""" Renames a file or folder, it raises FileExistsError instead of replacing an existing dest.
+
+	It uses renameat2(RENAME_NOREPLACE). At filesystems that don't support it, files are hard
+	linked to dest and unlinked from src, and folders are renamed if dest does not exist.
+		"""
+	if hasattr (libc, 'renameat2'):
+		if libc.renameat2 (-100, os.fsencode (src), -100, os.fsencode (dest), Renamenoreplace) == 0:  # -100: AT_FDCWD
+			return
+		error = ctypes.get_errno ()
+		if error not in (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP):
+			raise OSError (error, os.strerror (error), src, None, dest)
+	if os.path.isdir (src):
+		if os.path.lexists (dest):
+			raise FileExistsError (errno.EEXIST, os.strerror (errno.EEXIST), dest)
+		os.rename (src, dest)
+		return
+	try:
+		os.link (src, dest)
+	except OSError as error:
+		if error.errno not in (errno.EPERM, errno.EOPNOTSUPP, errno.EMLINK):
+			raise
+		if os.path.lexists (dest):  # No hard links at this filesystem
+			raise FileExistsError (errno.EEXIST, os.strerror (errno.EEXIST), dest)
+		os.rename (src, dest)
+		return
+	os.unlink (src)
+
+def movefile (origin:str, dest:str, filemd5:str=None, record:tuple=None)->str:
+	""" Moves a file to a destination name given by filedest(), creating its folder if needed.
+
+	An existing file is never replaced: if dest has been taken since its name was given, the file
+	is moved to a new name. record is (table, id) of the file at the move journal, new names are
+	written to the journal before the file is moved.
+	If it cannot be renamed as it is on another device, it is copied and verified with
+	crossdevicemove(). filemd5 is the md5 of the file at DB, if it is known.
+	Returns the destination, it raises OSError if the file can't be moved, the file is left at its origin then.
+		"""
+	if dummy == False:
+		index = dirindex if nameallocator is None else nameallocator.index
+		makefolder (os.path.dirname(dest))
+		while True:
+			try:
+				try:
+					renamenoreplace (origin, dest)
+				except OSError as error:
+					if error.errno != errno.EXDEV:
+						raise
+					crossdevicemove (origin, dest, filemd5)
+				break
+			except FileExistsError:
+				if index is not None:
+					index.add (dest, itemcheck (dest))
+				newdest = filedest (origin, dest)
+				if newdest is None:
+					raise FileNotFoundError (errno.ENOENT, os.strerror (errno.ENOENT), origin)
+				logging.warning (f'\t{dest} has been taken meanwhile, moving the file to {newdest}')
+				if record is not None and movejournal is not None:
+					movejournal.append ([(*record, origin, newdest)])
+				dest = newdest
+		if index is not None:
+			index.remove (origin)
+			index.add (dest, 'file')
+	logging.debug (f"\tfile has been moved. {dummymsg}")
+	return dest
+
 def filemove (origin:str, dest:str)->str:
 	""" Moves a file from source to a destination.
 
 	It implements Nextfilenaumber function to avoid overwriting files.
+	Returns the final destination, or None if the file does not exist.
 	"""
-	if itemcheck (origin) != 'file':
+	dest = filedest (origin, dest)
+	if dest is not None:
+		dest = movefile (origin, dest)
+	return dest
+
+Movetask = namedtuple ('Movetask', 'id table src dest editable_id editable_src eventid md5', defaults=(None, None))  # A file to move, and its editable file if editable_id is not -1.
+
+rotationalcache = dict ()  # device : True if it is rotational
+
+def devicerotational (device:int)->bool:
+	""" Tells if a block device is rotational (a hard disk), as the kernel reports at /sys/dev/block.
+
+	Partitions are looked up at their disk. Devices that are not found there, as network or
+	virtual filesystems, are taken as not rotational.
+		"""
+	if device not in rotationalcache:
+		rotational = False
+		try:
+			sysdir = os.path.realpath (f'/sys/dev/block/{os.major (device)}:{os.minor (device)}')
+			if os.path.exists (os.path.join (sysdir, 'partition')):
+				sysdir = os.path.dirname (sysdir)
+			with open (os.path.join (sysdir, 'queue', 'rotational')) as f:
+				rotational = f.read().strip() == '1'
+		except OSError:
+			pass
+		rotationalcache[device] = rotational
+	return rotationalcache[device]
+
+def pathdevice (path:str)->int:
+	""" Returns the device of a path, or of its nearest existing parent folder. None if it is not found."""
+	while True:
+		try:
+			return os.stat (path).st_dev
+		except OSError:
+			parent = os.path.dirname (path)
+			if parent == path:
+				return None
+			path = parent
+
+class Deviceexecutors:
+	""" Thread pools by device, so work on a slow device never waits for work on other devices.
+
+	Work is submitted with the devices it reads from or writes to. If one of them is rotational, the work
+	goes to a single worker of that device, as concurrent reads make hard disks seek. Otherwise it goes
+	to a pool of workers for that set of devices. No more than workers jobs run at once, whatever
+	the number of pools.
+		"""
+	def __init__ (self, workers:int):
+		self.workers = workers
+		self.executors = dict ()  # device or devices : ThreadPoolExecutor
+		self.lock = threading.Lock ()
+		self.slots = threading.BoundedSemaphore (workers)  # Jobs running at all pools
+
+	def run (self, fn, *args):
+		""" Runs a job when there is a free slot."""
+		with self.slots:
+			return fn (*args)
+
+	def rotational (self, devices:tuple)->int:
+		""" Returns the first rotational device, or None."""
+		for device in devices:
+			if device is not None and devicerotational (device):
+				return device
 		return None
-	while itemcheck (dest) != "" :
-		infomsg = "File already exists at destination, assigning a new name."
-		dest = Nextfilenumber (dest)
-		logging.debug (infomsg + " >> " + dest)
 
+	def submit (self, devices:tuple, fn, *args):
+		""" Submits fn(*args) to the executor of the devices, returns its Future."""
+		key = self.rotational (devices)
+		with self.lock:
+			if key is None:
+				key = devices
+				if key not in self.executors:
+					self.executors[key] = ThreadPoolExecutor (max_workers=self.workers)
+			elif key not in self.executors:
+				self.executors[key] = ThreadPoolExecutor (max_workers=1)
+			executor = self.executors[key]
+		return executor.submit (self.run, fn, *args)
+
+	def shutdown (self):
+		for executor in self.executors.values():
+			executor.shutdown ()
+
+def allocatetasks (tasks:list)->list:
+	""" Gives destination names to the files of a list of Movetasks, in order.
+
+	Editable files are moved besides their file, as filename_modified.ext.
+	Names are given before any of the files is moved, so names of files planned to move away
+	are still taken, and collision names can differ from moving the files one at a time.
+	Returns a list of (task, dest, editable_dest). dest is None if the file could not be moved,
+	editable_dest is None if there is no editable file to move or it could not be moved.
+		"""
+	results = []
+	for task in tasks:
+		dest = filedest (task.src, task.dest)
+		editable_dest = None
+		if dest is not None and task.editable_id != -1:
+			editable_dest = os.path.splitext(dest)[0] + '_modified' + os.path.splitext(dest)[1]
+			if task.editable_src == editable_dest:
+				logging.debug ("Editable file is already on its destination. This file remains on its place.")
+				editable_dest = None
+			else:
+				editable_dest = filedest (task.editable_src, editable_dest)
+				if editable_dest is None:
+					logging.warning (f"Cannot find editable file id({task.editable_id}): {task.editable_src}")
+		results.append ((task, dest, editable_dest))
+	return results
+
+def journaltasks (results:list):
+	""" Writes the moves given by allocatetasks() to the move journal, in batches of Journalbatch."""
+	if movejournal is None:
+		return
+	records = []
+	for task, dest, editable_dest in results:
+		if dest is not None:
+			records.append ((task.table, task.id, task.src, dest))
+		if editable_dest is not None:
+			records.append (('BackingPhotoTable', task.editable_id, task.editable_src, editable_dest))
+	for start in range (0, len (records), Journalbatch):
+		movejournal.append (records[start:start + Journalbatch])
+
+def movetasks (results:list)->list:
+	""" Moves the files with the names given by allocatetasks(), one after another.
+
+	Returns the results, with dest or editable_dest set to None for the files that could not be moved.
+		"""
+	moved = []
+	for task, dest, editable_dest in results:
+		if dest is not None:
+			try:
+				dest = movefile (task.src, dest, task.md5, (task.table, task.id))
+			except OSError as error:
+				logging.warning (f'File id({task.id}) cannot be moved to {dest}: {error}')
+				dest, editable_dest = None, None
+		if editable_dest is not None:
+			try:
+				editable_dest = movefile (task.editable_src, editable_dest, record=('BackingPhotoTable', task.editable_id))
+			except OSError as error:
+				logging.warning (f'Editable file id({task.editable_id}) cannot be moved to {editable_dest}: {error}')
+				editable_dest = None
+		moved.append ((task, dest, editable_dest))
+	return moved
+
+def runmovetasks (tasks:list)->list:
+	""" Moves the files of a list of Movetasks, one after another.
+
+	Tasks are run in batches of Journalbatch: destination names are given to the whole batch,
+	the batch is written to the move journal, and then its files are moved.
+	Returns the results of movetasks().
+		"""
+	batchsize = 1 if nameallocator is None else Journalbatch  # Names can only be reserved at the allocator.
+	results = []
+	for start in range (0, len (tasks), batchsize):
+		batch = allocatetasks (tasks[start:start + batchsize])
+		journaltasks (batch)
+		results.extend (movetasks (batch))
+	return results
+
+Foldertask = namedtuple ('Foldertask', 'src dest tasks')  # A folder renamed at once, with the Movetasks of all its files.
+
+def eventfoldertask (tasks:list, itemcount:int, reserved:set)->Foldertask:
+	""" Returns a Foldertask if all files of an event can be moved by renaming their folder, else None.
+
+	All items of the event must be moved, from one folder to one new folder, keeping their names.
+	The folder must contain only these files and their editable files, and the new folder must not exist.
+	reserved is a set of folders already planned as destinations, the new folder is added to it.
+		"""
+	if len (tasks) == 0 or len (tasks) != itemcount:
+		return None
+	src, dest = os.path.dirname (tasks[0].src), os.path.dirname (tasks[0].dest)
+	names = set ()
+	for task in tasks:
+		if os.path.dirname (task.src) != src or os.path.dirname (task.dest) != dest or os.path.basename (task.src) != os.path.basename (task.dest):
+			return None
+		names.add (os.path.basename (task.src))
+		if task.editable_id != -1:
+			editable_dest = os.path.splitext(task.dest)[0] + '_modified' + os.path.splitext(task.dest)[1]
+			if os.path.dirname (task.editable_src) != src or os.path.basename (task.editable_src) != os.path.basename (editable_dest):
+				return None
+			names.add (os.path.basename (task.editable_src))
+	if dest in reserved or dest.startswith (src + '/') or src.startswith (dest + '/') or pathkind (dest) != '':
+		return None
+	index = dirindex if nameallocator is None else nameallocator.index
+	if index is not None:
+		entries = index.entries (src)
+	else:
+		try:
+			entries = os.listdir (src)
+		except OSError:
+			entries = None
+	if entries is None or set (entries) != names:
+		return None
+	reserved.add (dest)
+	return Foldertask (src, dest, tasks)
+
+def movefolder (foldertask:Foldertask)->bool:
+	""" Renames the folder of a Foldertask at once. The rename is written to the move journal before it is done.
+
+	Returns False if the folder cannot be renamed, for example to another device, or if it
+	has other files than the ones of the task.
+		"""
+	src, dest = foldertask.src, foldertask.dest
 	if dummy == False:
-		if itemcheck (os.path.dirname(dest)) == '':
-			os.makedirs (os.path.dirname(dest))
-		shutil.move (origin, dest)
-	logging.debug (f"\tfile has been moved. {dummymsg}")
-	return dest
+		names = {os.path.basename (t.src) for t in foldertask.tasks} | {os.path.basename (t.editable_src) for t in foldertask.tasks if t.editable_id != -1}
+		try:
+			if set (os.listdir (src)) != names:
+				logging.info (f'Folder contents have changed, its files will be moved one by one: {src}')
+				return False
+		except OSError:
+			return False
+		if movejournal is not None:
+			movejournal.append ([('folder', None, src, dest)])
+		makefolder (os.path.dirname (dest))
+		try:
+			renamenoreplace (src, dest)
+		except OSError as error:
+			logging.warning (f'Folder cannot be renamed ({error}), its files will be moved one by one: {src}')
+			return False
+		index = dirindex if nameallocator is None else nameallocator.index
+		if index is not None:
+			index.remove (src)
+			index.add (dest, 'folder')
+	logging.debug (f'\tFolder {src} renamed to {dest}. {dummymsg}')
+	return True
+
+def renamefolderpointers (dbconnection, src:str, dest:str)->int:
+	""" Changes at DB the path of all files in a renamed folder. Returns the number of entries changed.
+
+	It scans the whole tables, it is only in use to recover folder renames from the move journal,
+	which does not record the entries of the folder. Executed plans update their entries by id.
+		"""
+	changed = 0
+	for DBTable, column in (('PhotoTable', 'filename'), ('VideoTable', 'filename'), ('BackingPhotoTable', 'filepath')):
+		cursor = dbconnection.execute (f'UPDATE {DBTable} SET {column} = ? || substr({column}, ?) WHERE substr({column}, 1, ?) = ?',
+			(dest, len (src) + 1, len (src) + 1, src + '/'))
+		changed += cursor.rowcount
+	return changed
+
+def executemoveplan (moveplan:list, workers:int)->list:
+	""" Executes a list of Movetasks, scheduling the moves by device.
+
+	Destination names are given to all tasks in plan order first, and all moves are written to the
+	move journal. Names are given as if no file had been moved yet: the current name of a file blocks
+	it as a destination, even if the file is planned to move away. So the collision names given by
+	Nextfilenumber may differ from moving files one at a time, but they don't depend on workers
+	or on the order moves finish.
+	Then moves are queued by their source and destination devices. If one of them is a hard disk,
+	files are moved one at a time in inode order of their source, so the disk does not seek back and
+	forth. Otherwise each destination folder is moved by one of workers threads.
+	Queues run at the same time (Deviceexecutors) unless workers is 1.
+	Without a name allocator, names can't be reserved in advance and tasks are run by runmovetasks().
+	Returns the results of movetasks() for all tasks, in plan order.
+		"""
+	if nameallocator is None:
+		return runmovetasks (moveplan)
+	results = allocatetasks (moveplan)
+	journaltasks (results)
+	executors = Deviceexecutors (workers)
+	devices = dict ()  # folder : device
+	queues = dict ()  # (source device, destination device) : results
+	for result in results:
+		task, dest = result[:2]
+		if dest is None:
+			continue
+		for folder in (os.path.dirname (task.src), os.path.dirname (dest)):
+			if folder not in devices:
+				devices[folder] = pathdevice (folder)
+		queues.setdefault ((devices[os.path.dirname (task.src)], devices[os.path.dirname (dest)]), []).append (result)
+	moved = dict ()  # (table, id) : result of movetasks()
+	jobs = []
+	for queuedevices, queue in queues.items():
+		if executors.rotational (queuedevices) is not None:
+			inodes = dict ()
+			for result in queue:
+				try:
+					inodes[result[0].src] = os.stat (result[0].src).st_ino
+				except OSError:
+					inodes[result[0].src] = 0
+			queue.sort (key=lambda result: inodes[result[0].src])
+			groups = [queue]
+		else:
+			groups = dict ()
+			for result in queue:
+				groups.setdefault (os.path.dirname (result[1]), []).append (result)
+			groups = groups.values()
+		for group in groups:
+			if workers <= 1:
+				moved.update (((r[0].table, r[0].id), r) for r in movetasks (group))
+			else:
+				jobs.append (executors.submit (queuedevices, movetasks, group))
+	for job in jobs:
+		moved.update (((r[0].table, r[0].id), r) for r in job.result ())
+	executors.shutdown ()
+	return [moved.get ((r[0].table, r[0].id), r) for r in results]
 
 def Thumbfilepath (ID:int,Tablename='PhotoTable')->tuple:
 	""" This function returns the full-filepath of the thumbnails given an id
@@ -270,12 +795,704 @@ def getappstatus (apps:list)->bool:
 			break
 	return state
 
+def shotwellstarted ()->bool:
+	""" Checks if Shotwell is running, to stop video conversions."""
+	if getappstatus (['shotwell']):
+		print( '\nWARNING: Shotwell process is running, I will not run meanwhile Shotwell application is running.')
+		logging.warning( 'Shotwell process is running. Aborting current conversions.')
+		return True
+	return False
+
+def procpids (app:str)->list:
+	""" Get the PIDs of a running application from /proc.
+
+	Returns an empty list if the application is not running.
+		"""
+	pids = []
+	for entry in os.listdir ('/proc'):
+		if not entry.isdigit ():
+			continue
+		try:
+			with open (f'/proc/{entry}/comm') as f:
+				name = f.read().strip()
+		except OSError:
+			continue
+		if name == app[:15]:  # process names are truncated to 15 chars
+			pids.append (int (entry))
+	return pids
+
+class Inotifywatcher:
+	""" Watches files of a directory for changes, with Linux inotify (through libc).
+
+	The watcher is a file descriptor that becomes readable when one of the files is
+	created, modified, moved or deleted. read() returns the names of the changed files.
+		"""
+	IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x2, 0x8, 0x80, 0x100, 0x200
+	Header = struct.Struct ('iIII')  # wd, mask, cookie, len
+
+	def __init__ (self, dirpath:str, names:set):
+		self.names = names
+		libc = ctypes.CDLL (ctypes.util.find_library ('c'), use_errno=True)
+		self.fd = libc.inotify_init1 (os.O_NONBLOCK | os.O_CLOEXEC)
+		if self.fd < 0:
+			raise OSError (ctypes.get_errno (), 'inotify_init1 failed')
+		mask = self.IN_MODIFY | self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+		if libc.inotify_add_watch (self.fd, os.fsencode (dirpath), mask) < 0:
+			error = ctypes.get_errno ()
+			os.close (self.fd)
+			raise OSError (error, f'inotify_add_watch failed on {dirpath}')
+
+	def fileno (self)->int:
+		return self.fd
+
+	def read (self)->set:
+		""" Returns the set of watched names with changes since the last read, without blocking."""
+		changed = set ()
+		while True:
+			try:
+				buf = os.read (self.fd, 65536)
+			except BlockingIOError:
+				return changed
+			offset = 0
+			while offset < len (buf):
+				wd, mask, cookie, namelen = self.Header.unpack_from (buf, offset)
+				offset += self.Header.size
+				name = os.fsdecode (buf[offset:offset + namelen].rstrip (b'\0'))
+				offset += namelen
+				if name in self.names:
+					changed.add (name)
+
+	def close (self):
+		os.close (self.fd)
+
+def waitprocessexit (pid:int, timeout:float=None)->bool:
+	""" Blocks until a process ends, with a pidfd if the kernel supports it.
+
+	Returns False if timeout seconds pass before.
+		"""
+	try:
+		pidfd = os.pidfd_open (pid)
+	except (AttributeError, OSError):
+		deadline = None if timeout is None else time.monotonic () + timeout
+		while os.path.exists (f'/proc/{pid}'):
+			if deadline is not None and time.monotonic () >= deadline:
+				return False
+			time.sleep (Daemondebounce)
+		return True
+	try:
+		return len (select.select ([pidfd], [], [], timeout)[0]) > 0
+	finally:
+		os.close (pidfd)
+
+def waitappexit (app:str, timeout:float)->bool:
+	""" Blocks until no instance of an application is running.
+
+	Returns False if it is still running after timeout seconds.
+		"""
+	deadline = time.monotonic () + timeout
+	while True:
+		pids = procpids (app)
+		if len (pids) == 0:
+			return True
+		for pid in pids:
+			if not waitprocessexit (pid, max (0, deadline - time.monotonic ())):
+				return False
+
+def waitforchanges (watcher:Inotifywatcher, app:str, timeout:int, pending=False)->bool:
+	""" Blocks until Shotwell DB has changes and Shotwell is not running.
+
+	It sleeps on the inotify watcher of the DB files and on the running Shotwell process, so
+	no CPU is used while idle. When changes are seen, it waits until Daemondebounce seconds pass
+	with no more changes and no Shotwell running. It returns True then, or False if timeout
+	seconds pass without changes. Set pending if there are changes already waiting to be processed.
+		"""
+	deadline = time.monotonic () + timeout
+	while True:
+		pids = procpids (app)
+		if len (pids) > 0:
+			logging.debug (f'Waiting for {app} to exit. Pending changes: {pending}')
+			for pid in pids:
+				waitprocessexit (pid)
+			pending = pending or len (watcher.read ()) > 0
+			continue
+		if pending:
+			wait = Daemondebounce
+		else:
+			wait = deadline - time.monotonic ()
+			if wait <= 0:
+				return False
+		ready = select.select ([watcher], [], [], wait)[0]
+		if len (ready) == 0:
+			if pending:
+				return True
+			continue
+		changed = watcher.read ()
+		if len (changed) > 0:
+			logging.debug (f'Changes detected at: {changed}')
+			pending = True
+
+Conversionjob = namedtuple ('Conversionjob', 'entry src dest creationtime strategy', defaults=('encode',))  # A video to convert, entry is its VideoTable row.
+Convpollseconds = 5  # Seconds between checks of Shotwell status meanwhile videos are converted.
+Remuxcodecs = ('h264', 'hevc')  # Video codecs that are copied, instead of encoded, under conv_remux_kbs.
+
+def probevideo (filepath:str)->dict:
+	""" Gets the codec, bitrate (kbit/s), duration (seconds), frame size and rotation of the video stream of a file with ffprobe.
+
+	The size of the file (bytes) is also returned, as probed.
+
+	Returns None if the file can't be probed.
+		"""
+	try:
+		output = check_output (['ffprobe', '-v', 'error', '-select_streams', 'v:0', '-show_streams', '-show_format',
+			'-of', 'json', filepath], stderr=subprocess.DEVNULL)
+		probe = json.loads (output)
+		stream, fileformat = probe['streams'][0], probe.get ('format', {})
+		bitrate = stream.get ('bit_rate', fileformat.get ('bit_rate'))
+		duration = stream.get ('duration', fileformat.get ('duration'))
+		size = fileformat.get ('size')
+		rotation = stream.get ('tags', {}).get ('rotate', 0)
+		for sidedata in stream.get ('side_data_list', []):
+			rotation = sidedata.get ('rotation', rotation)
+		return {
+			'codec'		: stream.get ('codec_name'),
+			'bitrate'	: None if bitrate is None else int (bitrate) // 1000,
+			'duration'	: None if duration is None else float (duration),
+			'size'		: None if size is None else int (size),
+			'width'		: stream.get ('width'),
+			'height'	: stream.get ('height'),
+			'rotation'	: int (rotation) % 360,
+			}
+	except (OSError, subprocess.CalledProcessError, ValueError, KeyError, IndexError) as error:
+		logging.warning (f'\tCan\'t probe {filepath}: {error}')
+		return None
+
+def cachedprobevideo (filepath:str)->dict:
+	""" Same as probevideo, but results are fetched from the fingerprint cache if the file has not changed."""
+	if fpcache is None:
+		return probevideo (filepath)
+	probe = fpcache.get (filepath, 'probe')
+	if probe is None:
+		probe = probevideo (filepath)
+		if probe is not None:
+			fpcache.put (filepath, probe=probe)
+	return probe
+
+def probevideopool (filepaths:list, workers=Hashworkers)->dict:
+	""" Probes of a batch of videos.
+
+	Returns a dictionary {filepath: probe}, probing the files concurrently. Files that can't be probed are left out.
+		"""
+	with ThreadPoolExecutor (max_workers=workers) as executor:
+		probes = dict (zip (filepaths, executor.map (cachedprobevideo, filepaths)))
+	return {filepath: probe for filepath, probe in probes.items() if probe is not None}
+
+def videomeasures (probe:dict, filesize:int, duration:float, width:int, height:int)->tuple:
+	""" File size, duration and frame size of a video.
+
+	Values are taken from the probe of the file if there is one, as Shotwell values are often 0 or stale.
+		"""
+	if probe is not None:
+		filesize = probe['size'] or filesize
+		duration = probe['duration'] or duration
+		width, height = probe['width'] or width, probe['height'] or height
+	return filesize, duration, width, height
+
+def convertedisvalid (filepath:str, duration:float)->bool:
+	""" Tells if a converted video is complete: it can be probed, and it lasts as its source, give or take a second."""
+	if not duration:
+		return False
+	probe = probevideo (filepath)
+	return probe is not None and probe['duration'] is not None and abs (probe['duration'] - duration) <= 1
+
+def conversionbitrate (probe:dict, filesize:int, duration:float, width:int, height:int)->float:
+	""" Average bitrate of a video, as bytes per second per 1000 pixels.
+
+	Returns None if the bitrate can't be known.
+		DefTest >> OK
+		"""
+	filesize, duration, width, height = videomeasures (probe, filesize, duration, width, height)
+	if not duration or not width or not height:
+		return None
+	return filesize / duration / (width * height / 1000)
+
+def conversionpriority (probe:dict, filesize:int, duration:float, width:int, height:int, targetbitrate:int)->float:
+	""" Estimated bytes saved by encoding a video, per megapixel-second to encode.
+
+	The encoded video is expected at targetbitrate (bytes per second per 1000 pixels), and the
+	encoding time to be proportional to the pixels to encode, so videos with higher values save
+	more bytes per second of CPU.
+		DefTest >> OK
+		"""
+	filesize, duration, width, height = videomeasures (probe, filesize, duration, width, height)
+	if not duration or not width or not height:
+		return 0
+	saved = filesize - targetbitrate * (width * height / 1000) * duration
+	return max (saved, 0) / (duration * width * height / 1000000)
+
+def conversionstrategy (probe:dict, remuxkbs:int, segmentseconds:int=0)->str:
+	""" Chooses how to convert a video.
+
+	Videos already in an efficient codec, with a video stream under remuxkbs kbit/s, are remuxed: their streams are copied to
+	the new container. Others, or videos that could not be probed, are encoded. Videos longer than
+	two segments of segmentseconds are encoded by segments, if segmentseconds is set.
+		DefTest >> OK
+		"""
+	if probe is None:
+		return 'encode'
+	if probe['codec'] in Remuxcodecs and probe['bitrate'] is not None and probe['bitrate'] < remuxkbs:
+		return 'remux'
+	if segmentseconds > 0 and probe['duration'] is not None and probe['duration'] > 2 * segmentseconds:
+		return 'segmented'
+	return 'encode'
+
+class Conversionqueue:
+	""" Converts videos with ffmpeg processes, several at a time.
+
+	Jobs are queued with add() and run by a pool of workers, each one runs a ffmpeg process
+	with a budget of threads, at a low CPU and I/O priority. results() yields the jobs as they
+	finish, so the caller updates the DB from a single thread, and can queue new jobs meanwhile.
+	stop() kills the running conversions and drops the queued ones, drain() only drops the queued ones.
+	Videos are converted to a .part file, renamed to the new file once ffmpeg has finished,
+	so the new file only exists when it is complete.
+
+	Segmented jobs split the video stream at keyframes in chunks of segmentseconds, the chunks
+	are encoded by the pool and joined to the new file, with the audio encoded in one go from the
+	original, so there are no gaps between chunks. Finished chunks are kept at segmentsfolder, so a
+	stopped conversion is resumed from them. No more than workers ffmpeg processes run at once.
+		"""
+	def __init__ (self, workers:int, threads:int, niceness:int, segmentseconds:int=0, segmentsfolder:str=None):
+		self.executor = ThreadPoolExecutor (max_workers=workers)
+		self.segmentexecutor = ThreadPoolExecutor (max_workers=workers)
+		self.slots = threading.BoundedSemaphore (workers)  # ffmpeg processes running
+		self.threads = threads
+		self.niceness = niceness
+		self.segmentseconds = segmentseconds
+		self.segmentsfolder = segmentsfolder
+		self.futures = dict ()  # future : job
+		self.pending = set ()
+		self.processes = set ()
+		self.lock = threading.Lock ()
+		self.stopped = False
+		self.drained = False
+
+	def ffmpeg (self)->list:
+		""" Returns the start of a ffmpeg command line."""
+		command = []
+		if self.niceness > 0:
+			command += ['nice', '-n', str (self.niceness)]
+			if shutil.which ('ionice') is not None:
+				command += ['ionice', '-c', '2', '-n', '7']
+		return command + ['ffmpeg', '-nostdin', '-hide_banner', '-loglevel', 'error']
+
+	def command (self, job:Conversionjob)->list:
+		""" Returns the command line to convert a video to job.dest, as a mov file."""
+		command = self.ffmpeg () + ['-i', job.src]
+		if job.strategy == 'remux':
+			command += ['-c', 'copy', '-map_metadata', '0']
+		elif self.threads > 0:
+			command += ['-threads', str (self.threads)]
+		if job.creationtime is not None:
+			command += ['-metadata', f'creation_time={job.creationtime}']
+		return command + ['-f', 'mov', job.dest]
+
+	def process (self, command:list, filepath:str)->int:
+		""" Runs a ffmpeg command on a file. Returns its exit code, or None if the conversion was stopped."""
+		with self.slots:
+			with self.lock:
+				if self.stopped:
+					return None
+				process = subprocess.Popen (command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+				self.processes.add (process)
+			errors = process.communicate ()[1]
+			with self.lock:
+				self.processes.discard (process)
+				if self.stopped and process.returncode != 0:  # Killed by stop()
+					return None
+		if process.returncode != 0:
+			logging.warning (f'\tffmpeg errors converting {filepath}: {errors.decode (errors="replace")[-500:]}')
+		return process.returncode
+
+	def run (self, job:Conversionjob)->int:
+		""" Converts a video. Returns the exit code of ffmpeg, or None if the conversion was stopped
+		or could not be run, to be retried on next pass."""
+		if dummy == True:
+			return 0
+		partial = job._replace (dest=job.dest + '.part')
+		try:
+			if job.strategy == 'segmented':
+				folder = self.segmentfolder (job.src)
+				if folder is None:
+					logging.warning (f'\tCan\'t access {job.src}, it will be converted on next pass.')
+					return None
+				exitcode = self.runsegmented (partial, folder)
+				if exitcode is not None:  # Segments are kept only to resume stopped conversions.
+					shutil.rmtree (folder, ignore_errors=True)
+			else:
+				exitcode = self.process (self.command (partial), job.src)
+			if exitcode == 0:
+				os.replace (partial.dest, job.dest)
+			return exitcode
+		finally:
+			if itemcheck (partial.dest) == 'file':
+				os.remove (partial.dest)
+
+	def segmentfolder (self, filepath:str)->str:
+		""" Returns the folder of the segments of a video, named after its stat, or None if it can't be accessed."""
+		try:
+			st = os.stat (filepath)
+		except OSError:
+			return None
+		return os.path.join (self.segmentsfolder, f'{st.st_dev}-{st.st_ino}-{st.st_size}-{st.st_mtime_ns}')
+
+	def encodesegment (self, src:str, dest:str)->int:
+		""" Encodes the video of a segment, dest only exists once it is fully encoded."""
+		command = self.ffmpeg () + ['-i', src, '-an']
+		if self.threads > 0:
+			command += ['-threads', str (self.threads)]
+		exitcode = self.process (command + ['-f', 'mov', dest + '.part'], src)
+		if exitcode == 0:
+			os.replace (dest + '.part', dest)
+		return exitcode
+
+	def runsegmented (self, job:Conversionjob, folder:str)->int:
+		""" Converts a video by segments at folder, resuming from segments encoded by former runs."""
+		splitfolder, encodedfolder = os.path.join (folder, 'split'), os.path.join (folder, 'encoded')
+		if itemcheck (splitfolder) != 'folder':
+			partial = splitfolder + '.part'
+			shutil.rmtree (partial, ignore_errors=True)
+			os.makedirs (partial)
+			exitcode = self.process (self.ffmpeg () + ['-i', job.src, '-map', '0:v:0', '-c', 'copy',
+				'-f', 'segment', '-segment_time', str (self.segmentseconds), '-reset_timestamps', '1',
+				os.path.join (partial, '%05d.mkv')], job.src)
+			if exitcode != 0:
+				return exitcode
+			os.rename (partial, splitfolder)
+		os.makedirs (encodedfolder, exist_ok=True)
+		segments = [os.path.splitext (name)[0] + '.mov' for name in sorted (os.listdir (splitfolder)) if name.endswith ('.mkv')]
+		encoded = set (os.listdir (encodedfolder))
+		logging.info (f'\tEncoding {len (set (segments) - encoded)} of {len (segments)} segments of {job.src}')
+		futures = [self.segmentexecutor.submit (self.encodesegment,
+			os.path.join (splitfolder, os.path.splitext (name)[0] + '.mkv'), os.path.join (encodedfolder, name))
+			for name in segments if name not in encoded]
+		exitcodes = []
+		for future in futures:
+			try:
+				exitcodes.append (future.result ())
+			except Exception as error:
+				logging.error (f'\tEncoding a segment of {job.src} failed: {error!r}')
+				exitcodes.append (None)
+		if None in exitcodes:
+			return None
+		for exitcode in exitcodes:
+			if exitcode != 0:
+				return exitcode
+		listfile = os.path.join (folder, 'segments.txt')
+		with open (listfile, 'w') as f:
+			for name in segments:
+				segment = os.path.join (encodedfolder, name).replace ("'", "'\\''")
+				f.write (f"file '{segment}'\n")
+		command = self.ffmpeg () + ['-f', 'concat', '-safe', '0', '-i', listfile, '-i', job.src,
+			'-map', '0:v', '-map', '1:a?', '-c:v', 'copy']
+		if job.creationtime is not None:
+			command += ['-metadata', f'creation_time={job.creationtime}']
+		return self.process (command + ['-f', 'mov', job.dest], job.src)
+
+	def cleansegments (self):
+		""" Removes segments of videos that are not queued to be converted by segments."""
+		if self.segmentsfolder is None or itemcheck (self.segmentsfolder) != 'folder':
+			return
+		keep = {self.segmentfolder (job.src) for job in self.futures.values() if job.strategy == 'segmented'}
+		for name in os.listdir (self.segmentsfolder):
+			folder = os.path.join (self.segmentsfolder, name)
+			if folder not in keep:
+				logging.debug (f'\tRemoving segments no longer in use: {folder}')
+				shutil.rmtree (folder, ignore_errors=True)
+
+	def add (self, job:Conversionjob, converted:bool=False):
+		""" Queues a video to be converted. If it is already converted, it is yielded as finished by results()."""
+		if converted:
+			future = Future ()
+			future.set_result (0)
+		else:
+			future = self.executor.submit (self.run, job)
+		self.futures[future] = job
+		self.pending.add (future)
+		if self.drained:
+			future.cancel ()
+
+	def results (self, stopcheck, deadline:float=None):
+		""" Yields (job, exitcode) as conversions finish. exitcode is None for conversions to retry
+		on next pass: stopped, dropped, or that could not be run.
+
+		stopcheck is called as conversions finish, or every Convpollseconds; when it returns True
+		conversions are stopped, and all jobs are yielded as stopped from then on, so the caller does
+		not write the DB. New files of jobs that had finished are kept, to be taken on next pass.
+		When time.monotonic() reaches deadline, the queue is drained: running conversions finish
+		and queued ones are dropped.
+			"""
+		while self.pending:
+			timeout = Convpollseconds
+			if deadline is not None and not self.drained:
+				timeout = max (0, min (timeout, deadline - time.monotonic ()))
+			done = wait (self.pending, timeout=timeout, return_when=FIRST_COMPLETED).done
+			self.pending -= done
+			if not self.stopped and stopcheck ():
+				self.stop ()
+			if deadline is not None and not self.drained and time.monotonic () >= deadline:
+				self.drain ()
+			for future in done:
+				yield self.futures[future], None if self.stopped else self.exitcode (future)
+
+	def exitcode (self, future)->int:
+		""" Exit code of a finished job, None if it was dropped or it raised an error."""
+		if future.cancelled ():
+			return None
+		try:
+			return future.result ()
+		except Exception as error:
+			logging.error (f'\tConversion of {self.futures[future].src} could not be run, it will be retried on next pass: {error!r}')
+			return None
+
+	def drain (self):
+		""" Cancels queued conversions, running ones go on."""
+		self.drained = True
+		for future in self.futures:
+			future.cancel ()
+
+	def stop (self):
+		""" Kills running conversions, and cancels queued ones."""
+		with self.lock:
+			self.stopped = True
+			for process in self.processes:
+				process.terminate ()
+		for future in self.futures:
+			future.cancel ()
+
+	def close (self):
+		self.executor.shutdown ()
+		self.segmentexecutor.shutdown ()
+
 def addtoconfigfile (linetoadd:str):
 	print ("adding a new parameter to the user config file: {}".format(linetoadd.split()[0]))
 	f = open(userfileconfig,"a")
 	f.write ("\n" + linetoadd)
 	f.close()
 
+def loadstate ()->dict:
+	""" Loads the state saved by the last execution, from a file at user's configuration folder.
+
+	Returns an empty dictionary if there is no state, or it can't be read.
+		"""
+	if itemcheck (stateFile) != 'file':
+		return dict ()
+	try:
+		with open (stateFile, 'rb') as f:
+			return pickle.load (f)
+	except (OSError, pickle.UnpicklingError, EOFError) as error:
+		logging.warning (f'State file could not be loaded: {error}')
+		return dict ()
+
+def savestate (state:dict):
+	""" Saves the state of this execution. The file is replaced at once, so it is never left half written."""
+	with open (stateFile + '.tmp', 'wb') as f:
+		pickle.dump (state, f)
+	os.replace (stateFile + '.tmp', stateFile)
+
+Planmagic = b'Shotwell-event2folder plan 2\n'
+Plantags = ('~tuple', '~set', '~items', '~datetime')  # Types that JSON has not, tagged at plan records.
+
+def planvalue (value):
+	""" Returns a value as plain JSON data. Tuples, sets, datetimes and dictionaries with other keys
+	than strings are tagged, as a dictionary of one key from Plantags."""
+	if isinstance (value, tuple):
+		return {'~tuple': [planvalue (v) for v in value]}
+	if isinstance (value, (set, frozenset)):
+		return {'~set': [planvalue (v) for v in value]}
+	if isinstance (value, datetime):
+		return {'~datetime': value.isoformat ()}
+	if isinstance (value, dict):
+		if all (type (k) is str and not k.startswith ('~') for k in value):
+			return {k: planvalue (v) for k, v in value.items()}
+		return {'~items': [[planvalue (k), planvalue (v)] for k, v in value.items()]}
+	if isinstance (value, list):
+		return [planvalue (v) for v in value]
+	if value is None or type (value) in (str, int, float, bool):
+		return value
+	raise ValueError (f'{type (value).__name__} values cannot be stored at plan files.')
+
+def untagplanvalue (value:dict):
+	""" json.loads object_hook, it gives back the values tagged by planvalue()."""
+	if len (value) == 1:
+		tag, data = next (iter (value.items()))
+		if tag == '~tuple':
+			return tuple (data)
+		if tag == '~set':
+			return set (data)
+		if tag == '~datetime':
+			return datetime.fromisoformat (data)
+		if tag == '~items':
+			return {k: v for k, v in data}
+	return value
+
+def planline (record)->bytes:
+	""" Returns a plan record as a line of JSON."""
+	return json.dumps (planvalue (record)).encode ('ascii') + b'\n'
+
+class Planspool:
+	""" A list of plan records spooled to a temporary file, so a plan is held with bounded memory.
+
+	Records are appended as plan file lines, and read back in order by iterating the spool.
+		"""
+	def __init__ (self):
+		self.file = tempfile.TemporaryFile ()
+		self.count = 0
+
+	def append (self, record):
+		self.file.write (planline (record))
+		self.count += 1
+
+	def __len__ (self)->int:
+		return self.count
+
+	def __iter__ (self):
+		self.file.seek (0)
+		try:
+			yield from readrecords (self.file, 'plan spool')
+		finally:
+			self.file.seek (0, os.SEEK_END)
+
+	def close (self):
+		self.file.close ()
+
+def planrecords (writelog:list, fileactions:list, moveplan:list, folderplan:list=()):
+	""" Yields the records of a plan in the order they must be applied.
+
+	('sql', (sql, params)) DB writes, ('file', action) file metadata actions, ('folder', (src, dest, tasks))
+	folder renames and ('move', task) file moves.
+		"""
+	for entry in writelog:
+		yield ('sql', entry)
+	for action in fileactions:
+		yield ('file', action)
+	for foldertask in folderplan:
+		yield ('folder', (foldertask.src, foldertask.dest, [tuple (task) for task in foldertask.tasks]))
+	for task in moveplan:
+		yield ('move', tuple (task))
+
+def writeplan (planpath:str, header:dict, records):
+	""" Writes a plan file: a header record followed by the plan records, one JSON line each.
+
+	The file is replaced at once, so it is never left half written.
+		"""
+	try:
+		with open (planpath + '.tmp', 'wb') as f:
+			f.write (Planmagic)
+			for record in chain ([('header', header)], records):
+				f.write (planline (record))
+	except:
+		os.remove (planpath + '.tmp')
+		raise
+	os.replace (planpath + '.tmp', planpath)
+
+def readplan (planpath:str):
+	""" Reads a plan file record by record. The first record is ('header', header).
+
+	It raises a ValueError if the file is not a plan or it is truncated.
+		"""
+	with open (planpath, 'rb') as f:
+		if f.read (len (Planmagic)) != Planmagic:
+			raise ValueError (f'{planpath} is not a plan file.')
+		yield from readrecords (f, planpath)
+
+def readrecords (f, filepath:str):
+	""" Reads JSON line records from an open file until its end. Records are data only, nothing is run to read them.
+
+	It raises a ValueError if a record is truncated or malformed.
+		"""
+	for line in f:
+		if not line.endswith (b'\n'):
+			raise ValueError (f'{filepath} is truncated.')
+		yield json.loads (line, object_hook=untagplanvalue)
+
+def dumpplan (planpath:str):
+	""" Prints a plan file, its header and then one record per line, so plans can be inspected and compared."""
+	plan = readplan (planpath)
+	header = next (plan)[1]
+	for key, value in header.items():
+		if key == 'check':
+			value = f"{len (value['signatures'])} event signatures, {len (value['rows'])} rows, max event id {value['maxevent']}"
+		print (f'# {key}: {value}')
+	counts = Counter ()
+	for kind, payload in plan:
+		counts[kind] += 1
+		print (f'{kind}\t{payload}')
+	print ('# ' + ', '.join (f'{count} {kind} records' for kind, count in counts.items()))
+
+class Movejournal:
+	""" A write-ahead journal of file moves.
+
+	Moves are written to disk before files are moved, so if the process dies before their new
+	paths are committed to DB, the DB is fixed at the next start by recoverjournal().
+	Records are (table, id, src, dest), written as plan file lines. Renamed folders are
+	recorded as ('folder', None, src, dest).
+		"""
+	def __init__ (self, journalpath:str):
+		self.path = journalpath
+		self.file = open (journalpath, 'ab')
+		self.lock = threading.Lock ()
+
+	def append (self, records:list):
+		""" Writes a batch of records, and waits until they are on disk."""
+		if len (records) == 0:
+			return
+		with self.lock:
+			for record in records:
+				self.file.write (planline (record))
+			self.file.flush ()
+			os.fsync (self.file.fileno ())
+
+	def close (self):
+		""" Closes and deletes the journal, once all moves are committed to DB."""
+		self.file.close ()
+		os.remove (self.path)
+
+def recoverjournal (dbconnection, journalpath:str)->int:
+	""" Commits to DB the moves of a journal left by an interrupted execution, and deletes the journal.
+
+	A move is committed if its destination exists and its source does not. Moves of
+	a truncated last record were never done, as files are moved after their records are on disk.
+	A file given a new name as its destination was taken is recorded again, the last record counts.
+	Returns the number of DB entries fixed.
+		"""
+	if itemcheck (journalpath) != 'file':
+		return 0
+	logging.warning ('Found a move journal of an interrupted execution, recovering the DB.')
+	fixed = 0
+	records, positions = [], dict ()  # (table, id, src) : position of its record
+	with open (journalpath, 'rb') as f:
+		try:
+			for record in readrecords (f, journalpath):
+				key = tuple (record[:3])
+				if record[0] != 'folder' and key in positions:
+					records[positions[key]] = record
+				else:
+					positions[key] = len (records)
+					records.append (record)
+		except ValueError:
+			logging.debug ('\tThe move journal ends with an incomplete record.')
+	for table, Id, src, dest in records:
+		if table == 'folder':
+			if itemcheck (dest) == 'folder' and itemcheck (src) == '':
+				fixed += renamefolderpointers (dbconnection, src, dest)
+		elif itemcheck (dest) == 'file' and itemcheck (src) == '':
+			column = 'filepath' if table == 'BackingPhotoTable' else 'filename'
+			cursor = dbconnection.execute (f'UPDATE {table} SET {column} = ? WHERE id = ? AND {column} = ?', (dest, Id, src))
+			fixed += cursor.rowcount
+	dbconnection.commit ()
+	os.remove (journalpath)
+	logging.info (f'{fixed} DB entries were recovered from the move journal.')
+	return fixed
+
 def Changes ()->bool:
 	""" Check if ShotwellDatabase has modifications since last execution.
 
@@ -338,14 +1555,229 @@ def md5hash (filepath:str)->str:
 	""" Md5 hash of a file.
 	
 	Given a fullpath to a file, it will return the md5 hashstring
-	it reads in bytes mode and it will load the full file in memory
+	it reads the file in chunks of Hashchunksize bytes into a reused buffer,
+	so memory usage stays the same no matter how big the file is.
 		"""
 	hasher = md5()
-	with open(filepath, 'rb') as afile:
-		buf = afile.read()
-		hasher.update(buf)
+	buf = bytearray (Hashchunksize)
+	view = memoryview (buf)
+	with open(filepath, 'rb', buffering=0) as afile:
+		while True:
+			readbytes = afile.readinto (buf)
+			if not readbytes:
+				break
+			hasher.update (view[:readbytes])
 	return (hasher.hexdigest())
 
+Copychunksize = 8*1024*1024  # Buffer size of copies to another device.
+transferstats = Counter ()  # files, bytes and seconds of the copies to another device
+transferlock = threading.Lock ()
+
+def copyandhash (src:str, dest:str)->str:
+	""" Copies a file and returns the md5 hash of its contents, computed in the same pass.
+	It raises FileExistsError if dest exists.
+
+	Data is read once, in chunks of Copychunksize bytes into a reused buffer. Writes are repeated
+	until each chunk is fully written, and the size of the copy is checked against the bytes read.
+	The copy is flushed to disk before it returns.
+		"""
+	hasher = md5()
+	buf = bytearray (Copychunksize)
+	view = memoryview (buf)
+	copied = 0
+	with open (src, 'rb', buffering=0) as fsrc, open (dest, 'xb', buffering=0) as fdest:
+		while True:
+			readbytes = fsrc.readinto (buf)
+			if not readbytes:
+				break
+			hasher.update (view[:readbytes])
+			written = 0
+			while written < readbytes:
+				written += fdest.write (view[written:readbytes])
+			copied += readbytes
+		os.fsync (fdest.fileno ())
+		if os.fstat (fdest.fileno ()).st_size != copied:
+			raise OSError (f'Copy of {src} has {os.fstat (fdest.fileno ()).st_size} bytes, {copied} were read.')
+	shutil.copystat (src, dest)
+	return hasher.hexdigest ()
+
+def crossdevicemove (src:str, dest:str, filemd5:str=None):
+	""" Moves a file to another device, copying and hashing it in one pass.
+
+	The file is copied to a hidden .part file besides dest, and it is renamed to dest once verified,
+	so an interrupted copy never lies under the name of a file. It is verified before the source
+	file is deleted: the hash of the data read must be the md5 at DB. If it is not (the DB md5 can
+	be outdated), the copy is read again and compared.
+	The hash is stored at the fingerprint cache, so the moved file is not read again to hash it.
+	It raises OSError if the copy does not match, or if the source file can't be deleted after
+	the copy. The source file is kept then, and the copy is deleted. An existing dest is never
+	replaced, FileExistsError is raised then.
+		"""
+	start = time.monotonic ()
+	partial = os.path.join (os.path.dirname (dest), '.' + os.path.basename (dest) + '.part')
+	try:
+		if itemcheck (partial) == 'file':
+			os.remove (partial)  # Left by an interrupted copy
+		filehash = copyandhash (src, partial)
+		if filehash != filemd5 and md5hash (partial) != filehash:
+			raise OSError (f'Copy of {src} does not match its source file.')
+		size = os.path.getsize (partial)
+		renamenoreplace (partial, dest)
+	except BaseException:
+		if itemcheck (partial) == 'file':
+			os.remove (partial)
+		raise
+	try:
+		os.remove (src)
+	except OSError as error:
+		logging.warning (f'\tCopied file cannot be deleted from its source ({error}), the copy is deleted and the file is kept at: {src}')
+		os.remove (dest)
+		raise
+	seconds = time.monotonic () - start
+	with transferlock:
+		transferstats['files'] += 1
+		transferstats['bytes'] += size
+		transferstats['seconds'] += seconds
+	if fpcache is not None:
+		fpcache.put (dest, md5=filehash)
+	logging.debug (f'\tCopied to another device, {size/2**20:.1f} MB at {size/2**20/max (seconds, 0.001):.1f} MB/s')
+
+class Hashpool:
+	""" Hashes files in background threads.
+
+	Files are queued with add() and hashed meanwhile the caller keeps working,
+	hashlib releases the GIL, so several files are read and hashed at the same time.
+		"""
+	def __init__ (self, workers=Hashworkers):
+		self.executors = Deviceexecutors (workers)  # Files on hard disks are read one at a time.
+		self.devices = dict ()  # folder : device
+		self.jobs = []
+
+	def add (self, filepath:str, *tag):
+		""" Queues a file to be hashed, tag is returned along with its hash."""
+		folder = os.path.dirname (filepath)
+		if folder not in self.devices:
+			self.devices[folder] = pathdevice (folder)
+		self.jobs.append ((filepath, tag, self.executors.submit ((self.devices[folder],), cachedmd5hash, filepath)))
+
+	def results (self):
+		""" Yields (tag, md5hashstring) for every queued file, in the order they were added.
+		Files that can't be read are logged and skipped."""
+		jobs, self.jobs = self.jobs, []
+		for filepath, tag, job in jobs:
+			try:
+				filehash = job.result()
+			except OSError as error:
+				logging.warning (f'\tCould not hash file {filepath}: {error}')
+				continue
+			yield tag, filehash
+
+	def close (self):
+		self.executors.shutdown ()
+
+class Fingerprintcache:
+	""" Sidecar SQLite cache of values computed from files.
+
+	Entries are keyed by the stat of the file (device, inode, size, mtime_ns). If the file
+	changes, its stat does too, and the stored values are discarded. It stores the md5 hash,
+	the mediainfo() result, the last title written to the file (metadata) and the probe of videos.
+	The cache is bounded to maxentries, less recently used entries are evicted at flush().
+		"""
+	fields = ('md5', 'mediainfo', 'metadata', 'probe')
+
+	def __init__ (self, cachefile:str, maxentries:int):
+		self.maxentries = maxentries
+		self.lock = threading.Lock ()
+		self.touched = dict ()  # (device, inode) : last access time, written at flush()
+		self.connection = sqlite3.connect (cachefile, check_same_thread=False)
+		self.connection.execute ("CREATE TABLE IF NOT EXISTS fingerprints (\
+			device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER,\
+			md5 TEXT, mediainfo BLOB, metadata BLOB, last_access INTEGER, probe BLOB,\
+			PRIMARY KEY (device, inode))")
+		columns = [row[1] for row in self.connection.execute ("PRAGMA table_info (fingerprints)")]
+		if 'probe' not in columns:  # Cache files created by older versions
+			self.connection.execute ("ALTER TABLE fingerprints ADD COLUMN probe BLOB")
+		self.connection.execute ("CREATE INDEX IF NOT EXISTS fingerprints_access ON fingerprints (last_access)")
+		self.connection.commit ()
+
+	def fingerprint (self, filepath:str)->tuple:
+		""" Returns the stat tuple (device, inode, size, mtime_ns) of a file, or None if it can't be accessed."""
+		try:
+			st = os.stat (filepath)
+		except OSError:
+			return None
+		return st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns
+
+	def get (self, filepath:str, field:str):
+		""" Returns a stored value of a file, or None if it is not cached or the file has changed."""
+		key = self.fingerprint (filepath)
+		if key is None:
+			return None
+		with self.lock:
+			row = self.connection.execute (f"SELECT {field} FROM fingerprints WHERE device=? AND inode=? AND size=? AND mtime_ns=?", key).fetchone()
+			if row is None or row[0] is None:
+				return None
+			self.touched[key[:2]] = int (time.time())
+		if field == 'md5':
+			return row[0]
+		return pickle.loads (row[0])
+
+	def put (self, filepath:str, **values):
+		""" Stores values for a file, given as keyword arguments (md5, mediainfo, metadata, probe).
+		Values stored for an older version of the file are discarded."""
+		key = self.fingerprint (filepath)
+		if key is None:
+			return
+		for field in values:
+			if field not in self.fields:
+				raise KeyError (field)
+			if field != 'md5':
+				values[field] = pickle.dumps (values[field])
+		now = int (time.time())
+		with self.lock:
+			row = self.connection.execute ("SELECT size, mtime_ns FROM fingerprints WHERE device=? AND inode=?", key[:2]).fetchone()
+			if row != key[2:]:
+				self.connection.execute ("INSERT OR REPLACE INTO fingerprints (device, inode, size, mtime_ns, last_access) VALUES (?,?,?,?,?)", key + (now,))
+			for field, value in values.items():
+				self.connection.execute (f"UPDATE fingerprints SET {field}=?, last_access=? WHERE device=? AND inode=?", (value, now) + key[:2])
+
+	def flush (self):
+		""" Records last access times, evicts less recently used entries and commits to disk."""
+		with self.lock:
+			self.connection.executemany ("UPDATE fingerprints SET last_access=? WHERE device=? AND inode=?", ((t,) + k for k, t in self.touched.items()))
+			self.touched = dict ()
+			count = self.connection.execute ("SELECT count(*) FROM fingerprints").fetchone()[0]
+			if count > self.maxentries:
+				self.connection.execute ("DELETE FROM fingerprints WHERE rowid IN (SELECT rowid FROM fingerprints ORDER BY last_access LIMIT ?)", (count - self.maxentries,))
+				logging.debug (f'{count - self.maxentries} entries evicted from fingerprint cache')
+			self.connection.commit ()
+
+	def close (self):
+		self.flush ()
+		self.connection.close ()
+
+def cachedmd5hash (filepath:str)->str:
+	""" Md5 hash of a file, fetched from the fingerprint cache if the file has not changed."""
+	if fpcache is None:
+		return md5hash (filepath)
+	filehash = fpcache.get (filepath, 'md5')
+	if filehash is None:
+		filehash = md5hash (filepath)
+		fpcache.put (filepath, md5=filehash)
+	return filehash
+
+def md5hashpool (filepaths:list, workers=Hashworkers)->dict:
+	""" Md5 hashes of a batch of files.
+	
+	Returns a dictionary {filepath: md5hashstring}, hashing the files concurrently.
+		"""
+	pool = Hashpool (workers)
+	for filepath in filepaths:
+		pool.add (filepath, filepath)
+	hashes = {tag[0]: filehash for tag, filehash in pool.results()}
+	pool.close ()
+	return hashes
+
 def enclosedyearfinder (string:str)->str:
 	""" Searchs for a year string.
 
@@ -499,6 +1931,409 @@ def findeventname(Abranch:str)->str:
 			eventname = mo.group('XeventnameX')
 	return eventname
 
+class DBwriter:
+	""" Buffers parameterized DB writes and executes them with executemany.
+
+	Consecutive writes with the same SQL text are sent in one executemany call, so sqlite3
+	reuses a single prepared statement, and the order of the writes is kept.
+	Writes are flushed and committed every batchsize writes, and at commit(), which is called
+	at the end of each phase. In dummy mode writes are executed, so later reads see them,
+	but they are never committed.
+	If a log list is given, every write is also appended to it as (sql, params), so the writes
+	can be replayed later on another DB.
+		"""
+	def __init__ (self, dbconnection, batchsize:int, dummy:bool, log:list=None):
+		self.connection = dbconnection
+		self.batchsize = batchsize
+		self.dummy = dummy
+		self.log = log
+		self.runs = []  # [sql, [params, ...]]
+		self.count = 0
+
+	def execute (self, sql:str, params:tuple):
+		""" Buffers a write. A full batch is flushed and committed."""
+		if self.log is not None:
+			self.log.append ((sql, params))
+		if len (self.runs) > 0 and self.runs[-1][0] == sql:
+			self.runs[-1][1].append (params)
+		else:
+			self.runs.append ([sql, [params]])
+		self.count += 1
+		if self.count >= self.batchsize:
+			self.commit ()
+
+	def flush (self):
+		""" Executes the buffered writes, without committing them."""
+		for sql, paramslist in self.runs:
+			self.connection.executemany (sql, paramslist)
+		self.runs = []
+		self.count = 0
+
+	def commit (self, phase:str=''):
+		""" Executes the buffered writes and commits the transaction."""
+		self.flush ()
+		if self.dummy == False:
+			self.connection.commit ()
+		if phase != '':
+			logging.debug ( f'Changes commited at the end of {phase}.{dummymsg}')
+
+class Itemsdigest:
+	""" SQLite aggregate of a digest of rows, whatever their order.
+
+	Each row is hashed on its own and the hashes are added up modulo 2**64, so a change in any row
+	changes the digest, even if other rows change the opposite way (swapped ratings, titles or dates).
+		"""
+	def __init__ (self):
+		self.digest = 0
+
+	def step (self, *values):
+		rowhash = md5 (repr (values).encode ('utf-8', 'surrogateescape')).digest ()
+		self.digest = (self.digest + int.from_bytes (rowhash[:8], 'big')) % 2**64
+
+	def finalize (self)->str:
+		return f'{self.digest:016x}'
+
+def eventsignatures (dbconnection, events:set=None)->dict:
+	""" Returns a signature of each event, computed in one query from its name and its items.
+
+	The signature of an event changes if its name changes, or if any of its photos or videos is
+	added, removed, re-dated, re-rated, renamed, re-titled or re-imported. Each row is hashed in
+	Python, so it is only computed for the given events, if events is not None.
+	Returns a dictionary {eventid: (name, itemcount, digest of items)}
+		"""
+	dbconnection.create_aggregate ('itemsdigest', 9, Itemsdigest)
+	where, params = '', ()
+	if events is not None:
+		events = list (events)
+		where = f"WHERE event_id IN ({','.join ('?' * len (events))})"
+		params = events * 3
+	signatures = dict ()
+	for row in dbconnection.execute (f"SELECT EventTable.id, EventTable.name, ifnull (items.itemcount, 0), items.digest \
+		FROM EventTable LEFT JOIN \
+			(SELECT event_id, count(*) AS itemcount, itemsdigest (tablename, id, exposure_time, rating, flags, editable_id, filename, title, time_reimported) AS digest FROM \
+				(SELECT 'PhotoTable' AS tablename, event_id, id, exposure_time, rating, flags, editable_id, filename, title, time_reimported FROM PhotoTable {where} \
+				UNION ALL SELECT 'VideoTable', event_id, id, exposure_time, rating, flags, -1, filename, title, time_reimported FROM VideoTable {where}) \
+			GROUP BY event_id) AS items ON items.event_id = EventTable.id {where.replace ('event_id', 'EventTable.id')}", params):
+		signatures[row[0]] = row[1:]
+	return signatures
+
+def textchecksum (column:str)->str:
+	""" SQL expression of a checksum of a text column: its length and some of its characters, 0 if it is null."""
+	return f"ifnull (length ({column}) + unicode ({column}) * 3 + unicode (substr ({column}, -1)) * 5 + unicode (substr ({column}, length ({column}) / 2 + 1, 1)) * 7, 0)"
+
+Checksumprime = 1000000007  # Row checksums are taken modulo this prime, so their sum never overflows.
+
+def eventsummaries (dbconnection)->dict:
+	""" Returns a summary of each event, computed by SQLite with no Python code per row.
+
+	The summary is the name of the event, its number of items and a sum of checksums of its rows,
+	weighted by their id so swapped values change it. It changes if any item is added, removed,
+	re-dated, re-rated, re-flagged, re-imported or moved to another event, and if a title or a
+	filename changes its length or the characters the checksum takes.
+	Returns a dictionary {eventid: (name, itemcount, checksum)}
+		"""
+	rows = {}
+	for table, editable in (('PhotoTable', 'editable_id'), ('VideoTable', '-1')):
+		rows[table] = f"SELECT event_id, ((id % 65521 + 1) * ((exposure_time % 65521 + rating * 7 + flags * 13 + ({editable} + 1) * 17 \
+			+ ifnull (time_reimported, 0) % 65521 * 19 + {textchecksum ('filename')} * 23 + {textchecksum ('title')} * 29) % {Checksumprime})) % {Checksumprime} AS checksum FROM {table}"
+	summaries = dict ()
+	for row in dbconnection.execute (f"SELECT EventTable.id, EventTable.name, ifnull (items.itemcount, 0), ifnull (items.checksum, 0) \
+		FROM EventTable LEFT JOIN \
+			(SELECT event_id, count(*) AS itemcount, sum (checksum) AS checksum FROM ({rows['PhotoTable']} UNION ALL {rows['VideoTable']}) \
+			GROUP BY event_id) AS items ON items.event_id = EventTable.id"):
+		summaries[row[0]] = row[1:]
+	return summaries
+
+def highwatermarks (dbconnection)->dict:
+	""" Returns the high-water marks of the photo and video tables, as {table: (max id, max time_created, max time_reimported)}."""
+	return {table: dbconnection.execute (f"SELECT ifnull (max (id), 0), ifnull (max (time_created), 0), ifnull (max (time_reimported), 0) FROM {table}").fetchone()
+		for table in ('PhotoTable', 'VideoTable')}
+
+def dirtyevents (dbconnection, lastsummaries:dict, lastmarks:dict)->tuple:
+	""" Returns the events changed since the summaries and high-water marks of the last run, and the current summaries.
+
+	Events of rows over the marks (new, created or re-imported rows) are dirty, and so are the
+	events whose summary has changed, which covers edits, removals and renamed events.
+		"""
+	dirty = set ()
+	for table, (maxid, maxcreated, maxreimported) in lastmarks.items():
+		dirty.update (row[0] for row in dbconnection.execute (
+			f"SELECT DISTINCT event_id FROM {table} WHERE id > ? OR time_created > ? OR time_reimported > ?", (maxid, maxcreated, maxreimported)))
+	summaries = eventsummaries (dbconnection)
+	dirty.update (e for e in summaries if lastsummaries.get (e) != summaries[e])
+	return dirty, summaries
+
+Mostrecentlowwater = 0.9  # Share of mostrecentkbs left at the most recent folder when it is over its size.
+
+def mostrecentcutoff (dbconnection, kbs:int, stars:int, lastcutoff:int=None)->int:
+	""" Returns the exposure time after which files are sent to the most recent folder.
+
+	Files after the cutoff with a rating of stars or more sum up to kbs, the running sum is computed
+	by SQLite with a window function. So that files near the cutoff do not go back and forth on each
+	import, the last cutoff is kept while the files after it fit in kbs. When they do not, the oldest
+	ones are evicted until the rest fit in Mostrecentlowwater of kbs.
+	Returns None if there are no files with such rating.
+		"""
+	items = "SELECT filesize, exposure_time, rating, 'PhotoTable' FROM PhotoTable WHERE rating >= ? \
+		UNION SELECT filesize, exposure_time, rating, 'VideoTable' FROM VideoTable WHERE rating >= ?"
+	if lastcutoff is not None:
+		total = dbconnection.execute (f"SELECT total (filesize) FROM ({items}) WHERE exposure_time > ?", (stars, stars, lastcutoff)).fetchone()[0]
+		if total <= kbs:
+			return lastcutoff
+		kbs = int (kbs * Mostrecentlowwater)
+	row = dbconnection.execute (f"SELECT exposure_time FROM \
+		(SELECT exposure_time, sum (filesize) OVER (ORDER BY exposure_time DESC ROWS UNBOUNDED PRECEDING) AS acumulated FROM ({items})) \
+		WHERE acumulated >= ? ORDER BY acumulated LIMIT 1", (stars, stars, kbs)).fetchone()
+	if row is None:
+		# All files fit, the cutoff is the oldest one.
+		row = dbconnection.execute (f"SELECT min (exposure_time) FROM ({items})", (stars, stars)).fetchone()
+	return row[0]
+
+FICLONE = 0x40049409  # ioctl that clones a file sharing its data, on filesystems with reflinks (btrfs, xfs).
+
+def mirrorfile (src:str, dest:str)->str:
+	""" Creates dest with the contents of src, sharing its data when it is possible.
+
+	On the same filesystem, it tries a reflink, a copy that shares data blocks until one of the files
+	is written (btrfs, xfs), and then a hardlink if the filesystem has no reflinks. On another
+	filesystem both fail, and it tries an in-kernel copy with copy_file_range, and finally a plain copy.
+	Returns the method used.
+		"""
+	with open (src, 'rb') as fsrc, open (dest, 'wb') as fdest:
+		try:
+			fcntl.ioctl (fdest.fileno (), FICLONE, fsrc.fileno ())
+			method = 'reflink'
+		except OSError as error:
+			method = 'hardlink' if error.errno != errno.EXDEV else None
+	if method == 'hardlink':
+		try:
+			os.remove (dest)
+			os.link (src, dest)
+			return method
+		except OSError:
+			method = None
+	if method is None:
+		with open (src, 'rb') as fsrc, open (dest, 'wb') as fdest:
+			try:
+				remaining = os.fstat (fsrc.fileno ()).st_size
+				while remaining > 0:
+					copied = os.copy_file_range (fsrc.fileno (), fdest.fileno (), remaining)
+					if copied == 0:
+						break
+					remaining -= copied
+				method = 'copy_file_range'
+			except (OSError, AttributeError):
+				fsrc.seek (0)
+				fdest.seek (0)
+				fdest.truncate ()
+				shutil.copyfileobj (fsrc, fdest, Hashchunksize)
+				method = 'copy'
+	shutil.copystat (src, dest)
+	return method
+
+def mirrorisfresh (mirrorpath:str, filepath:str)->bool:
+	""" Checks that a mirror has the contents of its file, by their size and modification time.
+
+	Mirrors keep the modification time of their file, so a file rewritten after it was mirrored
+	(for example with a new title or date in its metadata) does not match.
+		"""
+	try:
+		mirrorstat, filestat = os.stat (mirrorpath), os.stat (filepath)
+	except OSError:
+		return False
+	return (mirrorstat.st_size, mirrorstat.st_mtime_ns) == (filestat.st_size, filestat.st_mtime_ns)
+
+def syncmirror (wanted:list, lastmirror:dict, processedevents:set)->tuple:
+	""" Updates the mirror of the most recent files, changing only what differs from the last run.
+
+	wanted is a list of (mirror folder, file path, eventid) of the processed events.
+	lastmirror is the mirror of the last run, as {mirror path: (file path, eventid)}, the mirrors
+	of events that were not processed are kept as they are.
+	Returns the new mirror and a set of folders where mirrors were removed.
+		"""
+	index = dirindex if nameallocator is None else nameallocator.index
+	mirror = {m: v for m, v in lastmirror.items() if v[1] not in processedevents}
+	lastmirrors = {(os.path.dirname (m), v[0]): m for m, v in lastmirror.items() if v[1] in processedevents}
+	pending = []
+	stale = []  # Mirrors of files changed since they were mirrored
+	for mirrordir, filepath, eventid in wanted:
+		m = lastmirrors.get ((mirrordir, filepath))
+		if m is not None and pathkind (m) == 'file':
+			mirror[m] = (filepath, eventid)
+			if not mirrorisfresh (m, filepath):
+				stale.append (m)
+		else:
+			pending.append ((mirrordir, filepath, eventid))
+	emptied = set ()
+	removed = 0
+	for m in lastmirror:
+		if m not in mirror and pathkind (m) == 'file':
+			removed += 1
+			if dummy == False:
+				os.remove (m)
+				if index is not None:
+					index.remove (m)
+			emptied.add (os.path.dirname (m))
+			logging.debug (f'\tMirror removed: {m} {dummymsg}')
+	methods = Counter ()
+	for m in stale:
+		if dummy == False:
+			os.remove (m)
+			methods[mirrorfile (mirror[m][0], m)] += 1
+		logging.debug (f'\tMirror refreshed: {m} {dummymsg}')
+	for mirrordir, filepath, eventid in pending:
+		m = os.path.join (mirrordir, os.path.basename (filepath))
+		while m in mirror or pathkind (m) != '':
+			m = Nextfilenumber (m)
+		if dummy == False:
+			makefolder (mirrordir)
+			methods[mirrorfile (filepath, m)] += 1
+			if index is not None:
+				index.add (m, 'file')
+		mirror[m] = (filepath, eventid)
+		logging.debug (f'\tMirror created: {m} {dummymsg}')
+	logging.info (f'Most recent mirror: {len (pending)} created and {len (stale)} refreshed {dict (methods)}, {removed} removed, {len (mirror)} in total.')
+	return mirror, emptied
+
+Eventdatepolicies = ('average', 'min', 'median', 'first')
+
+def eventdate (policy:str, eventid:int, eventavgtime:float, items:list, firstdates:dict)->float:
+	""" Returns the date of an event used to name its folder, as a timestamp.
+
+	Policies are:
+		average: the average of its distinct exposure times, as Shotwell dates events (eventavgtime).
+		min: its earliest exposure time.
+		median: its median exposure time, the lower one if there are an even number of times.
+		first: the average when the event was first seen, it is kept at firstdates and it does not
+			change while it is within the exposure times of the event.
+	items are eventplanner items. It returns 0 for events without dated items.
+		"""
+	times = sorted ({item[3] for item in items if item[3]})
+	if len (times) == 0:
+		return eventavgtime
+	if policy == 'min':
+		return times[0]
+	if policy == 'median':
+		return times[(len (times) - 1) // 2]
+	if policy == 'first':
+		first = firstdates.get (eventid)
+		if first is None or not times[0] <= first <= times[-1]:
+			first = firstdates[eventid] = eventavgtime
+		return first
+	return eventavgtime
+
+def eventplanner (dbconnection, eventids:set=None)->tuple:
+	""" Yields the events of the DB with their average date and their items.
+
+	Events and their average exposure time are fetched in one query, and all photos and videos
+	(joined to their editable backing photo) in a second one. Both are sorted by event id, so
+	items are grouped by streaming both cursors at once instead of querying each event.
+	The average is computed over distinct exposure times of the event, as Shotwell dates events.
+	Yields (eventid, eventname, eventavgtime, items) for each event, eventavgtime is 0 for
+	events without dated items. Items are tuples of:
+		(id, filename, title, exposure_time, import_id, DBTable, editable_id, rating, md5, flags, editable_filepath)
+	If a set of eventids is given, only those events are fetched.
+		"""
+	eventfilter, photofilter, videofilter = '', '', ''
+	if eventids is not None:
+		dbconnection.execute ("CREATE TEMP TABLE IF NOT EXISTS plannerevents (id INTEGER PRIMARY KEY)")
+		dbconnection.execute ("DELETE FROM temp.plannerevents")
+		dbconnection.executemany ("INSERT INTO temp.plannerevents VALUES (?)", ((e,) for e in eventids))
+		eventfilter = "WHERE EventTable.id IN (SELECT id FROM temp.plannerevents)"
+		photofilter = "WHERE PhotoTable.event_id IN (SELECT id FROM temp.plannerevents)"
+		videofilter = "WHERE VideoTable.event_id IN (SELECT id FROM temp.plannerevents)"
+	eventcursor = dbconnection.cursor ()
+	eventcursor.execute (f"SELECT EventTable.id, EventTable.name, ifnull (eventtimes.avgtime, 0) FROM EventTable LEFT JOIN \
+		(SELECT event_id, avg (exposure_time) AS avgtime FROM \
+			(SELECT event_id, exposure_time FROM VideoTable WHERE exposure_time != 0 \
+			UNION SELECT event_id, exposure_time FROM PhotoTable WHERE exposure_time != 0) \
+		GROUP BY event_id) AS eventtimes ON eventtimes.event_id = EventTable.id \
+		{eventfilter} ORDER BY EventTable.id")
+	# Items are sorted (not read through an index), so rows are already fetched when
+	# the caller updates them.
+	itemcursor = dbconnection.cursor ()
+	itemcursor.execute (f"SELECT PhotoTable.event_id, PhotoTable.id, PhotoTable.filename, PhotoTable.title, PhotoTable.exposure_time, PhotoTable.import_id, \
+			'PhotoTable' AS DBTable, PhotoTable.editable_id, PhotoTable.rating, PhotoTable.md5, PhotoTable.flags, BackingPhotoTable.filepath \
+		FROM PhotoTable LEFT JOIN BackingPhotoTable ON PhotoTable.editable_id != -1 AND BackingPhotoTable.id = PhotoTable.editable_id {photofilter} \
+		UNION ALL SELECT event_id, id, filename, title, exposure_time, import_id, 'VideoTable' AS DBTable, -1 AS editable_id, rating, md5, flags, null FROM VideoTable {videofilter} \
+		ORDER BY 1, 2, 3, 7")
+	item = itemcursor.fetchone ()
+	for eventid, eventname, eventavgtime in eventcursor:
+		# Items of events that are not at EventTable are skipped.
+		while item is not None and (item[0] is None or item[0] < eventid):
+			item = itemcursor.fetchone ()
+		items = []
+		while item is not None and item[0] == eventid:
+			items.append (item[1:])
+			item = itemcursor.fetchone ()
+		yield eventid, eventname, eventavgtime, items
+	itemcursor.close ()
+	eventcursor.close ()
+
+class Exposureindex:
+	""" Sorted in-memory index of the exposure times and events of photos and videos.
+
+	It is loaded once from the DB, and it answers which events have items in a time window
+	with a binary search. It must be updated with move() as items get new exposure times or
+	events, so later lookups see earlier assignments.
+		"""
+	def __init__ (self, dbconnection):
+		self.times = []  # sorted exposure times
+		self.events = []  # event_id of each exposure time
+		for exposure_time, event_id in dbconnection.execute ("SELECT exposure_time, event_id FROM PhotoTable UNION ALL SELECT exposure_time, event_id FROM VideoTable ORDER BY 1"):
+			self.times.append (exposure_time)
+			self.events.append (event_id)
+
+	def __len__ (self):
+		return len (self.times)
+
+	def add (self, exposure_time:int, event_id:int):
+		position = bisect_right (self.times, exposure_time)
+		self.times.insert (position, exposure_time)
+		self.events.insert (position, event_id)
+
+	def remove (self, exposure_time:int, event_id:int):
+		""" Removes an entry, it does nothing if the entry is not at the index."""
+		position = bisect_left (self.times, exposure_time)
+		while position < len (self.times) and self.times[position] == exposure_time:
+			if self.events[position] == event_id:
+				del self.times[position]
+				del self.events[position]
+				return
+			position += 1
+
+	def move (self, old_time:int, old_event:int, new_time:int, new_event:int):
+		""" Updates the exposure time and event of an item."""
+		self.remove (old_time, old_event)
+		self.add (new_time, new_event)
+
+	def window (self, start:int, end:int)->tuple:
+		""" Returns events with items exposed between start and end (both excluded).
+
+		Returns a tuple with the number of different events, and the event with more items,
+		or (0, None) if there are no items in the window.
+			"""
+		found = Counter (self.events[bisect_right (self.times, start):bisect_left (self.times, end)])
+		if len (found) == 0:
+			return 0, None
+		return len (found), found.most_common (1)[0][0]
+
+def timeclusters (entries:list, gap:int)->list:
+	""" Groups entries by time.
+
+	Given a list of entries sorted by time (first element of each entry), it returns a list of
+	clusters (lists of entries). A new cluster is started when the time between an entry and
+	the previous one is equal or greater than gap.
+		"""
+	clusters = []
+	lasttime = None
+	for entry in entries:
+		if lasttime is None or entry[0] - lasttime >= gap:
+			clusters.append ([])
+		clusters[-1].append (entry)
+		lasttime = entry[0]
+	return clusters
+
 def mediainfo (abspath:str, assignstat:bool)->tuple:
 	""" Finds and returns creation date of media, and if it was assigned from stat. 
 		"""
@@ -657,6 +2492,238 @@ def mediainfo (abspath:str, assignstat:bool)->tuple:
 
 	return TimeOriginalEpoch, decideflag
 
+def cachedmediainfo (abspath:str, assignstat:bool)->tuple:
+	""" Same as mediainfo, but results are fetched from the fingerprint cache if the file has not changed.
+
+	mediainfo also parses the path of the file, so cached values are only valid for the same path and options.
+		"""
+	if fpcache is None:
+		return mediainfo (abspath, assignstat)
+	params = (abspath, assignstat, mintepoch)
+	cached = fpcache.get (abspath, 'mediainfo')
+	if cached is not None and cached[0] == params:
+		logging.debug (f'## item: {abspath} (mediainfo from cache)')
+		return cached[1]
+	result = mediainfo (abspath, assignstat)
+	fpcache.put (abspath, mediainfo=(params, result))
+	return result
+
+def inserttitlemetadata (photopath:str, phototitle:str):
+	""" Writes a title into the metadata of an image file, if it has a different one.
+
+	Titles already written are remembered at the fingerprint cache, so unchanged files are not opened again.
+		"""
+	lastmetadata = None
+	if fpcache is not None:
+		lastmetadata = fpcache.get (photopath, 'metadata')
+	if lastmetadata is not None and lastmetadata.get ('title') == phototitle:
+		logging.debug ('\tImage title metadata is up to date (fingerprint cache).')
+		return
+	try:
+		image_metadata = GExiv2.Metadata(photopath)
+	except:
+		logging.warning ('\tAn error occurred during obtaining metadata on this file')
+		return
+	if image_metadata.get('Iptc.Application2.Caption') != phototitle:
+		mydictofmetadatas = {
+		'Iptc.Application2.Caption': phototitle,
+		'Iptc.Application2.Headline': phototitle,
+		'Xmp.dc.title': 'lang="x-default" ' + phototitle,
+		'Xmp.photoshop.Headline' : phototitle,
+		}
+
+		for x in mydictofmetadatas:
+			image_metadata.set_tag_string (x, mydictofmetadatas[x])
+		if dummy == False :
+			image_metadata.save_file()
+		logging.info ( f"\tImage title metadata has been updated with database title: {phototitle}{dummymsg}")
+	if fpcache is not None and dummy == False:
+		fpcache.put (photopath, metadata={'title': phototitle})
+
+def updatehashes (hashpool:Hashpool, dbwriter:DBwriter):
+	""" Updates at DB the md5 of images with a date inserted in their metadata.
+
+	Images are queued at hashpool with a tag (Table, Id, Filepath, TimeOriginalEpoch).
+		"""
+	for (Table, Id, Filepath, TimeOriginalEpoch), MD5 in hashpool.results():
+		dbwriter.execute (f"UPDATE {Table} SET md5 = ? WHERE id = ?", (MD5, Id))
+		logging.debug ( f'\tUpdated md5 {MD5} for entry {Id} at {Table}.{dummymsg}')
+	hashpool.close ()
+
+def applyfileactions (fileactions:list, dbwriter:DBwriter):
+	""" Runs file metadata actions that were deferred meanwhile planning on a DB snapshot.
+
+	Actions are ('date', Filepath, TimeOriginalEpoch, Table, Id) or ('title', photopath, phototitle).
+	Images with a date inserted get their md5 updated at DB.
+		"""
+	hashpool = Hashpool ()
+	for action in fileactions:
+		if action[0] == 'title':
+			inserttitlemetadata (*action[1:])
+		elif action[0] == 'date':
+			Filepath, TimeOriginalEpoch, Table, Id = action[1:]
+			if dummy == False:
+				add_date_metadate (Filepath, TimeOriginalEpoch)
+			hashpool.add (Filepath, Table, Id, Filepath, TimeOriginalEpoch)
+	updatehashes (hashpool, dbwriter)
+
+def applyplanrecords (plan, dbwriter:DBwriter)->tuple:
+	""" Applies the DB writes and file metadata actions of plan records, as they are read.
+
+	Records come in the order of planrecords(). DB writes are replayed and file actions are run in
+	chunks of Journalbatch. Returns iterators of the Foldertasks and the Movetasks of the rest of
+	the plan, read as they are iterated: the folders must be iterated before the moves.
+		"""
+	plan = iter (plan)
+	rest = []  # The first record after the ones consumed
+	fileactions = []
+	for kind, payload in plan:
+		if kind == 'sql':
+			dbwriter.execute (*payload)
+		elif kind == 'file':
+			if len (fileactions) == 0:
+				dbwriter.commit ('replaying planned DB changes')
+			fileactions.append (payload)
+			if len (fileactions) >= Journalbatch:
+				applyfileactions (fileactions, dbwriter)
+				fileactions = []
+		else:
+			rest.append ((kind, payload))
+			break
+	applyfileactions (fileactions, dbwriter)
+	dbwriter.commit ('file metadatas')
+	def folders ():
+		for kind, payload in chain (rest, plan):
+			if kind != 'folder':
+				rest[:] = [(kind, payload)]
+				return
+			yield Foldertask (payload[0], payload[1], [Movetask (*task) for task in payload[2]])
+		rest.clear ()
+	def moves ():
+		for kind, payload in chain (rest, plan):
+			if kind == 'move':
+				yield Movetask (*payload)
+	return folders (), moves ()
+
+def commitpointers (pointerupdates:dict, dbwriter:DBwriter):
+	""" Changes at DB the paths of moved files, given as {table: [(path, id), ...]}, and commits them. The lists are emptied."""
+	if dummy == False:
+		dbwriter.flush ()
+		for DBTable, updates in pointerupdates.items():
+			column = 'filepath' if DBTable == 'BackingPhotoTable' else 'filename'
+			dbwriter.connection.executemany (f'UPDATE {DBTable} SET {column} = ? WHERE id = ?', updates)
+			updates.clear ()
+	dbwriter.commit ('events')
+
+def executeplan (folderplan, moveplan, workers:int, dbwriter:DBwriter, batchsize:int=None, keep:set=frozenset ())->tuple:
+	""" Renames the event folders and moves the files of a plan, and changes their paths at DB.
+
+	Folders are renamed first, the files of a folder that can't be renamed are moved one by one.
+	Files are moved by executemoveplan() in chunks of batchsize tasks (all at once if it is None),
+	and the new paths of each chunk are committed to DB before the next chunk is read, so plans
+	given as iterators are executed with bounded memory.
+	Returns a tuple of: {(table, id): final path, None if it could not be moved} for the entries
+	in keep, folders that files were moved from, and events with files that could not be moved.
+		"""
+	finalpaths, movedfrom, failedevents = dict (), set (), set ()
+	pointerupdates = {'PhotoTable': [], 'VideoTable': [], 'BackingPhotoTable': []}
+	leftover = []  # Tasks of folders that could not be renamed
+	renamed = 0
+	for foldertask in folderplan:
+		if movefolder (foldertask):
+			renamed += 1
+			# Only the entries of the task are changed, by id.
+			for task in foldertask.tasks:
+				pointerupdates[task.table].append ((task.dest, task.id))
+				if task.editable_id != -1:
+					pointerupdates['BackingPhotoTable'].append ((os.path.splitext(task.dest)[0] + '_modified' + os.path.splitext(task.dest)[1], task.editable_id))
+				if (task.table, task.id) in keep:
+					finalpaths[(task.table, task.id)] = task.dest
+			movedfrom.add (os.path.dirname (foldertask.src))
+		else:
+			leftover.extend (foldertask.tasks)
+	commitpointers (pointerupdates, dbwriter)
+	logging.info (f'{renamed} event folders were renamed, moving files with {workers} workers')
+	transferstats.clear ()
+	tasks = chain (leftover, moveplan)
+	moved = 0
+	while True:
+		chunk = list (islice (tasks, batchsize))
+		if len (chunk) == 0:
+			break
+		for task, dest, editable_dest in executemoveplan (chunk, workers):
+			if (task.table, task.id) in keep:
+				finalpaths[(task.table, task.id)] = dest
+			if dest is None:
+				logging.warning (f"File id({task.id}) was not moved, it is missing or it could not be moved: {task.src}")
+				failedevents.add (task.eventid)
+				continue
+			moved += 1
+			pointerupdates[task.table].append ((dest, task.id))
+			# adding a folder to scan
+			movedfrom.add (os.path.dirname(task.src))
+			logging.debug ( f"Entry {task.id} moved to {dest}. {dummymsg}")
+			if editable_dest is not None:
+				pointerupdates['BackingPhotoTable'].append ((editable_dest, task.editable_id))
+				movedfrom.add (os.path.dirname(task.editable_src))
+				logging.debug ( f"Editable entry {task.editable_id} moved to {editable_dest}. {dummymsg}")
+		commitpointers (pointerupdates, dbwriter)
+	logging.info (f'{moved} files were moved.')
+	if transferstats['files'] > 0:
+		logging.info (f"{transferstats['files']} files were copied to another device, {transferstats['bytes']/2**20:.1f} MB at {transferstats['bytes']/2**20/max (transferstats['seconds'], 0.001):.1f} MB/s")
+	return finalpaths, movedfrom, failedevents
+
+def snapshotDB (dbpath:str, snapshotpath:str)->sqlite3.Connection:
+	""" Copies a DB to a snapshot file, and returns a connection to the snapshot.
+
+	It uses the sqlite3 backup API, so the copy is consistent even if Shotwell is writing to the DB.
+		"""
+	liveconnection = sqlite3.connect (f'file:{dbpath}?mode=ro', uri=True)
+	snapshot = sqlite3.connect (snapshotpath)
+	liveconnection.backup (snapshot)
+	liveconnection.close ()
+	return snapshot
+
+Rowcolumns = {
+	'PhotoTable': 'filename, exposure_time, event_id, title',
+	'VideoTable': 'filename, exposure_time, event_id, title',
+	'BackingPhotoTable': 'filepath',
+	}  # Columns compared to check that a planned row has not changed.
+
+def rowvalues (dbconnection, rows:set)->dict:
+	""" Returns the values of a set of rows given as (table, id), as {(table, id): (values, ...)}."""
+	values = dict ()
+	for table, columns in Rowcolumns.items():
+		ids = [i for t, i in rows if t == table]
+		for start in range (0, len (ids), 500):
+			chunk = ids[start:start + 500]
+			query = f"SELECT id, {columns} FROM {table} WHERE id IN ({','.join ('?' * len (chunk))})"
+			for row in dbconnection.execute (query, chunk):
+				values[(table, row[0])] = row[1:]
+	return values
+
+def snapshotisvalid (dbconnection, check:dict)->bool:
+	""" Checks that the rows used to plan on a DB snapshot are the same at the live DB.
+
+	check is a dictionary taken from the snapshot before any planned write:
+		'maxevent': max id of EventTable,
+		'signatures': {eventid: signature} of the events with planned actions,
+		'rows': rowvalues() of the planned rows that are not covered by an event signature.
+		"""
+	maxevent = dbconnection.execute ("SELECT max(id) FROM EventTable").fetchone()[0]
+	if maxevent != check['maxevent']:
+		logging.info ('New events have been created since the snapshot.')
+		return False
+	signatures = eventsignatures (dbconnection, check['signatures'].keys())
+	for eventid, signature in check['signatures'].items():
+		if signatures.get (eventid) != signature:
+			logging.info (f'Event {eventid} has changed since the snapshot.')
+			return False
+	if rowvalues (dbconnection, set (check['rows'])) != check['rows']:
+		logging.info ('Planned photos or videos have changed since the snapshot.')
+		return False
+	return True
+
 def add_date_metadate (imagepath:str,TimeEpoch:str):
 	""" Adds a date to the metadata of an image file.
 		"""
@@ -675,6 +2742,27 @@ if __name__ == '__main__':
 	appuserpath= os.path.join (UserHomePath,".Shotwell-event2folder")
 	userfileconfig = os.path.join (appuserpath,"Shotevent2folder_cfg.py")
 	lastExecFile = os.path.join (appuserpath,".LastExec.dump")
+	fpcacheFile = os.path.join (appuserpath,".Fingerprints.sqlite")
+	stateFile = os.path.join (appuserpath,".State.dump")
+	snapshotFile = os.path.join (appuserpath,".Snapshot.db")
+	journalFile = os.path.join (appuserpath,".Moves.journal")
+	segmentsFolder = os.path.join (appuserpath,"segments")
+
+	# Command line: "plan <planfile>" saves the changes to a plan file without applying them,
+	# "apply <planfile>" applies a saved plan, "dump <planfile>" prints it.
+	# With no command, changes are planned and applied at once.
+	command, planFile = None, None
+	if len (sys.argv) == 3 and sys.argv[1] in ('plan', 'apply', 'dump'):
+		command, planFile = sys.argv[1], os.path.abspath (sys.argv[2])
+	elif len (sys.argv) > 1:
+		print (f'Usage: {sys.argv[0]} [plan <planfile> | apply <planfile> | dump <planfile>]')
+		exit ()
+	if command == 'dump':
+		try:
+			dumpplan (planFile)
+		except (OSError, ValueError, StopIteration) as error:
+			print (f'Plan file cannot be read: {error}')
+		exit ()
 	if itemcheck( appuserpath) != "folder":
 		os.makedirs( appuserpath)
 
@@ -708,12 +2796,26 @@ if __name__ == '__main__':
 		('mostrecentkbs', 			'0', '# Max amount of Kbs to send to the most recent pictures path as destination. Set 0 if you do not want to send any pictures there. (2_000_000_000 is 2Gb)'),
 		('morerecent_stars',		'-1', '# use values from -1 to 5 . Filter pictures or videos by rating to send to the more recent pictures path as destination. use -1 to move all files or ignore this option (default).'),
 		('conv_mov',				'False','# Convert movies with ffmpeg to shrink their size'),
-		('conv_bitrate_kbs',		'1200','# Movies under this average bitrate will not be processed'),
+		('conv_bitrate_kbs',		'1200','# Movies under this average bitrate will not be processed. Unlike conv_remux_kbs, it is measured in bytes per second per 1000 pixels of the frame, so it does not depend on the resolution.'),
 		('conv_flag',				"''",'# Only convert .mov videos wich ends on this string. leave an empty string to convert all videos.'),
 		('conv_extension',			"'MOV'", '# Filter video conversion to this kind of movies, leave an empty string to convert all file formats.'),
+		('conv_remux_kbs',			'0', '# Videos already in H.264 or HEVC under this bitrate of the video stream, in kbit/s, are remuxed to the new file instead of encoded. 0 encodes every video.'),
+		('conv_tick_seconds',		'0', '# Time budget in seconds to start video conversions on each pass, the most valuable ones first. Videos left are converted on next passes. 0 sets no limit.'),
+		('conv_segment_seconds',	'0', '# Videos longer than two segments of these seconds are encoded by segments in parallel, and stopped encodings are resumed from finished segments. 0 encodes whole videos.'),
+		('conv_workers',			'1', '# Number of videos converted at the same time.'),
+		('conv_threads',			'0', '# Number of threads of each ffmpeg conversion, 0 lets ffmpeg choose. conv_workers x conv_threads should not be over the number of cores.'),
+		('conv_nice',				'10', '# CPU priority of ffmpeg conversions, from 0 (normal) to 19 (lowest). Over 0 the I/O priority is lowered too.'),
 		('daemonmode',				'False','# It keeps the script running and process Shotwell DataBase if it has changes since last execution.'),
-		('sleepseconds',			'120','# Number of seconds to sleep, until another check in daemon mode.'),
+		('sleepseconds',			'120','# Number of seconds to sleep, until another check in daemon mode. It is only used if inotify is not available, set 0 to run just once.'),
 		('dummy',			 		'False', '# Dummy mode. True will not perform any changes to DB or File structure.'),
+		('moveworkers',				'1', '# Number of files moved at the same time. Files are moved after all events are processed, each destination folder is handled by a single worker.'),
+		('snapshotplanning',		'False', '# When Shotwell is running, plan all changes on a snapshot of its DataBase, and apply them as soon as Shotwell exits.'),
+		('mostrecentmirror',		'False', '# Keep the most recent files at their event folder, and mirror them at librarymostrecentpath with hardlinks. If it is on another filesystem reflinks or copies are made. Only changes are applied on each run.'),
+		('eventdate',				"'average'", '# Date used to name event folders: average, min, median or first. average is the date Shotwell gives to events. min, median and first do not change so often as the average when photos are added, first keeps the first date given to the event while it is within the event dates.'),
+		('incremental',				'False', '# Only process events with changes since the last run. All events are processed again if the configuration changes, and events with files crossing the most recent date limit if it moves.'),
+		('usedirindex',				'False', '# Read each folder once and check files and name collisions from memory. It saves a lot of time on network mounted libraries.'),
+		('dbcommitbatch',			'1000', '# Number of DB writes sent to Shotwell DB in each transaction. Each phase (autodate, events, conversions) commits its remaining writes when it ends.'),
+		('cachemaxentries',			'500_000', '# Max number of files remembered at the fingerprint cache (md5, dates and written metadata), so unchanged files are not read again. Set 0 to disable the cache.'),
 		)
 
 	retrievedvalues = dict ()
@@ -742,15 +2844,31 @@ if __name__ == '__main__':
 	importtitlefromfilenames = retrievedvalues ['importtitlefromfilenames']
 	inserttitlesinfiles = retrievedvalues ['inserttitlesinfiles']
 	daemonmode = retrievedvalues ['daemonmode']
+	if command is not None:
+		daemonmode = False  # plan and apply commands run once.
 	sleepseconds = retrievedvalues ['sleepseconds']
 	conv_mov = retrievedvalues ['conv_mov']
 	conv_bitrate_kbs = retrievedvalues ['conv_bitrate_kbs']
 	conv_flag = retrievedvalues ['conv_flag']
 	conv_extension = retrievedvalues ['conv_extension']
+	conv_remux_kbs = retrievedvalues ['conv_remux_kbs']
+	conv_tick_seconds = retrievedvalues ['conv_tick_seconds']
+	conv_segment_seconds = retrievedvalues ['conv_segment_seconds']
+	conv_workers = retrievedvalues ['conv_workers']
+	conv_threads = retrievedvalues ['conv_threads']
+	conv_nice = retrievedvalues ['conv_nice']
 	autodate = retrievedvalues ['autodate']
 	assignstat = retrievedvalues ['assignstat']
 	mintepoch = retrievedvalues ['mintepoch']
 	flat_tree = retrievedvalues ['flat_tree']
+	cachemaxentries = retrievedvalues ['cachemaxentries']
+	dbcommitbatch = retrievedvalues ['dbcommitbatch']
+	moveworkers = retrievedvalues ['moveworkers']
+	usedirindex = retrievedvalues ['usedirindex']
+	incremental = retrievedvalues ['incremental']
+	snapshotplanning = retrievedvalues ['snapshotplanning']
+	eventdatepolicy = retrievedvalues ['eventdate']
+	mostrecentmirror = retrievedvalues ['mostrecentmirror']
 
 	# Fetched from Shotwell's configuration
 	commit_metadata = gsettingsget('org.yorba.shotwell.preferences.files','commit-metadata','bool')
@@ -811,6 +2929,30 @@ if __name__ == '__main__':
 				conv_extension_q = '%'
 			else:
 				conv_extension_q = conv_extension
+		#  --conv_remux_kbs
+			if type (conv_remux_kbs) != int or conv_remux_kbs < 0:
+				errmsgs.append ("\n conv_remux_kbs at configuration file must be an integer, 0 or greater.")
+				logging.critical ("conv_remux_kbs is not an integer, 0 or greater.")
+		#  --conv_tick_seconds
+			if type (conv_tick_seconds) != int or conv_tick_seconds < 0:
+				errmsgs.append ("\n conv_tick_seconds at configuration file must be an integer, 0 or greater.")
+				logging.critical ("conv_tick_seconds is not an integer, 0 or greater.")
+		#  --conv_segment_seconds
+			if type (conv_segment_seconds) != int or conv_segment_seconds < 0:
+				errmsgs.append ("\n conv_segment_seconds at configuration file must be an integer, 0 or greater.")
+				logging.critical ("conv_segment_seconds is not an integer, 0 or greater.")
+		#  --conv_workers
+			if type (conv_workers) != int or conv_workers < 1:
+				errmsgs.append ("\n conv_workers at configuration file must be an integer greater than 0.")
+				logging.critical ("conv_workers is not an integer greater than 0.")
+		#  --conv_threads
+			if type (conv_threads) != int or conv_threads < 0:
+				errmsgs.append ("\n conv_threads at configuration file must be an integer, 0 or greater.")
+				logging.critical ("conv_threads is not an integer, 0 or greater.")
+		#  --conv_nice
+			if type (conv_nice) != int or conv_nice not in range (0, 20):
+				errmsgs.append ("\n conv_nice at configuration file must be an integer from 0 to 19.")
+				logging.critical ("conv_nice is not an integer from 0 to 19.")
 
 	#	--autodate
 	if type(autodate) != bool:
@@ -835,6 +2977,46 @@ if __name__ == '__main__':
 		logging.critical ("flat_tree value is not boolean.")
 
 
+	#	--moveworkers
+	if type(moveworkers) != int or moveworkers < 1:
+		errmsgs.append ("\n moveworkers at configuration file must be an integer greater than 0.")
+		logging.critical ("moveworkers is not an integer greater than 0.")
+
+	#	--mostrecentmirror
+	if type(mostrecentmirror) != bool:
+		errmsgs.append ("\n mostrecentmirror at configuration file must be True or False.")
+		logging.critical ("mostrecentmirror value is not boolean.")
+
+	#	--eventdate
+	if eventdatepolicy not in Eventdatepolicies:
+		errmsgs.append (f"\n eventdate at configuration file must be one of: {', '.join (Eventdatepolicies)}.")
+		logging.critical (f"eventdate value is not valid: {eventdatepolicy}")
+
+	#	--snapshotplanning
+	if type(snapshotplanning) != bool:
+		errmsgs.append ("\n snapshotplanning at configuration file must be True or False.")
+		logging.critical ("snapshotplanning value is not boolean.")
+
+	#	--incremental
+	if type(incremental) != bool:
+		errmsgs.append ("\n incremental at configuration file must be True or False.")
+		logging.critical ("incremental value is not boolean.")
+
+	#	--usedirindex
+	if type(usedirindex) != bool:
+		errmsgs.append ("\n usedirindex at configuration file must be True or False.")
+		logging.critical ("usedirindex value is not boolean.")
+
+	#	--dbcommitbatch
+	if type(dbcommitbatch) != int or dbcommitbatch < 1:
+		errmsgs.append ("\n dbcommitbatch at configuration file must be an integer greater than 0.")
+		logging.critical ("dbcommitbatch is not an integer greater than 0.")
+
+	#	--cachemaxentries
+	if type(cachemaxentries) != int or cachemaxentries < 0:
+		errmsgs.append ("\n cachemaxentries at configuration file must be a positive integer. Set 0 to disable the fingerprint cache.")
+		logging.critical ("cachemaxentries is not a positive integer.")
+
 	# exit if errors are econuntered
 	if len (errmsgs) != 0 :
 		for a in errmsgs:
@@ -862,11 +3044,25 @@ if __name__ == '__main__':
 	'conv_bitrate_kbs'		:	conv_bitrate_kbs,
 	'conv_flag'				:	conv_flag,
 	'conv_extension'		:	conv_extension,
+	'conv_remux_kbs'		:	conv_remux_kbs,
+	'conv_tick_seconds'		:	conv_tick_seconds,
+	'conv_segment_seconds'	:	conv_segment_seconds,
+	'conv_workers'			:	conv_workers,
+	'conv_threads'			:	conv_threads,
+	'conv_nice'				:	conv_nice,
 	'autodate'				:	autodate,
 	'assignstat'			:	assignstat,
 	'commit_metadata'		:	commit_metadata,
 	'mintepoch'				:	mintepoch,
 	'flat_tree'				:	flat_tree,
+	'cachemaxentries'		:	cachemaxentries,
+	'dbcommitbatch'			:	dbcommitbatch,
+	'moveworkers'			:	moveworkers,
+	'usedirindex'			:	usedirindex,
+	'incremental'			:	incremental,
+	'snapshotplanning'		:	snapshotplanning,
+	'eventdate'				:	eventdatepolicy,
+	'mostrecentmirror'		:	mostrecentmirror,
 	}
 
 	
@@ -894,10 +3090,28 @@ if __name__ == '__main__':
 		else:
 			print ('ffmpeg is present.')
 			ffmpeg = True
+	ffprobe = ffmpeg and shutil.which ('ffprobe') is not None
+	if ffmpeg and not ffprobe:
+		print ('No ffprobe tool is found. Videos will be selected by Shotwell values, and never remuxed.')
 
+	dbwatcher = None
 	if daemonmode:
-		print (f'Running in daemon mode. I will iterate every {sleepseconds} seconds.')
+		try:
+			dbwatcher = Inotifywatcher (os.path.dirname (DBpath), {os.path.basename (DBpath) + x for x in ('', '-journal', '-wal')})
+		except (OSError, AttributeError) as error:
+			logging.warning (f'inotify is not available ({error}), checking DB changes every {sleepseconds} seconds.')
+			print (f'Running in daemon mode. I will iterate every {sleepseconds} seconds.')
+		else:
+			print ('Running in daemon mode. I will run as soon as Shotwell DB changes and Shotwell is closed.')
+
+	state = loadstate ()  # State saved by the last execution
 
+	# Opening the fingerprint cache
+	if cachemaxentries > 0:
+		fpcache = Fingerprintcache (fpcacheFile, cachemaxentries)
+		logging.info (f'Using fingerprint cache at: {fpcacheFile}')
+
+	conversionsleft = 0  # Videos the last pass did not convert, because of its time budget or Shotwell
 	while True:
 		foldercollection = set ()
 		datelimit2move_exposure = datetime.now()
@@ -910,9 +3124,10 @@ if __name__ == '__main__':
 
 		countdown = 12
 		execution = True
+		deferred = False  # Changes were not processed because Shotwell was running
 
 		if daemonmode:
-			execution = Changes ()
+			execution = Changes () or conversionsleft > 0
 
 		# Check if Target folder is reachable. If not reachable, no execution possible.
 		if itemcheck (librarymainpath) != 'folder':
@@ -921,14 +3136,22 @@ if __name__ == '__main__':
 			execution = False
 
 		# Check if shotwell process is alive. Cancels the execution if it is alive.
-		if execution:
+		snapshotmode = command == 'plan'  # Planning on a DB snapshot, plan command or meanwhile Shotwell is running.
+		if execution and not snapshotmode:
 			execution = False
 			for a in range (countdown,0,-1):
 				if getappstatus (['shotwell']):
+					if snapshotplanning and command is None:
+						print ('\nShotwell process is running, planning changes on a snapshot of its DataBase.')
+						logging.info ('Shotwell process is running, planning on a DB snapshot')
+						execution = True
+						snapshotmode = True
+						break
 					print ('\nWARNING: Shotwell process is running, I will not run meanwhile Shotwell application is running.')
 					logging.warning ('Shotwell process is running')
 					if daemonmode:
 						execution = False
+						deferred = True
 						break
 					print (f'{a} retries left to desist')
 					time.sleep (10)
@@ -938,7 +3161,25 @@ if __name__ == '__main__':
 
 		if execution:
 			# Connecting to DB
-			dbconnection = sqlite3.connect (DBpath)
+			if snapshotmode:
+				# Changes are planned on a snapshot, DB writes are logged and file metadatas deferred,
+				# then they are applied to the live DB when Shotwell exits.
+				dbconnection = snapshotDB (DBpath, snapshotFile)
+				writelog, fileactions = Planspool (), Planspool ()
+				snapshotcheck = {
+					'maxevent': dbconnection.execute ("SELECT max(id) FROM EventTable").fetchone()[0],
+					'signatures': eventsignatures (dbconnection),
+					'rows': dict(),
+					}
+			else:
+				dbconnection = sqlite3.connect (DBpath)
+				writelog, fileactions = None, None
+				if dummy == False:
+					recoverjournal (dbconnection, journalFile)
+			dbwriter = DBwriter (dbconnection, dbcommitbatch, dummy, writelog)
+			if usedirindex:
+				dirindex = Dirindex ()  # A new snapshot of directories on each pass.
+			nameallocator = Nameallocator (Dirindex () if dirindex is None else dirindex)
 
 			__Schema__, __appversion__ = dbconnection.execute ("SELECT schema_version, app_version FROM versiontable").fetchone()
 			if 20 < __Schema__ < 24 :
@@ -949,29 +3190,31 @@ if __name__ == '__main__':
 				exit ()
 
 			# Autodate routine.
-			if autodate:
-				neweventsids = []  # I will try to add images to new created events.
+			if autodate and command != 'apply':
+				hashpool = Hashpool ()  # md5 of metadata-stamped images are computed in background.
+				exposureindex = Exposureindex (dbconnection)  # Exposure times and events of all items.
 				logging.debug ('Starting autodate routine')
 				deltaHours = 8  # Gap to find an existent event for the images.
 				deltatime = int(deltaHours*60*60/2)
 
+				# Dating all entries.
+				datedentries = []
 				dbnoeventcursor = dbconnection.cursor()
 				dbnoeventcursor.execute ("SELECT id,filename,timestamp,'PhotoTable',file_format,event_id FROM PhotoTable WHERE exposure_time = 0 and flags != 4 UNION SELECT id,filename,timestamp,'VideoTable',null,event_id FROM VideoTable WHERE exposure_time = 0  and flags != 4")
 				for entry in dbnoeventcursor:
 					logging.debug( f'Procesing no event_entry: {entry}')
 					Id, Filepath, Timestamp, Table, File_Format, Event_id = entry
-					eventID = Event_id
-					if itemcheck (Filepath) != 'file':
+					if pathkind (Filepath) != 'file':
 						logging.warning ( f'\tFile is not accesible: ({Id}) from {Table}')
 						continue
 					#Retrieving dates from file.
-					TimeOriginalEpoch, decideflag = mediainfo (Filepath, assignstat)
+					TimeOriginalEpoch, decideflag = cachedmediainfo (Filepath, assignstat)
 					if decideflag == None:
 						logging.info ( f"\tWe couldn't assign a date from the filename: {Filepath}")
 						if Event_id != -1:
 							# Try to assign a date from the Event if it has some photos.
 							# It will assign the earlier date of the even's photos.
-							Minimundate = dbconnection.execute("SELECT MIN(times) FROM (SELECT exposure_time as times FROM PhotoTable WHERE event_id = {0} and exposure_time != 0 UNION SELECT exposure_time as times FROM VideoTable WHERE event_id = {0} and exposure_time != 0)".format(Event_id,)).fetchone()[0]
+							Minimundate = dbconnection.execute("SELECT MIN(times) FROM (SELECT exposure_time as times FROM PhotoTable WHERE event_id = ? and exposure_time != 0 UNION SELECT exposure_time as times FROM VideoTable WHERE event_id = ? and exposure_time != 0)", (Event_id, Event_id)).fetchone()[0]
 							if Minimundate == None:
 								logging.info ( f"\tWe couldn't assign any date from the Photoevent: {Filepath}")
 								# we cant't do anything, I can't guess the picture date.
@@ -981,86 +3224,129 @@ if __name__ == '__main__':
 						else:
 							# we cant't do anything, I can't guess the picture date.
 							continue
-					elif Event_id == -1 :
-						logging.debug ("\t Searchign an event to add the item...")
-						ocurrences, eventID = dbconnection.execute ("SELECT count(ocurrences) as events_count, event_id from \
-							(select count(event_id) as ocurrences, event_id FROM \
-								(select event_id, id from PhotoTable WHERE exposure_time < {0} and exposure_time > {1} \
-									union	\
-								select event_id, id from VideoTable WHERE exposure_time < {0} and exposure_time > {1})	\
-							group by event_id order by ocurrences desc)".format(TimeOriginalEpoch + deltatime,TimeOriginalEpoch - deltatime)).fetchone()
+					datedentries.append ((TimeOriginalEpoch, Table, Id, Filepath, File_Format, Event_id))
+				dbnoeventcursor.close()
+				if snapshotmode:
+					snapshotcheck['rows'].update (rowvalues (dbconnection, {(e[1], e[2]) for e in datedentries}))
+
+				# Searching events for entries without event, in time order.
+				datedentries.sort ()
+				assignments = []  # (entry, eventID)
+				noevententries = []  # entries that will go to new events
+				for entry in datedentries:
+					TimeOriginalEpoch, Table, Id, Filepath, File_Format, Event_id = entry
+					eventID = Event_id
+					if Event_id == -1:
+						logging.debug ( f"\t Searchign an event to add the item {Filepath}...")
+						ocurrences, eventID = exposureindex.window (TimeOriginalEpoch - deltatime, TimeOriginalEpoch + deltatime)
 						logging.debug ( f'\t{ocurrences} occurences found')
-						if ocurrences != 1 and eventID not in neweventsids:
-							logging.debug ('\tCreating a new event for the item.')
-							#Selecting next event ID
-							eventID = dbconnection.execute("SELECT max(id)+1 FROM EventTable").fetchone()[0]
-							Time_created = int(datetime.timestamp(datetime.now()))
-							Primary_source_id = Thumbfilepath (Id,Table)[0]
-							neweventsids.append (eventID)
-							#Inserting new event
-							dbconnection.execute ("INSERT INTO EventTable \
-										(name,primary_photo_id,time_created,primary_source_id,comment) \
-									VALUES (null,null,{},'{}',null)".format( Time_created , Primary_source_id ))
+						if ocurrences != 1:
+							noevententries.append (entry)
+							continue
+					assignments.append ((entry, eventID))
+					exposureindex.move (0, Event_id, TimeOriginalEpoch, eventID)
+
+				# Creating new events for clusters of entries without event.
+				if len (noevententries) > 0:
+					clusters = timeclusters (noevententries, deltaHours*60*60)
+					nexteventID = dbconnection.execute ("SELECT ifnull (max(id), 0) + 1 FROM EventTable").fetchone()[0]
+					Time_created = int(datetime.timestamp(datetime.now()))
+					for n, cluster in enumerate (clusters):
+						eventID = nexteventID + n
+						firstentry = cluster[0]
+						dbwriter.execute ("INSERT INTO EventTable \
+								(id,name,primary_photo_id,time_created,primary_source_id,comment) \
+							VALUES (?,null,null,?,?,null)", (eventID, Time_created, Thumbfilepath (firstentry[2], firstentry[1])[0]))
+						for entry in cluster:
+							assignments.append ((entry, eventID))
+					logging.debug ( f'\tCreating {len(clusters)} new events for {len(noevententries)} items.')
+
+				for entry, eventID in assignments:
+					TimeOriginalEpoch, Table, Id, Filepath, File_Format, Event_id = entry
 					# assigning  image/video exposure time
-					logging.debug ('\tAssigning exposure time and event to the image')
-					dbconnection.execute ("UPDATE {} SET exposure_time = {}, event_id = {} where id = {}".format(Table,TimeOriginalEpoch,eventID,Id))
+					logging.debug ( f'\tAssigning exposure time and event {eventID} to the item {Filepath}')
+					dbwriter.execute (f"UPDATE {Table} SET exposure_time = ?, event_id = ? WHERE id = ?", (TimeOriginalEpoch, eventID, Id))
 					#Inserting metadatas in file
 					if commit_metadata and File_Format == 0 and TimeOriginalEpoch != None:
+						if fileactions is not None:
+							fileactions.append (('date', Filepath, TimeOriginalEpoch, Table, Id))
+							continue
 						if dummy == False:
 							add_date_metadate( Filepath, TimeOriginalEpoch)
-						MD5 = md5hash (Filepath)
-						dbconnection.execute ("UPDATE {} SET md5 = '{}' where id = {}".format(Table, MD5, Id))
-						logging.debug ( f'\tMetadata inserted into the image, updated md5 {MD5}.{dummymsg}')
+						hashpool.add (Filepath, Table, Id, Filepath, TimeOriginalEpoch)
+						logging.debug ( f'\tMetadata inserted into the image, md5 queued to be updated.{dummymsg}')
 
-					if dummy == False:
-						dbconnection.commit()
-					logging.debug( f'\tChanges commited.{dummymsg}')
-				dbnoeventcursor.close()
+				dbwriter.commit ('autodate dating')
+				# Updating md5 of the images with inserted metadatas.
+				updatehashes (hashpool, dbwriter)
+				dbwriter.commit ('autodate')
 			
-			totalreg = dbconnection.execute ('SELECT sum (ids) FROM (SELECT count (id) AS ids FROM phototable UNION SELECT count(id) AS ids FROM videotable )').fetchone()[0]
-			progress = Progresspercent (totalreg)
-			idcounter = 0
-
 			# Most recent pictures routine.
-			if mostrecentkbs > 0 :
-				dballitemscursor = dbconnection.cursor ()
-				dballitemscursor.execute ("SELECT filesize, exposure_time, rating, 'PhotoTable' as tabla FROM PhotoTable WHERE rating >= %(rating)s UNION SELECT filesize, exposure_time, rating,'VideoTable' as tabla FROM VideoTable WHERE rating >= %(rating)s ORDER BY exposure_time DESC" %{'rating':morerecent_stars} )
-				acumulatedKb = 0
-				for entry in dballitemscursor:
-					acumulatedKb = acumulatedKb + entry[0]
-					#print (acumulatedKb)
-					if acumulatedKb >= mostrecentkbs:
-						break
-				datelimit2move_exposure = datetime.fromtimestamp(entry[1])
+			mostrecent = None  # (mostrecentkbs, morerecent_stars, cutoff) of this run
+			if mostrecentkbs > 0 and command != 'apply':
+				lastcutoff = None
+				if state.get ('mostrecent') is not None and state['mostrecent'][:2] == (mostrecentkbs, morerecent_stars):
+					lastcutoff = state['mostrecent'][2]
+				cutoff = mostrecentcutoff (dbconnection, mostrecentkbs, morerecent_stars, lastcutoff)
+				if cutoff is not None:
+					datelimit2move_exposure = datetime.fromtimestamp(cutoff)
+					mostrecent = (mostrecentkbs, morerecent_stars, cutoff)
+					if cutoff != lastcutoff:
+						logging.info ('The most recent folder cutoff has changed.')
 				logging.info ( f"Files earlier than {datelimit2move_exposure.strftime(r'%Y-%m-%d')} and with a rating of {morerecent_stars} or more will be sent to {librarymostrecentpath}")
-				dballitemscursor.close()
 
 			# Inserting a Trash event
 			dbeventcursor = dbconnection.cursor ()
 			try:
 				dbeventcursor.execute("INSERT INTO EventTable (id, name) VALUES (-1,'Trash')")
-				dbconnection.commit()
+				if dummy == False:
+					dbconnection.commit()
 			except:
 				pass
 
-			# Processing events. Event cursor
-			dbeventcursor.execute('SELECT id,name FROM EventTable')
-			for e in dbeventcursor:
-				# Retrieve event data
-				eventid, eventname = e	
-				times = dbconnection.execute('SELECT exposure_time FROM videotable WHERE event_id = ? and exposure_time != 0 UNION select exposure_time from phototable where event_id = ? and exposure_time != 0', (eventid,eventid))
-
-				#    calculating event date by average
-				suma, count = 0, 0
-				for l in times:
-					count += 1
-					suma += l[0]
-				eventavgtime = 0
-				if count == 0:
-					logging.debug ( f'\tEvent {eventid} has no datable photos or videos (or is empty).')
+			# Choosing the events to process. On incremental runs, only events with changes since the last run.
+			plannedevents = None  # None means all events
+			retryevents = set ()  # Events with files that could not be processed
+			runsignature = (librarymainpath, librarymostrecentpath, insertdateinfilename, flat_tree, importtitlefromfilenames,
+							inserttitlesinfiles, mostrecentkbs, morerecent_stars, eventdatepolicy, mostrecentmirror)
+			datelimit = int (datelimit2move_exposure.timestamp()) if mostrecentkbs > 0 else None
+			if incremental and command != 'apply':
+				if state.get ('runsignature') == runsignature and 'highwater' in state:
+					plannedevents, summaries = dirtyevents (dbconnection, state.get ('eventsummaries', dict()), state['highwater'])
+					plannedevents |= state.get ('retryevents', set())
+					lastdatelimit = state.get ('datelimit')
+					if datelimit != lastdatelimit:
+						# Events with items between both date limits go to another folder now.
+						limits = sorted ((datelimit, lastdatelimit))
+						crossing = dbconnection.execute ("SELECT event_id FROM PhotoTable WHERE exposure_time BETWEEN ? AND ? UNION SELECT event_id FROM VideoTable WHERE exposure_time BETWEEN ? AND ?", limits + limits)
+						plannedevents.update (e[0] for e in crossing)
+					totalreg = sum (summaries[e][1] for e in plannedevents if e in summaries)
+					logging.info (f'Incremental run: {len(plannedevents)} of {len(summaries)} events have changes.')
 				else:
-					eventavgtime = suma/count
-				eventtime = datetime.fromtimestamp(eventavgtime)
+					logging.info ('Configuration has changed since the last run, processing all events.')
+			if plannedevents is None:
+				totalreg = dbconnection.execute ('SELECT sum (ids) FROM (SELECT count (id) AS ids FROM phototable UNION SELECT count(id) AS ids FROM videotable )').fetchone()[0]
+			progress = Progresspercent (totalreg)
+			idcounter = 0
+
+			# Processing events. Events and their items are fetched by the event planner.
+			moveplan = []
+			folderplan = []  # Event folders renamed at once
+			plannedfolders = set ()  # Destinations of folderplan
+			touchedevents = set ()  # Events with planned changes
+			eventdates = dict (state.get ('eventdates', dict()))  # Dates of events with the first eventdate policy
+			avoidedmoves = 0  # Files in place that would be moved with the average eventdate policy
+			mirrorwanted = dict ()  # (DBTable, id): (mirror folder, file path, eventid) of files to mirror at the most recent folder
+			processedevents = set ()
+			if command == 'apply':
+				plannedevents = set ()  # Changes come from the plan file.
+			for eventid, eventname, eventavgtime, eventitems in eventplanner (dbconnection, plannedevents):
+				if eventavgtime == 0:
+					logging.debug ( f'\tEvent {eventid} has no datable photos or videos (or is empty).')
+				processedevents.add (eventid)
+				eventdatetime = eventdate (eventdatepolicy, eventid, eventavgtime, eventitems, eventdates)
+				eventtime = datetime.fromtimestamp(eventdatetime)
+				policymoved = datetime.fromtimestamp(eventavgtime).strftime(r'%Y-%m-%d') != eventtime.strftime(r'%Y-%m-%d')
 
 				if eventname == None :
 					eventname = ""
@@ -1091,24 +3377,22 @@ if __name__ == '__main__':
 				logging.debug ("path for the event: " + eventpath)
 				logging.debug ("path for the event in case of the the most recent pictures: " + eventpathlast)
 			
-				# retrieving event's photos and videos
-				dbtablecursor = dbconnection.cursor()
-				dbtablecursor.execute("SELECT id, filename, title, exposure_time, import_id, 'PhotoTable' AS DBTable, editable_id, rating, md5, flags FROM PhotoTable WHERE event_id = ? UNION SELECT id, filename, title, exposure_time, import_id, 'VideoTable' AS DBTable, -1 AS editable_id, rating, md5, flags FROM VideoTable WHERE event_id = ?",(eventid, eventid))
-
 				# Process each file
-				for p in dbtablecursor:
+				eventtasks = []
+				for p in eventitems:
 					idcounter += 1
 					eventpathF = eventpath
-					photoid, photopath, phototitle, phototimestamp, import_id, DBTable, editable_id, stars, filemd5, Flags = p
+					photoid, photopath, phototitle, phototimestamp, import_id, DBTable, editable_id, stars, filemd5, Flags, editable_photo = p
 					photodate = None
 					if phototimestamp:
 						photodate = datetime.fromtimestamp(phototimestamp)
 					photodateimport = datetime.fromtimestamp(import_id)
 					photofilename = os.path.basename(photopath)
 
-					if itemcheck (photopath) != "file":
+					if pathkind (photopath) != "file":
 						infomsg = f"! Image or video in database is not present at this moment:{photopath}"
 						print (infomsg) ; logging.warning (infomsg)
+						retryevents.add (eventid)
 						continue
 
 					# logging the editable ID, just for info.
@@ -1122,10 +3406,15 @@ if __name__ == '__main__':
 
 					# Check if file is in the last Kb to move to most recent dir.
 					# It also overrides files from trash beign sent to the more recent dir.
+					mirrored = False
 					if photodate:
 						if mostrecentkbs != 0 and photodate > datelimit2move_exposure and stars >= morerecent_stars and eventid != -1: 
-							logging.debug ("File will be sent to the recent pictures folder")
-							eventpathF = eventpathlast
+							if mostrecentmirror:
+								logging.debug ("File will be mirrored at the recent pictures folder")
+								mirrored = True
+							else:
+								logging.debug ("File will be sent to the recent pictures folder")
+								eventpathF = eventpathlast
 
 					photonewfilename = photofilename
 					# checking a starting date in filename
@@ -1160,35 +3449,25 @@ if __name__ == '__main__':
 						phototitle = extracttitle (os.path.splitext(photofilename)[0])
 						# Changing Title pointer
 						if dummy == False:
-							dbconnection.execute ( f'UPDATE {DBTable} SET title = ? where id = ?', ( phototitle, photoid))
+							dbwriter.execute ( f'UPDATE {DBTable} SET title = ? WHERE id = ?', ( phototitle, photoid))
+						touchedevents.add (eventid)
 						logging.debug ( f"Entry {photoid}, title updated at table {DBTable}. Title:{phototitle} {dummymsg}")
 
 					# writting titles from database to file
 					# database title = Extracted title = phototitle
 					fileextension:str = os.path.splitext (photofilename)[1]
 					if inserttitlesinfiles == True and phototitle != None and fileextension.lower() in ['.jpg']:
-						try:
-							image_metadata = GExiv2.Metadata(photopath)
-						except:
-							logging.warning ('\tAn error occurred during obtaining metadata on this file')
+						if fileactions is not None:
+							fileactions.append (('title', photopath, phototitle))
+							touchedevents.add (eventid)
 						else:
-							if image_metadata.get('Iptc.Application2.Caption') != phototitle:
-								mydictofmetadatas = {
-								'Iptc.Application2.Caption': phototitle,
-								'Iptc.Application2.Headline': phototitle,
-								'Xmp.dc.title': 'lang="x-default" ' + phototitle,
-								'Xmp.photoshop.Headline' : phototitle,
-								}
-
-								for x in mydictofmetadatas:
-									image_metadata.set_tag_string (x, mydictofmetadatas[x])
-								if dummy == False :
-									image_metadata.save_file()
-								logging.info ( f"\tImage title metadata has been updated with database title: {phototitle}{dummymsg}")
+							inserttitlemetadata (photopath, phototitle)
 					
 					photonewfilename = NoTAlloChReplace (photonewfilename)  # Replace not allowed Characters on filename for some filesystems
 					dest = os.path.join (eventpathF, photonewfilename)
 					logging.debug ("destination is set to :" + dest)
+					if mirrored:
+						mirrorwanted[(DBTable, photoid)] = (eventpathlast, photopath, eventid)
 
 					## Deletes thumbnails due a condition. Shotwell will restore deleted thumbnails
 					'''
@@ -1207,48 +3486,151 @@ if __name__ == '__main__':
 					if photopath == dest:
 						infomsg = "This file is already on its destination. This file remains on its place."
 						logging.debug (infomsg)
+						if policymoved:
+							avoidedmoves += 1
 						continue
-					else:
-						#moving files from photopath to dest
-						dest = filemove (photopath, dest)
-						# Changing DB pointer
-						if dummy == False:
-							dbconnection.execute ( f'UPDATE {DBTable} SET filename = ? where id = ?', (dest, photoid))
-						# adding a folder to scan
-						foldercollection.add (os.path.dirname(photopath))	
-						logging.debug (os.path.dirname(photopath) + ' added to folders list')
-						logging.debug ( f"Entry {photoid} updated at table {DBTable}. {dummymsg}")
-					
 					# Checking externally edited photos. Backups images are sent besides modified images.
-					if editable_id != -1:
-						editable_photo = dbconnection.execute ( f'SELECT filepath FROM BackingPhotoTable WHERE id = {editable_id}').fetchone()[0]
-						editable_dest = os.path.splitext(dest)[0] + '_modified' + os.path.splitext(dest)[1]
-						if os.path.dirname(editable_photo) == os.path.dirname(editable_dest) and editable_photo == editable_dest:
-							infomsg = "This file is already on its destination. This file remains on its place."
-							logging.debug (infomsg)
-							continue			
-						else:
-							#moving files from editable_photo to editable_dest
-							result = filemove (editable_photo, editable_dest)
-							if result != None:
-								editable_dest = result
-								foldercollection.add (os.path.dirname(editable_photo))
-								logging.debug (os.path.dirname(editable_photo) + ' added to folders list')
-								# Changing DB pointer
-								if dummy == False:
-									dbconnection.execute ('UPDATE BackingPhotoTable SET filepath = ? where id = ?', (editable_dest, editable_id))
-								logging.debug ( f"Entry {editable_id} updated at table BackingPhotoTable. {dummymsg}")
-							else:
-								infomsg = f"Cannot find editable file id({editable_id}): {editable_photo}"
-								logging.warning (infomsg)
-
-				dbtablecursor.close()
+					if editable_id != -1 and editable_photo is None:
+						logging.warning (f"Cannot find editable file id({editable_id}) at BackingPhotoTable")
+						editable_id = -1
+					eventtasks.append (Movetask (photoid, DBTable, photopath, dest, editable_id, editable_photo, eventid, filemd5))
+					touchedevents.add (eventid)
+					logging.debug (f"Entry {photoid} added to the move plan.")
+
+				# If the whole event folder is moved as it is, it is renamed at once.
+				foldertask = eventfoldertask (eventtasks, len (eventitems), plannedfolders)
+				if foldertask is not None:
+					folderplan.append (foldertask)
+					logging.debug (f"Event folder will be renamed to: {foldertask.dest}")
+				else:
+					moveplan.extend (eventtasks)
+
+			if eventdatepolicy != 'average':
+				logging.info (f'The {eventdatepolicy} eventdate policy avoided moving {avoidedmoves} files.')
+
+			# Saving the plan made on a DB snapshot to a plan file, or waiting for Shotwell to exit to apply it.
+			if snapshotmode:
+				dbwriter.commit ('planning')
+				snapshotcheck['signatures'] = {e: snapshotcheck['signatures'].get (e) for e in touchedevents}
+				snapshotcheck['rows'].update (rowvalues (dbconnection, {('BackingPhotoTable', t.editable_id) for t in chain (moveplan, *(f.tasks for f in folderplan)) if t.editable_id != -1}))
+				dbconnection.close ()
+				if command == 'plan':
+					header = {'created': datetime.now(), 'check': snapshotcheck, 'runsignature': runsignature, 'datelimit': datelimit, 'eventdates': eventdates, 'mostrecent': mostrecent,
+						'mirror': (mirrorwanted, processedevents)}
+					writeplan (planFile, header, planrecords (writelog, fileactions, moveplan, folderplan))
+					os.remove (snapshotFile)
+					if fpcache is not None:
+						fpcache.flush ()
+					print (f'Plan saved at {planFile}: {len(folderplan)} folders to rename, {len(moveplan)} files to move, {len(writelog)} DB changes, {len(fileactions)} file metadata changes.')
+					logging.info (f'Plan saved at {planFile}')
+					break
+				print (f'Plan is ready: {len(folderplan)} folders to rename, {len(moveplan)} files to move, {len(writelog)} DB changes. Waiting for Shotwell to exit.')
+				logging.info ('Waiting for Shotwell to exit to apply the plan.')
+				if not waitappexit ('shotwell', Daemonmaxwait):
+					os.remove (snapshotFile)
+					print (f'Shotwell is still running after {Daemonmaxwait} seconds, the plan is discarded.')
+					logging.warning (f'Shotwell is still running after {Daemonmaxwait} seconds, the plan is discarded.')
+					if daemonmode:
+						continue  # A new plan is made on a fresh snapshot.
+					break
+				os.remove (snapshotFile)
+				dbconnection = sqlite3.connect (DBpath)
+				if dummy == False:
+					recoverjournal (dbconnection, journalFile)
+				dbeventcursor = dbconnection.cursor ()
+				try:
+					dbeventcursor.execute("INSERT INTO EventTable (id, name) VALUES (-1,'Trash')")
+					if dummy == False:
+						dbconnection.commit()
+				except:
+					pass
+				plan = planrecords (writelog, fileactions, moveplan, folderplan)
+			elif command == 'apply':
+				logging.info (f'Reading plan file {planFile}')
+				try:
+					plan = readplan (planFile)
+					header = next (plan)[1]
+				except (OSError, ValueError, StopIteration) as error:
+					print (f'Plan file cannot be read: {error}')
+					logging.critical (f'Plan file cannot be read: {error}')
+					dbeventcursor.execute("DELETE FROM EventTable WHERE id = -1")
+					if dummy == False:
+						dbconnection.commit()
+					dbconnection.close ()
+					break
+				snapshotcheck, runsignature, datelimit, eventdates = header['check'], header['runsignature'], header['datelimit'], header['eventdates']
+				mostrecent = header['mostrecent']
+				mirrorwanted, processedevents = header['mirror']
+
+			# Applying a plan made on a DB snapshot. Plans are discarded if the DB has changed since the snapshot.
+			if snapshotmode or command == 'apply':
+				if not snapshotisvalid (dbconnection, snapshotcheck):
+					dbeventcursor.execute("DELETE FROM EventTable WHERE id = -1")
+					if dummy == False:
+						dbconnection.commit()
+					dbconnection.close ()
+					if command == 'apply':
+						print ('Shotwell DataBase has changed since the plan was made, it cannot be applied.')
+						logging.critical ('Shotwell DB has changed since the plan was made, it cannot be applied.')
+						break
+					print ('Shotwell DataBase has changed since the snapshot, the plan is discarded.')
+					logging.warning ('Shotwell DB has changed since the snapshot, the plan is discarded and a new pass will run.')
+					continue
+				logging.info ('Plan is valid, applying it.')
+				dbwriter = DBwriter (dbconnection, dbcommitbatch, dummy)
+				# The plan is streamed: folders and moves are read as they are executed.
+				folderplan, moveplan = applyplanrecords (plan, dbwriter)
+
+			# Removing the mirrors if the mirror mode is turned off. It is done before files are moved,
+			# as recent files come back to the folders of their mirrors, and their names must be free.
+			mirror = None
+			if not (mostrecentmirror and mostrecentkbs > 0) and state.get ('mirror'):
+				mirror, emptied = syncmirror ([], state['mirror'], {v[1] for v in state['mirror'].values()})
+				foldercollection.update (emptied)
+
+			# Executing the move plan and changing DB pointers
+			if dummy == False:
+				movejournal = Movejournal (journalFile)
+			batchsize = Journalbatch if snapshotmode or command == 'apply' else None  # Plans read as records are streamed
+			finalpaths, movedfrom, failedevents = executeplan (folderplan, moveplan, moveworkers, dbwriter, batchsize, set (mirrorwanted))
+			foldercollection.update (movedfrom)
+			retryevents.update (failedevents)
+			if movejournal is not None:
+				movejournal.close ()
+				movejournal = None
+
+			# Mirroring the most recent files.
+			if mostrecentmirror and mostrecentkbs > 0:
+				wanted = [(mirrordir, finalpaths.get (key, filepath), eventid) for key, (mirrordir, filepath, eventid) in mirrorwanted.items() if finalpaths.get (key, filepath) is not None]
+				mirror, emptied = syncmirror (wanted, state.get ('mirror', dict()), processedevents)
+				foldercollection.update (emptied)
+
+			if dummy == True:
+				dbconnection.rollback ()
+			elif incremental or eventdatepolicy == 'first' or mostrecent is not None or mirror is not None:
+				if incremental:
+					state.pop ('eventsignatures', None)  # Saved by older versions.
+					state['eventsummaries'] = eventsummaries (dbconnection)
+					state['highwater'] = highwatermarks (dbconnection)
+					state['runsignature'] = runsignature
+					state['datelimit'] = datelimit
+					state['retryevents'] = retryevents
+				if eventdatepolicy == 'first':
+					state['eventdates'] = eventdates
+				if mostrecent is not None:
+					state['mostrecent'] = mostrecent
+				if mirror is not None:
+					state['mirror'] = mirror
+				savestate (state)
 
 			# Deleting Trash event and closing connections
 			dbeventcursor.execute("DELETE FROM EventTable WHERE id = -1")
 			dbeventcursor.close()
-			dbconnection.commit()
-			logging.debug ("Changes were commited")
+			if dummy == False:
+				dbconnection.commit()
+				logging.debug ("Changes were commited")
+			else:
+				dbconnection.rollback ()
 
 			# Cleaning empty folders
 			if clearfolders == True:
@@ -1265,6 +3647,8 @@ if __name__ == '__main__':
 								logging.warning ('I will not delete your Desktop directory.')
 								continue
 							shutil.rmtree (i)
+							if dirindex is not None:
+								dirindex.remove (i)
 							ftext = i
 							if len (ftext) > 50:
 								ftext = "..." + ftext [-47:]
@@ -1279,19 +3663,69 @@ if __name__ == '__main__':
 			if conv_mov and ffmpeg:
 				logging.debug ('Querying DB for video conversions.')
 				newImportID = int(now.timestamp())
-				dbMOVcursor = dbconnection.cursor()
-				dbMOVcursor.execute (
+				videorows = dbconnection.execute (
 						"SELECT ROUND ((filesize/clip_duration)/(width*height/1000)) AS bitrate,* FROM videotable WHERE \
 						filename LIKE '%{0}.{1}' ESCAPE '/' \
-						AND bitrate > {2} \
 						AND filename NOT LIKE '%/_c.mov' ESCAPE '/' \
 						AND filename NOT LIKE '%/_f.{1}' ESCAPE '/' \
 						AND rating > -1 \
-						AND (event_id <> -1 OR (event_id = -1 and exposure_time = 0))".format (conv_flag_q, conv_extension_q, conv_bitrate_kbs,)
-						)
-				for entry in dbMOVcursor:
-					Entry_id = entry [1]
+						AND (event_id <> -1 OR (event_id = -1 and exposure_time = 0))".format (conv_flag_q, conv_extension_q,)
+						).fetchall()  # Rows are fetched at once, the DB is written meanwhile videos are converted.
+				# Videos are selected by their probed bitrate, Shotwell values are used if they can't be probed.
+				probes = dict ()
+				if ffprobe:
+					probes = probevideopool ([entry[2] for entry in videorows if itemcheck (entry[2]) == 'file'])
+				candidates = []
+				for entry in videorows:
+					probe = probes.get (entry[2])
+					bitrate = conversionbitrate (probe, entry[7], entry[5], entry[3], entry[4])
+					if bitrate is None or bitrate <= conv_bitrate_kbs:
+						continue
+					strategy = conversionstrategy (probe, conv_remux_kbs, conv_segment_seconds)
+					priority = conversionpriority (probe, entry[7], entry[5], entry[3], entry[4], conv_bitrate_kbs)
+					candidates.append (((strategy != 'remux', -priority, entry[1]), entry, strategy))
+				# Remuxes take seconds of I/O, they go first. Encodes go by bytes saved per CPU second.
+				candidates.sort (key=lambda candidate: candidate[0])
+				logging.debug (f'{len (candidates)} of {len (videorows)} videos are over the conversion bitrate, {len (probes)} probed.')
+				conversions = Conversionqueue (conv_workers, conv_threads, conv_nice, conv_segment_seconds, segmentsFolder)
+				deadline = None
+				if conv_tick_seconds > 0:
+					deadline = time.monotonic () + conv_tick_seconds
+				conversionsleft = 0
+				for sortkey, entry, strategy in candidates:
 					sourcefile = entry[2]
+					Entry_exposure_time = entry [9]
+
+					if itemcheck (sourcefile) != 'file':
+						logging.warning( '\tThis file cannot be accessed, or does not exist at this very moment.')
+						continue
+										
+					videoStringTime = None
+					if Entry_exposure_time != 0:
+						videoCreationTime = datetime.fromtimestamp ( Entry_exposure_time)
+						videoStringTime = datetime.isoformat( videoCreationTime, timespec='microseconds') + 'Z'  # Example:   2018-01-03T18:25:34.000000Z
+
+					newFilename = os.path.splitext(sourcefile)[0]+'_c.mov'
+					job = Conversionjob (entry, sourcefile, newFilename, videoStringTime, strategy)
+					if itemcheck (newFilename) == 'file':
+						duration = videomeasures (probes.get (sourcefile), entry[7], entry[5], entry[3], entry[4])[1]
+						if dummy == False and ffprobe and convertedisvalid (newFilename, duration):
+							# Converted by a pass that was stopped before writing it to DB.
+							logging.info ( f'Taking a conversion finished on a former pass: {newFilename}')
+							conversions.add (job, converted=True)
+							continue
+						if dummy == False:
+							os.remove(newFilename)
+						logging.warning ( f'\tIt seems that an old converted file was there, it has been deleted.{dummymsg}')
+					logging.info ( f'Queuing file to convert ({strategy}) with ffmpeg: {sourcefile}')
+					conversions.add (job)
+				if dummy == False:
+					conversions.cleansegments ()
+
+				# DB is updated from this thread as conversions finish.
+				for job, ffmpeg_status in conversions.results (shotwellstarted, deadline):
+					entry, sourcefile, newFilename = job.entry, job.src, job.dest
+					Entry_id = entry [1]
 					Entry_width = entry [3]
 					Entry_height = entry [4]
 					Entry_clip_duration = entry [5]
@@ -1309,36 +3743,16 @@ if __name__ == '__main__':
 					#Entry_time_reimported = entry [17]
 					#Entry_flags = entry [18]
 					Entry_comment = entry [19]
-
-					if itemcheck (sourcefile) != 'file':
-						logging.warning( '\tThis file cannot be accessed, or does not exist at this very moment.')
-						continue
-										
 					Entry_tag_id = f'video-{Entry_id:016x},'
-					metadataparam = ''
-					if Entry_exposure_time != 0:
-						videoCreationTime = datetime.fromtimestamp ( Entry_exposure_time)
-						videoStringTime = datetime.isoformat( videoCreationTime, timespec='microseconds') + 'Z'  # Example:   2018-01-03T18:25:34.000000Z
-						metadataparam += f'-metadata creation_time="{videoStringTime}"'
-
-					logging.info ( f'Processing file with ffmpeg: {sourcefile}')
-					newFilename = os.path.splitext(sourcefile)[0]+'_c.mov'
-					if itemcheck (newFilename) == 'file':
-						if dummy == False:
-							os.remove(newFilename)
-						logging.warning ( f'\tIt seems that an old converted file was there, it has been deleted.{dummymsg}')
-					
-					if dummy == False:
-						logging.info( f'\tConverting video {newFilename}')
-						ffmpeg_status = os.system (f'ffmpeg -i "{sourcefile}" {metadataparam} "{newFilename}"')
-					else:
-						ffmpeg_status = 0
-					logging.debug( f'\tffmpeg exitted with code: {ffmpeg_status}{dummymsg}')
-
-					if getappstatus (['shotwell']):
-						print( '\nWARNING: Shotwell process is running, I will not run meanwhile Shotwell application is running.')
-						logging.warning( 'Shotwell process is running. Aborting current conversion.')
-						ffmpeg_status = None  # Exit conversion sesion.
+					logging.debug( f'\tffmpeg exitted with code: {ffmpeg_status} converting ({job.strategy}) {sourcefile}{dummymsg}')
+
+					if job.strategy == 'remux' and ffmpeg_status not in (0, None):
+						# Streams can't be copied to the new container, encoding them.
+						logging.info ( f'\tRemux failed, queuing file to encode with ffmpeg: {sourcefile}')
+						if itemcheck (newFilename) == 'file':
+							os.remove (newFilename)
+						conversions.add (job._replace (strategy='encode'))
+						continue
 
 					if ffmpeg_status == 0:
 						# (ffmpeg exitted with no errors)
@@ -1347,7 +3761,7 @@ if __name__ == '__main__':
 						newMD5 = 0
 						newFilesize = 0
 						if dummy == False:
-							newMD5 = md5hash (newFilename)
+							newMD5 = cachedmd5hash (newFilename)
 							newFilesize = os.path.getsize (newFilename)
 						newEntry = (None,
 									newFilename,
@@ -1374,47 +3788,52 @@ if __name__ == '__main__':
 						if videoConvlineID is None:
 							logging.debug ( f'\tInserting new line at VideoTable.{dummymsg}')
 							if dummy == False:
-								dbconnection.execute ('INSERT INTO videotable VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?) ', newEntry )
+								dbwriter.flush ()
+								newEntry_id = dbconnection.execute ('INSERT INTO videotable VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?,?) ', newEntry ).lastrowid
 								# Adding new videofiles to tag table (cloning values)
-								dbconnection.commit ()
-								newEntry_id = dbconnection.execute ('SELECT max(id) FROM videotable').fetchone()[0]
 								newVideoTag_id = f'video-{newEntry_id:016x},'
 								TagCursor = dbconnection.cursor ()
 								logging.debug ( f'\tSelecting tags for entry {Entry_tag_id}')
 								TagCursor.execute ("SELECT id, photo_id_list FROM tagtable WHERE photo_id_list LIKE ?", (f'%{Entry_tag_id}%',))
-								for TagEntry in TagCursor:
+								for TagEntry in TagCursor.fetchall ():
 									lineID , tagtext = TagEntry[0], TagEntry[1]
 									newTagText = tagtext + newVideoTag_id
-									dbconnection.execute ('UPDATE tagtable SET photo_id_list=? WHERE id=?',(newTagText,lineID))
+									dbwriter.execute ('UPDATE tagtable SET photo_id_list=? WHERE id=?',(newTagText,lineID))
 
 						else:
 							logging.debug ( f'\tUpdating an existent registry for converted video.{dummymsg}')
 							# This will not update or clone the tag registry, it will preserve existent converted video tag attributes and rating.
 							if dummy == False:
-								dbconnection.execute ('UPDATE videotable SET filesize=?, import_id=?, md5=?, time_created=? WHERE id = ?', (newFilesize, newImportID, newMD5, int(now.timestamp()), videoConvlineID[0]))
+								dbwriter.execute ('UPDATE videotable SET filesize=?, import_id=?, md5=?, time_created=? WHERE id = ?', (newFilesize, newImportID, newMD5, int(now.timestamp()), videoConvlineID[0]))
 						
 						# Set original video as rejected. (rating = -1)
 						if dummy == False:
-							dbconnection.execute ('UPDATE videotable SET rating=-1 WHERE id = ?', (Entry_id,))
+							dbwriter.execute ('UPDATE videotable SET rating=-1 WHERE id = ?', (Entry_id,))
 						
+					elif ffmpeg_status is None:
+						# The conversion was stopped or could not be run, a finished new file is kept for next pass.
+						conversionsleft += 1
 					else:
 						# ffmpeg encounterered errors
 						if dummy == False:
 							if itemcheck (newFilename) == 'file':
 								os.remove(newFilename)
-							if ffmpeg_status is not None:
-								failedName = os.path.splitext(sourcefile)[0]+'_f{}'.format (os.path.splitext(sourcefile)[1])
+							failedName = os.path.splitext(sourcefile)[0]+'_f{}'.format (os.path.splitext(sourcefile)[1])
+							try:
 								os.rename (sourcefile, failedName)
-								dbconnection.execute('UPDATE videotable SET filename=? WHERE id=?', (failedName,Entry_id))
+							except OSError as error:
+								logging.warning (f'\tFailed video cannot be renamed to {failedName}: {error}')
 							else:
-								break
+								dbwriter.execute('UPDATE videotable SET filename=? WHERE id=?', (failedName,Entry_id))
 
-					if dummy == False:
-						dbconnection.commit()
-					
-				dbMOVcursor.close()
+					dbwriter.commit ('conversion')
+				conversions.close ()
+				if conversionsleft > 0:
+					logging.info (f'{conversionsleft} videos are left to convert on next pass.')
 			# Closing db Connection
 			dbconnection.close ()
+			if fpcache is not None:
+				fpcache.flush ()
 			logging.debug ("DB connection was closed")
 
 
@@ -1425,10 +3844,13 @@ if __name__ == '__main__':
 				logging.debug ('Creating/updating LastExecFile.dump')
 				pickle.dump (LastExec, f)
 				f.close()
-			if sleepseconds > 0:
-				time.sleep (sleepseconds)
-			else:
+			if sleepseconds <= 0:
 				break
+			if dbwatcher is not None:
+				dbwatcher.read ()  # discarding changes made by this pass
+				waitforchanges (dbwatcher, 'shotwell', Daemonmaxwait, deferred or conversionsleft > 0)
+			else:
+				time.sleep (sleepseconds)
 		else:
 			break
 	print ('\nDone!')
\ No newline at end of file